@@ -1,212 +1,555 @@
+# -*- coding: utf-8 -*-
 # ======================================================
-# I. TẠO TESTSET 100 MẪU TỪ TOÀN BỘ DỮ LIỆU
-# Code chạy trên Google Colab
+# ĐÁNH GIÁ CHATBOT: SONG SONG, CHẠY TIẾP ĐƯỢC, BERTSCORE THEO BATCH
+#
+#   # 1) Sinh testset (JSONL, mỗi dòng một câu hỏi có id cố định) từ dữ liệu gốc
+#   python Model_Evaluation.py testset --data toan_bo_du_lieu_final.json \
+#       --out testset.jsonl --size 2000
+#
+#   # 2) Retrieval (recall@k, MRR của expected_link trong các nguon truy xuất được),
+#   #    chạy pipeline trong process, KHÔNG gọi LLM
+#   python Model_Evaluation.py retrieval --testset testset.jsonl --out retrieval.jsonl --k 1 3 5 10
+#
+#   # 3) Câu trả lời end-to-end qua HTTP API (hoặc --backend inprocess). Mặc định tắt
+#   #    fast path để đo LLM; --fast-path [--compare-llm] đo cả fast path, báo cáo
+#   #    tách theo answer_source
+#   python Model_Evaluation.py answers --testset testset.jsonl --out answers.jsonl \
+#       --api-url http://localhost:7860/chat --workers 16
+#
+#   # 4) BERTScore theo batch (điểm ghi vào answers.scores.jsonl) + báo cáo
+#   python Model_Evaluation.py score --results answers.jsonl --batch-size 64
+#   python Model_Evaluation.py report --results answers.jsonl --retrieval retrieval.jsonl
+#
+# Mỗi kết quả được ghi ngay vào file JSONL khi xong; chạy lại cùng lệnh sẽ bỏ qua
+# các id đã có (dòng lỗi được chạy lại), nên có thể dừng / tiếp tục bất cứ lúc nào.
+#
+# --backend inprocess nạp app.py trực tiếp (initialize_application, tải artifact
+# từ HF Hub); --bench-data <dir> dùng corpus giả lập của benchmark_pipeline.py
+# (LLM giả) để kiểm tra nhanh chính script này.
 # ======================================================
 
-import json, random, re, requests, time
-from urllib.parse import urlparse, unquote
-import evaluate
-import pandas as pd
-
-# Đọc dữ liệu gốc (toàn bộ)
-with open("/content/drive/MyDrive/eGov-Bot/EDA/toan_bo_du_lieu_final.json", "r", encoding="utf-8") as f:
-    data = json.load(f)
-
-dialogs = []
-for rec in data:
-    # Lấy các trường quan trọng trong bản ghi
-    ten = rec.get("ten_thu_tuc", "")
-    co_quan = rec.get("co_quan_thuc_hien", "")
-    ho_so = rec.get("thanh_phan_ho_so", "")
-    trinh_tu = rec.get("trinh_tu_thuc_hien", "")
-    link = rec.get("nguon", "")
-
-    dialogue = []
-    # Tạo câu hỏi-đáp cho từng trường (ưu tiên hồ sơ, rồi cơ quan, rồi trình tự)
-    if ho_so:
-        dialogue.append({
-            "question": f"Làm thủ tục {ten.lower()} cần những giấy tờ gì?",
-            "answer": ho_so.strip(),
-            "expected_link": link
-        })
-    if co_quan:
-        if not dialogue:
-            dialogue.append({
-                "question": f"Cơ quan nào thực hiện thủ tục {ten.lower()}?",
-                "answer": co_quan.strip(),
-                "expected_link": link
-            })
-        else:
-            dialogue.append({
-                "question": "Cơ quan nào thực hiện thủ tục này?",
-                "answer": co_quan.strip(),
-                "expected_link": link
-            })
-    if trinh_tu:
-        if not dialogue:
-            dialogue.append({
-                "question": f"Trình tự thực hiện thủ tục {ten.lower()} là gì?",
-                "answer": trinh_tu.strip(),
-                "expected_link": link
-            })
-        else:
-            dialogue.append({
-                "question": "Vậy trình tự thế nào?",
-                "answer": trinh_tu.strip(),
-                "expected_link": link
-            })
-
-    # Nếu có ít nhất 1 QA thì thêm vào danh sách
-    if dialogue:
-        dialogs.append({
-            "context": ten,      # Lưu context là tên thủ tục
-            "dialogue": dialogue
-        })
-
-# Gom tất cả các turn (mỗi turn = 1 câu hỏi-đáp)
-all_turns = []
-for d in dialogs:
-    for t in d["dialogue"]:
-        all_turns.append({
-            "context": d["context"],
-            "dialogue": [t]   # vẫn giữ format multi-turn
-        })
-
-print(f"Tổng số turn có sẵn: {len(all_turns)}")
-
-# Lấy ngẫu nhiên đúng 100 turn (nếu dữ liệu đủ nhiều)
-if len(all_turns) >= 100:
-    final_dialogs = random.sample(all_turns, 100)
-else:
-    final_dialogs = all_turns
-
-print(f"Số mẫu test chọn: {len(final_dialogs)}")
-
-# Lưu ra file JSON để dùng cho đánh giá
-out_path = "/content/drive/MyDrive/eGov-Bot/EDA/testset_100_multi_turn.json"
-with open(out_path, "w", encoding="utf-8") as f:
-    json.dump(final_dialogs, f, ensure_ascii=False, indent=2)
-
-print(f"✅ Testset đã lưu tại: {out_path}")
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+from urllib.parse import unquote
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from offline_common import read_items  # noqa: E402
+
+
+# ======================================================
+# I. TESTSET
+# ======================================================
+
+# (trường, mẫu câu hỏi): mỗi thủ tục sinh tối đa một câu cho mỗi trường có dữ liệu.
+# Đây đúng là dạng câu fast path trả lời thẳng, nên lệnh answers mặc định tắt fast path
+QUESTION_TEMPLATES = [
+    ("thanh_phan_ho_so", "Làm thủ tục {name} cần những giấy tờ gì?"),
+    ("co_quan_thuc_hien", "Cơ quan nào thực hiện thủ tục {name}?"),
+    ("trinh_tu_thuc_hien", "Trình tự thực hiện thủ tục {name} là gì?"),
+]
+
+
+def cmd_testset(args):
+    with open(args.data, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    items = []
+    for rec in data:
+        name, link = rec.get("ten_thu_tuc", "").strip(), rec.get("nguon", "").strip()
+        if not name or not link:
+            continue
+        for field, template in QUESTION_TEMPLATES:
+            value = (rec.get(field) or "").strip()
+            if value:
+                items.append({"context": name, "field": field, "question": template.format(name=name.lower()),
+                              "answer": value, "expected_link": link})
+
+    print(f"Tổng số câu hỏi có thể sinh: {len(items)}")
+    if args.size and len(items) > args.size:
+        items = random.Random(args.seed).sample(items, args.size)
+    with open(args.out, "w", encoding="utf-8") as f:
+        for i, item in enumerate(items):
+            f.write(json.dumps({"id": str(i), **item}, ensure_ascii=False) + "\n")
+    print(f"✅ Testset {len(items)} câu đã lưu tại: {args.out}")
+
+
+# ======================================================
+# II. CHECKPOINT JSONL + CHẠY SONG SONG
+# ======================================================
+
+class JsonlCheckpoint:
+    """Append-only JSONL keyed by "id"; a row with "error" is retried on the next run"""
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = latest_rows(path)
+        self._lock = threading.Lock()
+        # Dòng cuối ghi dở (bị ngắt giữa chừng): xuống dòng để dòng mới không dính vào
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, "rb+") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+
+    def done(self, item_id):
+        row = self.rows.get(item_id)
+        return row is not None and not row.get("error")
+
+    def extend(self, rows):
+        lines = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+            for row in rows:
+                self.rows[row["id"]] = row
+
+    def append(self, row):
+        self.extend([row])
+
+
+def load_jsonl(path):
+    """Các dòng của file JSONL (bỏ dòng cuối ghi dở nếu lần chạy trước bị ngắt)"""
+    if not path or not os.path.exists(path):
+        return []
+    rows = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                continue
+    return rows
+
+
+def latest_rows(path):
+    """id -> dòng mới nhất (một id có thể được ghi lại khi chạy tiếp)"""
+    return {row["id"]: row for row in load_jsonl(path)}
+
+
+def run_parallel(items, fn, checkpoint, workers, label):
+    """Chạy fn(item) -> row cho các item chưa có trong checkpoint, ghi từng dòng khi xong"""
+    todo = [item for item in items if not checkpoint.done(item["id"])]
+    print(f"[{label}] {len(items) - len(todo)}/{len(items)} đã có trong {checkpoint.path}, "
+          f"chạy {len(todo)} câu với {workers} worker")
+    start = time.perf_counter()
+    errors = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(fn, item): item for item in todo}
+        for n, future in enumerate(as_completed(futures), 1):
+            item = futures[future]
+            try:
+                row = future.result()
+            except Exception as e:
+                row = {"id": item["id"], "question": item.get("question", ""), "error": str(e)}
+            errors += bool(row.get("error"))
+            checkpoint.append(row)
+            if n % 50 == 0 or n == len(todo):
+                elapsed = time.perf_counter() - start
+                print(f"[{label}] {n}/{len(todo)}  {n / elapsed:.1f} câu/s  lỗi: {errors}")
+    return errors
+
+
+# ======================================================
+# III. BACKEND: HTTP API HOẶC APP TRONG PROCESS
+# ======================================================
+
+class HttpBackend:
+    """POST /chat với một requests.Session mỗi thread, retry + backoff khi 429 / 5xx"""
+
+    def __init__(self, url, timeout, retries):
+        import requests
+
+        self.requests = requests
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self._local = threading.local()
+
+    def chat(self, payload):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self.requests.Session()
+        error = None
+        for attempt in range(self.retries):
+            try:
+                resp = session.post(self.url, json=payload, timeout=self.timeout)
+                if resp.status_code == 200:
+                    return resp.json()
+                error = f"HTTP {resp.status_code}: {resp.text[:200]}"
+                if resp.status_code < 500 and resp.status_code != 429:
+                    break
+            except Exception as e:
+                error = str(e)
+            time.sleep(min(30.0, 2.0 ** attempt))
+        raise RuntimeError(error)
+
+
+class InProcessBackend:
+    """app.py nạp trong process; /chat qua Flask test client"""
+
+    def __init__(self, chatbot):
+        self.chatbot = chatbot
+
+    def chat(self, payload):
+        resp = self.chatbot.app.test_client().post("/chat", json=payload)
+        if resp.status_code != 200:
+            raise RuntimeError(f"HTTP {resp.status_code}: {resp.get_data(as_text=True)[:200]}")
+        return resp.get_json()
+
+
+def load_app(args):
+    """Nạp app.py cho --backend inprocess / retrieval, không ghi analytics vào user_data"""
+    if args.bench_data:
+        import benchmark_pipeline
+
+        bench_args = SimpleNamespace(data_dir=args.bench_data, embedder="hash", encode_ms=0.0,
+                                     llm_latency_ms=0.0, llm_jitter_ms=0.0)
+        return benchmark_pipeline.load_app(bench_args, benchmark_pipeline.StageTimer())
+
+    work_dir = tempfile.mkdtemp(prefix="egov-eval-")
+    os.environ.setdefault("ANALYTICS_DB", os.path.join(work_dir, "analytics.db"))
+
+    import app as chatbot
+    from analytics_store import AnalyticsStore
+
+    # load_resources giữ store này thay vì tạo store trên ANALYTICS_DB mặc định
+    chatbot.analytics = AnalyticsStore(os.path.join(work_dir, "analytics.db"))
+    chatbot.initialize_application()
+    return chatbot, work_dir
+
+
+def close_app(chatbot, work_dir):
+    chatbot.analytics.close()
+    shutil.rmtree(work_dir, ignore_errors=True)
 
 
 # ======================================================
-# II. CHẠY ĐÁNH GIÁ TRÊN TESTSET VỪA TẠO
+# IV. RETRIEVAL (KHÔNG CẦN LLM)
 # ======================================================
 
-import json, random, re, requests, time
-from urllib.parse import urlparse, unquote
-from tqdm import tqdm
-import evaluate
-import pandas as pd
+def normalize_url(url):
+    return unquote((url or "").strip()).rstrip("/").lower()
+
+
+def cmd_retrieval(args):
+    chatbot, work_dir = load_app(args)
+    max_k = max(args.k)
+
+    def evaluate_item(item):
+        expected = normalize_url(item.get("expected_link"))
+        start = time.perf_counter()
+        retrieved = [parent_id for parent_id, _ in chatbot.retrieve_procedures(item["question"], top_k=max_k)]
+        latency_ms = round((time.perf_counter() - start) * 1000, 2)
+        ranks = [i for i, parent_id in enumerate(retrieved, 1) if normalize_url(parent_id) == expected]
+        return {"id": item["id"], "question": item["question"], "expected_link": item.get("expected_link"),
+                "retrieved": retrieved, "rank": ranks[0] if ranks else None, "latency_ms": latency_ms}
+
+    try:
+        items = read_items(args.testset)
+        checkpoint = JsonlCheckpoint(args.out)
+        run_parallel(items, evaluate_item, checkpoint, args.workers, "retrieval")
+    finally:
+        close_app(chatbot, work_dir)
+    print_report(retrieval_report(latest_rows(args.out), args.k))
+
+
+def retrieval_report(rows, ks):
+    rows = [r for r in rows.values() if not r.get("error")]
+    if not rows:
+        return {}
+    ranks = [r.get("rank") for r in rows]
+    return {
+        "retrieval": {
+            "questions": len(rows),
+            **{f"recall@{k}": round(sum(1 for rank in ranks if rank and rank <= k) / len(rows), 4)
+               for k in sorted(ks)},
+            "mrr": round(sum(1.0 / rank for rank in ranks if rank) / len(rows), 4),
+            **latency_summary([r.get("latency_ms") for r in rows]),
+        }
+    }
+
+
+# ======================================================
+# V. CÂU TRẢ LỜI END-TO-END
+# ======================================================
+
+# Link dạng markdown [..](url) hoặc URL thuần
+_MD_LINK_RE = re.compile(r'\[.*?\]\((https?://[^\s)]+)\)')
+_PLAIN_LINK_RE = re.compile(r'https?://[^\s\)\]\}\'"]+')
+
 
-# Hàm tách link từ câu trả lời của chatbot (trường hợp có markdown hoặc URL thuần)
 def extract_links(text):
-    """Tách URL từ text (Markdown + plain URL)."""
+    """Tất cả URL trong câu trả lời (Markdown + URL thuần), theo thứ tự, không trùng"""
     if not text:
         return []
     text = str(text)
-    md = re.findall(r'\[.*?\]\((https?://[^\s)]+)\)', text)   # link dạng markdownzal
-    plain = re.findall(r'https?://[^\s\)\]\}\'"]+', text)     # link dạng thuần
-    urls = md + plain
     seen, out = set(), []
-    for u in urls:
+    for u in _MD_LINK_RE.findall(text) + _PLAIN_LINK_RE.findall(text):
         u = u.strip().rstrip('.,;:!?)]}\'"')   # loại bỏ ký tự thừa cuối URL
         if u and u not in seen:
             seen.add(u)
             out.append(u)
-    return out[-1]   # chỉ lấy link cuối cùng nếu có nhiều
-
-# Đọc file testset đã chuẩn bị
-final_dialogs = json.load(open("D:\\testset_single_turn.json", "r", encoding="utf-8"))
-
-# API chatbot (server local)
-API_ENDPOINT = "http://localhost:7860/chat"
-
-# Hàm gọi chatbot với retry
-def call_chatbot(question, session_id, retries=3):
-    """Gọi API chatbot với retry và log lỗi."""
-    for attempt in range(retries):
-        try:
-            resp = requests.post(
-                API_ENDPOINT,
-                json={"question": question, "session_id": session_id},
-                timeout=30
-            )
-            if resp.status_code == 200:
-                return resp.json().get("answer", "")
-            else:
-                print(f"❌ Lỗi API {resp.status_code} (thử {attempt+1}/{retries}) cho câu: {question}")
-                print("Chi tiết:", resp.text[:300])
-        except Exception as e:
-            print(f"❌ Exception (thử {attempt+1}/{retries}): {e} cho câu: {question}")
-        time.sleep(2)
-    return ""
-
-# Chạy đánh giá: gọi chatbot cho từng câu hỏi và lưu kết quả
-final_questions = json.load(open("D:\\testset_single_turn.json", "r", encoding="utf-8"))
-
-results = []
-for item in final_questions:
-    q = item["question"]
-    gold = item["answer"]
-    expected_link = item["expected_link"]
+    return out
+
+
+def cmd_answers(args):
+    chatbot = work_dir = None
+    if args.backend == "http":
+        backend = HttpBackend(args.api_url, args.timeout, args.retries)
+    else:
+        chatbot, work_dir = load_app(args)
+        backend = InProcessBackend(chatbot)
+
+    def answer_item(item):
+        # Mỗi câu một session riêng: câu trước không làm lệch ngữ cảnh câu sau
+        payload = {"question": item["question"], "session_id": f"eval-{item['id']}", "fast_path": args.fast_path}
+        start = time.perf_counter()
+        body = backend.chat(payload)
+        pred = body.get("answer", "")
+        if body.get("error"):
+            raise RuntimeError(pred)  # error_payload: dòng lỗi, chạy lại ở lần sau
+        row = {
+            "id": item["id"],
+            "question": item["question"],
+            "gold_answer": item.get("answer", ""),
+            "expected_link": item.get("expected_link", ""),
+            "predicted_answer": pred,
+            "predicted_links": extract_links(pred),
+            "answer_source": body.get("answer_source", ""),
+            "context_source": body.get("context_source"),
+            "latency_ms": body.get("latency_ms"),
+            "client_ms": round((time.perf_counter() - start) * 1000, 2),
+            "timings": body.get("timings"),
+        }
+        # Câu được fast path trả lời: hỏi lại với fast path tắt để so sánh với LLM
+        if args.compare_llm and row["answer_source"] == "fast_path":
+            llm = backend.chat({**payload, "fast_path": False, "session_id": f"eval-llm-{item['id']}"})
+            row["llm_answer"] = llm.get("answer", "")
+            row["llm_links"] = extract_links(row["llm_answer"])
+        return row
 
     try:
-        resp = requests.post(API_ENDPOINT, json={"question": q}, timeout=30)
-        pred = resp.json().get("answer", "") if resp.status_code == 200 else ""
-    except:
-        pred = ""
-
-    # Trích xuất link chatbot trả về
-    pred_links = extract_links(pred)
-
-    results.append({
-        "question": q,
-        "gold_answer": gold,
-        "expected_link": expected_link,
-        "predicted_answer": pred,
-        "predicted_links": pred_links
-    })
-
-    time.sleep(1)   # nghỉ giữa các request để tránh quá tải
+        items = read_items(args.testset)
+        checkpoint = JsonlCheckpoint(args.out)
+        run_parallel(items, answer_item, checkpoint, args.workers, "answers")
+    finally:
+        if chatbot is not None:
+            close_app(chatbot, work_dir)
+    print_report(answers_report(latest_rows(args.out), latest_rows(scores_path(args.out, None))))
+
+
+def link_matches(expected, links):
+    expected = normalize_url(expected)
+    return bool(expected) and any(normalize_url(u) == expected for u in links or [])
+
+
+def answers_report(rows, scores):
+    rows = [r for r in rows.values() if not r.get("error")]
+    if not rows:
+        return {}
+    report = {"answers": {**answer_metrics(rows),
+                          "answer_sources": dict(Counter(r.get("answer_source") for r in rows))}}
+
+    scored = [scores[r["id"]] for r in rows if r["id"] in scores]
+    if scored:
+        report["bertscore"] = {
+            "scored": len(scored),
+            **{name: round(float(np.mean([s[name] for s in scored])), 4) for name in ("precision", "recall", "f1")},
+        }
+
+    # Tách theo answer_source: testset sinh từ QUESTION_TEMPLATES trúng đúng các mẫu
+    # của fast path, nên số gộp phần lớn là điểm của fast path chứ không phải của LLM
+    by_source = {}
+    for row in rows:
+        by_source.setdefault(row.get("answer_source") or "unknown", []).append(row)
+    if len(by_source) > 1:
+        for source, group in sorted(by_source.items()):
+            f1 = [scores[r["id"]]["f1"] for r in group if r["id"] in scores]
+            report[f"answers[{source}]"] = {
+                **answer_metrics(group),
+                **({"bertscore_f1": round(float(np.mean(f1)), 4)} if f1 else {}),
+            }
+
+    # So sánh fast path với LLM trên cùng câu hỏi (answers --compare-llm)
+    compared = [r for r in rows if r.get("answer_source") == "fast_path" and r.get("llm_answer")
+                and "llm_f1" in scores.get(r["id"], {})]
+    if compared:
+        report["fast_path_vs_llm"] = {
+            "questions": len(compared),
+            "f1_fast_path": round(float(np.mean([scores[r["id"]]["f1"] for r in compared])), 4),
+            "f1_llm": round(float(np.mean([scores[r["id"]]["llm_f1"] for r in compared])), 4),
+            "link_fast_path": round(sum(link_matches(r["expected_link"], r["predicted_links"])
+                                        for r in compared) / len(compared), 4),
+            "link_llm": round(sum(link_matches(r["expected_link"], r.get("llm_links"))
+                                  for r in compared) / len(compared), 4),
+        }
+    return report
+
+
+def answer_metrics(rows):
+    total = len(rows)
+    return {
+        "questions": total,
+        # Có link đúng ở bất kỳ đâu trong câu trả lời / chỉ xét link cuối (cách đo cũ)
+        "link_in_answer": round(sum(link_matches(r["expected_link"], r["predicted_links"]) for r in rows) / total, 4),
+        "last_link_match": round(sum(link_matches(r["expected_link"], r["predicted_links"][-1:])
+                                     for r in rows) / total, 4),
+        "context_source_match": round(sum(link_matches(r["expected_link"], [r.get("context_source")])
+                                           for r in rows) / total, 4),
+        **latency_summary([r.get("client_ms") for r in rows]),
+    }
+
+
+def latency_summary(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return {}
+    arr = np.asarray(values, dtype=float)
+    return {"p50_ms": round(float(np.percentile(arr, 50)), 2), "p95_ms": round(float(np.percentile(arr, 95)), 2)}
 
 
 # ======================================================
-# III. ĐÁNH GIÁ KẾT QUẢ
+# VI. BERTSCORE THEO BATCH + BÁO CÁO
 # ======================================================
 
-import json
-import evaluate
-
-# Đọc kết quả chatbot đã lưu
-with open("D:/test_results_single_turn.json", "r", encoding="utf-8") as f:
-    results = json.load(f)
-
-# Chuẩn bị dữ liệu cho BERTScore
-preds = [r.get("predicted_answer", "") for r in results]
-refs = [r.get("gold_answer", "") for r in results]
-
-# Tính BERTScore (đo chất lượng câu trả lời theo ngữ nghĩa)
-bertscore = evaluate.load("bertscore")
-bert_out = bertscore.compute(predictions=preds, references=refs, lang="vi")
-
-# Lấy giá trị trung bình cho precision, recall, f1
-avg_precision = sum(bert_out["precision"]) / len(bert_out["precision"])
-avg_recall = sum(bert_out["recall"]) / len(bert_out["recall"])
-avg_f1 = sum(bert_out["f1"]) / len(bert_out["f1"])
-
-print("\n=== Answer Quality (Semantic) ===")
-print(f"Precision: {avg_precision:.4f}")
-print(f"Recall: {avg_recall:.4f}")
-print(f"F1: {avg_f1:.4f}")
-
-# Đánh giá độ chính xác khi chatbot trả về link
-total = len(results)
-matches = sum(1 for r in results if r.get("expected_link") == r.get("predicted_links"))
-ratio = matches / total if total > 0 else 0
-
-print("\n=== Link Match ===")
-print(f"Tổng số phần tử: {total}")
-print(f"Số phần tử trùng khớp: {matches}")
-print(f"Tỷ lệ trùng khớp: {ratio:.2%}")
+def scores_path(results_path, scores):
+    return scores or os.path.splitext(results_path)[0] + ".scores.jsonl"
+
+
+def cmd_score(args):
+    import evaluate
+
+    rows = [r for r in latest_rows(args.results).values() if not r.get("error")]
+    checkpoint = JsonlCheckpoint(scores_path(args.results, args.scores))
+    done = checkpoint.rows
+    todo = [r for r in rows if r["id"] not in done or (r.get("llm_answer") and "llm_f1" not in done[r["id"]])]
+    print(f"[score] {len(rows) - len(todo)}/{len(rows)} đã có điểm trong {checkpoint.path}, chấm {len(todo)} câu")
+
+    bertscore = evaluate.load("bertscore")
+
+    def compute(preds, refs):
+        # Câu trả lời rỗng được 0 điểm, không đưa vào model
+        out = {name: [0.0] * len(preds) for name in ("precision", "recall", "f1")}
+        keep = [i for i, p in enumerate(preds) if p.strip()]
+        if keep:
+            res = bertscore.compute(predictions=[preds[i] for i in keep], references=[refs[i] for i in keep],
+                                    lang=args.lang, model_type=args.model_type, batch_size=args.batch_size)
+            for name in out:
+                for i, value in zip(keep, res[name]):
+                    out[name][i] = float(value)
+        return out
+
+    # Model BERTScore nạp một lần; mỗi chunk ghi ngay ra file để dừng giữa chừng không mất điểm
+    for start in range(0, len(todo), args.chunk_size):
+        chunk = todo[start:start + args.chunk_size]
+        refs = [r.get("gold_answer", "") for r in chunk]
+        out = compute([r.get("predicted_answer", "") for r in chunk], refs)
+        with_llm = [i for i, r in enumerate(chunk) if r.get("llm_answer")]
+        llm_out = compute([chunk[i]["llm_answer"] for i in with_llm], [refs[i] for i in with_llm])
+        llm_f1 = dict(zip(with_llm, llm_out["f1"]))
+        scored = []
+        for i, r in enumerate(chunk):
+            row = {"id": r["id"], **{name: round(out[name][i], 6) for name in out}}
+            if i in llm_f1:
+                row["llm_f1"] = round(llm_f1[i], 6)
+            scored.append(row)
+        checkpoint.extend(scored)
+        print(f"[score] {min(start + args.chunk_size, len(todo))}/{len(todo)}")
+
+    print_report(answers_report(latest_rows(args.results), checkpoint.rows))
+
+
+def cmd_report(args):
+    report = {}
+    if args.results:
+        report.update(answers_report(latest_rows(args.results), latest_rows(scores_path(args.results, args.scores))))
+    if args.retrieval:
+        report.update(retrieval_report(latest_rows(args.retrieval), args.k))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def print_report(report):
+    for section, values in report.items():
+        print(f"\n=== {section} ===")
+        for name, value in values.items():
+            print(f"{name:<22}{value:.4f}" if isinstance(value, float) else f"{name:<22}{value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đánh giá retrieval và câu trả lời của chatbot")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_testset = sub.add_parser("testset")
+    p_testset.add_argument("--data", required=True, help="toan_bo_du_lieu_final.json")
+    p_testset.add_argument("--out", required=True)
+    p_testset.add_argument("--size", type=int, default=1000, help="số câu lấy ngẫu nhiên (0 = tất cả)")
+    p_testset.add_argument("--seed", type=int, default=42)
+    p_testset.set_defaults(func=cmd_testset)
+
+    def add_app_args(p):
+        p.add_argument("--bench-data", default=None, help="thư mục corpus của benchmark_pipeline.py (LLM giả)")
+        p.add_argument("--workers", type=int, default=8)
+
+    p_retrieval = sub.add_parser("retrieval")
+    p_retrieval.add_argument("--testset", required=True)
+    p_retrieval.add_argument("--out", required=True)
+    p_retrieval.add_argument("--k", type=int, nargs="+", default=[1, 3, 5, 10])
+    add_app_args(p_retrieval)
+    p_retrieval.set_defaults(func=cmd_retrieval)
+
+    p_answers = sub.add_parser("answers")
+    p_answers.add_argument("--testset", required=True)
+    p_answers.add_argument("--out", required=True)
+    p_answers.add_argument("--backend", choices=["http", "inprocess"], default="http")
+    p_answers.add_argument("--api-url", default="http://localhost:7860/chat")
+    p_answers.add_argument("--timeout", type=float, default=60.0)
+    p_answers.add_argument("--retries", type=int, default=3)
+    p_answers.add_argument("--fast-path", action="store_true",
+                           help="bật fast path (mặc định tắt: mọi câu đều qua LLM, vì testset "
+                                "sinh từ QUESTION_TEMPLATES đúng là các câu fast path trả lời)")
+    p_answers.add_argument("--compare-llm", action="store_true",
+                           help="với --fast-path: câu được fast path trả lời thì hỏi lại với LLM để so sánh")
+    add_app_args(p_answers)
+    p_answers.set_defaults(func=cmd_answers)
+
+    p_score = sub.add_parser("score")
+    p_score.add_argument("--results", required=True, help="file JSONL của lệnh answers")
+    p_score.add_argument("--scores", default=None, help="mặc định <results>.scores.jsonl")
+    p_score.add_argument("--lang", default="vi")
+    p_score.add_argument("--model-type", default=None, help="model BERTScore (mặc định theo --lang)")
+    p_score.add_argument("--batch-size", type=int, default=64)
+    p_score.add_argument("--chunk-size", type=int, default=512, help="số câu mỗi lần ghi điểm ra file")
+    p_score.set_defaults(func=cmd_score)
+
+    p_report = sub.add_parser("report")
+    p_report.add_argument("--results", default=None)
+    p_report.add_argument("--scores", default=None)
+    p_report.add_argument("--retrieval", default=None)
+    p_report.add_argument("--k", type=int, nargs="+", default=[1, 3, 5, 10])
+    p_report.add_argument("--output", default=None, help="ghi báo cáo JSON")
+    p_report.set_defaults(func=cmd_report)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
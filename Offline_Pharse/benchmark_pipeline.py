@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+# ======================================================
+# BENCHMARK PIPELINE /chat KHÔNG CẦN GEMINI VÀ ARTIFACT TRÊN HF HUB
+#
+#   # 1) Sinh corpus giả lập đúng định dạng artifact (toan_bo_du_lieu_final.json,
+#   #    metas.pkl.gz, bm25.pkl.gz, index.faiss) vào một thư mục
+#   python benchmark_pipeline.py corpus --out-dir bench_data --procedures 5000
+#
+#   # 2) Chạy app.py trong process với LLM giả (độ trễ cấu hình được), phát lại các
+#   #    phiên nhiều lượt song song và đo throughput + p50/p95/p99 từng bước
+#   python benchmark_pipeline.py run --data-dir bench_data --sessions 500 \
+#       --concurrency 16 --rate 20 --llm-latency-ms 800 --output bench.json
+#
+# Embedding mặc định là "hash" (bag-of-words băm, không cần tải model) để chạy
+# được ở mọi nơi; --embedder model dùng AITeamVN/Vietnamese_Embedding thật (khi đó
+# corpus cũng phải sinh bằng --embedder model để FAISS cùng không gian vector).
+#
+# Các bước đo: embedding, faiss, bm25, retrieval (hybrid + gộp theo thủ tục),
+# context (ContextManager.get_context_for_query), fast_path, prompt, generation,
+# store (lưu cache + lịch sử) và total (toàn bộ request /chat phía client).
+# ======================================================
+
+import argparse
+import gzip
+import json
+import os
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import zlib
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from procedure_fields import FIELD_MAP  # noqa: E402
+from vn_text import index_terms  # noqa: E402
+from offline_common import EMBED_MODEL_NAME  # noqa: E402
+
+STAGES = ["embedding", "faiss", "bm25", "retrieval", "context", "fast_path", "prompt", "generation", "store", "total"]
+
+
+# ======================================================
+# I. CORPUS GIẢ LẬP
+# ======================================================
+
+ACTIONS = ["Đăng ký", "Cấp", "Cấp lại", "Cấp đổi", "Gia hạn", "Điều chỉnh", "Thu hồi", "Xác nhận",
+           "Công nhận", "Thẩm định", "Phê duyệt", "Chấp thuận"]
+OBJECTS = ["khai sinh", "kết hôn", "khai tử", "hộ chiếu phổ thông", "giấy phép lái xe", "giấy phép xây dựng",
+           "giấy chứng nhận quyền sử dụng đất", "hộ kinh doanh", "giấy phép lao động", "chứng chỉ hành nghề",
+           "thẻ bảo hiểm y tế", "giấy phép vận chuyển hàng hóa nguy hiểm", "hồ sơ thuế", "con dấu",
+           "giấy chứng nhận đăng ký doanh nghiệp", "thường trú", "tạm trú", "căn cước công dân"]
+QUALIFIERS = ["", "cho trẻ em", "có yếu tố nước ngoài", "tại cấp xã", "tại cấp huyện", "tại cấp tỉnh",
+              "cho người nước ngoài", "trong khu công nghiệp", "lần đầu", "trực tuyến"]
+AGENCIES = ["Ủy ban nhân dân cấp xã", "Ủy ban nhân dân cấp huyện", "Sở Tư pháp", "Sở Giao thông vận tải",
+            "Cục Quản lý xuất nhập cảnh", "Sở Xây dựng", "Sở Kế hoạch và Đầu tư", "Công an cấp tỉnh",
+            "Sở Lao động - Thương binh và Xã hội", "Chi cục Thuế"]
+DOCUMENTS = ["Tờ khai theo mẫu", "Bản sao giấy khai sinh", "Bản chính giấy chứng sinh", "Ảnh 4x6",
+             "Bản sao căn cước công dân", "Giấy xác nhận tình trạng hôn nhân", "Đơn đề nghị",
+             "Giấy khám sức khỏe", "Văn bản ủy quyền", "Bản sao sổ hộ khẩu", "Giấy tờ chứng minh chỗ ở hợp pháp"]
+STEPS = ["Nộp hồ sơ tại bộ phận một cửa", "Cán bộ kiểm tra tính hợp lệ của hồ sơ", "Nộp lệ phí theo quy định",
+         "Cơ quan có thẩm quyền thẩm định", "Trả kết quả cho người nộp", "Bổ sung hồ sơ nếu chưa đầy đủ"]
+CHANNELS = ["Trực tiếp", "Trực tuyến", "Dịch vụ bưu chính"]
+
+FOLLOW_UPS = ["Cần những giấy tờ gì?", "Cơ quan nào thực hiện thủ tục này?", "Vậy trình tự thế nào?",
+              "Lệ phí bao nhiêu và mất bao lâu?", "Cần đáp ứng điều kiện gì?", "Nguồn ở đâu?"]
+
+
+def synthetic_procedure(i, rng):
+    name = " ".join(x for x in (rng.choice(ACTIONS), rng.choice(OBJECTS), rng.choice(QUALIFIERS)) if x)
+    channels = rng.sample(CHANNELS, rng.randint(1, len(CHANNELS)))
+    return {
+        "ten_thu_tuc": f"{name} ({i})",
+        "cach_thuc_thuc_hien": "\n".join(
+            f"{c}: thời hạn giải quyết {rng.randint(1, 30)} ngày làm việc; lệ phí {rng.choice([0, 20000, 50000, 100000])} đồng"
+            for c in channels),
+        "thanh_phan_ho_so": "\n".join(f"- {d}" for d in rng.sample(DOCUMENTS, rng.randint(2, 6))),
+        "trinh_tu_thuc_hien": "\n".join(f"Bước {k}: {s}" for k, s in enumerate(rng.sample(STEPS, rng.randint(3, 5)), 1)),
+        "co_quan_thuc_hien": rng.choice(AGENCIES),
+        "yeu_cau_dieu_kien": rng.choice(["Không", "Người nộp phải đủ 18 tuổi", "Hồ sơ nộp trong thời hạn 60 ngày"]),
+        "thu_tuc_lien_quan": "",
+        "nguon": f"https://dichvucong.gov.vn/synthetic/{i}",
+    }
+
+
+def chunk_procedures(procedures):
+    """Một chunk cho mỗi trường có nội dung (cùng khóa với metas.pkl.gz thật)"""
+    metas = []
+    for proc in procedures:
+        for field, label in FIELD_MAP.items():
+            value = proc.get(field)
+            if not value or field == "nguon":
+                continue
+            raw = f"{proc['ten_thu_tuc']}\n{label}: {value}"
+            metas.append({
+                "id": f"{proc['nguon']}#{field}",
+                "parent_id": proc["nguon"],
+                "ten_thu_tuc": proc["ten_thu_tuc"],
+                "field": field,
+                "text": raw,
+                "raw": raw,
+                "nguon": proc["nguon"],
+            })
+    return metas
+
+
+class HashEmbedder:
+    """Embedding giả: băm các term của vn_text vào ``dim`` chiều rồi normalize.
+
+    Cùng interface với SentenceTransformer mà app.py dùng (encode,
+    get_sentence_embedding_dimension). ``encode_ms`` giả lập thời gian encode mỗi batch.
+    """
+
+    def __init__(self, dim=256, encode_ms=0.0):
+        self.dim = dim
+        self.encode_ms = encode_ms
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def _embed(self, text):
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for term in index_terms(text):
+            h = zlib.crc32(term.encode("utf-8"))
+            vec[h % self.dim] += 1.0 if (h >> 16) & 1 else -1.0
+        return vec
+
+    def encode(self, texts, batch_size=None, convert_to_numpy=True, normalize_embeddings=True, **kwargs):
+        if self.encode_ms:
+            time.sleep(self.encode_ms / 1000.0)
+        embs = np.stack([self._embed(t) for t in texts]) if len(texts) else np.zeros((0, self.dim), np.float32)
+        if normalize_embeddings:
+            norms = np.linalg.norm(embs, axis=1, keepdims=True)
+            embs = embs / np.maximum(norms, 1e-12)
+        return embs.astype(np.float32)
+
+
+def make_embedder(name, encode_ms=0.0):
+    if name == "hash":
+        return HashEmbedder(encode_ms=encode_ms)
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBED_MODEL_NAME)
+
+
+def cmd_corpus(args):
+    import faiss
+
+    rng = random.Random(args.seed)
+    procedures = [synthetic_procedure(i, rng) for i in range(args.procedures)]
+    metas = chunk_procedures(procedures)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    with open(os.path.join(args.out_dir, "toan_bo_du_lieu_final.json"), "w", encoding="utf-8") as f:
+        json.dump(procedures, f, ensure_ascii=False)
+    with gzip.open(os.path.join(args.out_dir, "metas.pkl.gz"), "wb") as f:
+        pickle.dump(metas, f)
+    # app.py chỉ lấy k1 / b / epsilon từ BM25 pickle, postings build lại bằng vn_text
+    with gzip.open(os.path.join(args.out_dir, "bm25.pkl.gz"), "wb") as f:
+        pickle.dump(types.SimpleNamespace(k1=1.5, b=0.75, epsilon=0.25), f)
+
+    embedder = make_embedder(args.embedder)
+    vectors = embedder.encode([m["text"] for m in metas], batch_size=64, convert_to_numpy=True,
+                              normalize_embeddings=True).astype("float32")
+    index = faiss.IndexFlatIP(vectors.shape[1])
+    index.add(vectors)
+    faiss.write_index(index, os.path.join(args.out_dir, "index.faiss"))
+
+    with open(os.path.join(args.out_dir, "bench_manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({"procedures": len(procedures), "chunks": len(metas), "embedder": args.embedder,
+                   "dim": int(vectors.shape[1]), "seed": args.seed}, f, indent=2)
+    print(f"Đã sinh {len(procedures)} thủ tục, {len(metas)} chunk vào {args.out_dir}")
+
+
+# ======================================================
+# II. ĐO THỜI GIAN TỪNG BƯỚC
+# ======================================================
+
+class StageTimer:
+    """Thu thập thời gian (ms) theo bước, an toàn giữa các thread"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, stage, ms):
+        with self._lock:
+            self.samples[stage].append(ms)
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, (time.perf_counter() - start) * 1000)
+        return timed
+
+    def summary(self):
+        out = {}
+        for stage in STAGES + sorted(set(self.samples) - set(STAGES)):
+            values = self.samples.get(stage)
+            if not values:
+                continue
+            arr = np.asarray(values)
+            out[stage] = {
+                "count": len(arr),
+                "mean_ms": round(float(arr.mean()), 2),
+                "p50_ms": round(float(np.percentile(arr, 50)), 2),
+                "p95_ms": round(float(np.percentile(arr, 95)), 2),
+                "p99_ms": round(float(np.percentile(arr, 99)), 2),
+            }
+        return out
+
+
+class TimedIndex:
+    """Bọc FAISS index để đo riêng thời gian search"""
+
+    def __init__(self, index, timer):
+        self._index = index
+        self._timer = timer
+
+    def search(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._index.search(*args, **kwargs)
+        finally:
+            self._timer.record("faiss", (time.perf_counter() - start) * 1000)
+
+    def __getattr__(self, name):
+        return getattr(self._index, name)
+
+
+class StubGenerativeModel:
+    """Thay Gemini: trả lời sau ``latency_ms`` (± jitter), hỗ trợ stream và async"""
+
+    def __init__(self, latency_ms, jitter_ms, timer, chunks=8):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.timer = timer
+        self.chunks = chunks
+
+    def _delay(self):
+        return max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) / 1000.0
+
+    @staticmethod
+    def _answer(prompt):
+        return f"Câu trả lời mô phỏng ({len(prompt)} ký tự prompt)."
+
+    def generate_content(self, prompt, stream=False):
+        start = time.perf_counter()
+        delay = self._delay()
+        text = self._answer(prompt)
+        if not stream:
+            time.sleep(delay)
+            self.timer.record("generation", (time.perf_counter() - start) * 1000)
+            return types.SimpleNamespace(text=text)
+
+        def chunks():
+            step = max(1, len(text) // self.chunks)
+            for i in range(0, len(text), step):
+                time.sleep(delay / self.chunks)
+                yield types.SimpleNamespace(text=text[i:i + step])
+            self.timer.record("generation", (time.perf_counter() - start) * 1000)
+        return chunks()
+
+    async def generate_content_async(self, prompt, stream=False):
+        import asyncio
+        start = time.perf_counter()
+        await asyncio.sleep(self._delay())
+        self.timer.record("generation", (time.perf_counter() - start) * 1000)
+        text = self._answer(prompt)
+        if not stream:
+            return types.SimpleNamespace(text=text)
+
+        async def chunks():
+            yield types.SimpleNamespace(text=text)
+        return chunks()
+
+
+def load_app(args, timer):
+    """Nạp app.py với dữ liệu trong --data-dir thay cho load_resources() (HF Hub)"""
+    work_dir = tempfile.mkdtemp(prefix="egov-bench-")
+    os.environ.setdefault("COMPACT_STORE_DIR", os.path.join(work_dir, "store"))
+    os.environ.setdefault("ANALYTICS_DB", os.path.join(work_dir, "analytics.db"))
+    os.environ.setdefault("SESSION_BACKEND", "memory")
+
+    import app as chatbot
+    from analytics_store import AnalyticsStore
+    from llm_pool import GenerationPool, LLMKey
+
+    # Không ghi lượt xem giả lập vào user_data thật (load_resources không được gọi ở đây)
+    chatbot.analytics = AnalyticsStore(os.path.join(work_dir, "analytics.db"))
+
+    with open(os.path.join(args.data_dir, "bench_manifest.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest["embedder"] != args.embedder:
+        raise SystemExit(f"Corpus được sinh với --embedder {manifest['embedder']}, không phải {args.embedder}")
+
+    path = lambda name: os.path.join(args.data_dir, name)  # noqa: E731
+    (chatbot.metadatas, chatbot.bm25, chatbot.bm25_sparse, chatbot.procedure_dict, chatbot.parent_keys,
+     chatbot.chunk_parent_codes, chatbot.parent_id_to_chunks) = chatbot.load_corpus(
+        path("metas.pkl.gz"), path("bm25.pkl.gz"), path("toan_bo_du_lieu_final.json"))
+    chatbot.faiss_index = TimedIndex(chatbot.load_faiss(path("index.faiss")), timer)
+
+    embedder = make_embedder(args.embedder, args.encode_ms)
+    chatbot.embedding_model = embedder
+    chatbot.embedding_backend = args.embedder
+    chatbot.embedding_batcher = chatbot.EmbeddingBatcher(
+        embedder, chatbot.config.EMB_BATCH_MAX_SIZE, chatbot.config.EMB_BATCH_MAX_WAIT_MS)
+
+    # Ma trận embedding thủ tục (như artifact procedure_embs.npy)
+    ids = list(chatbot.procedure_dict)
+    chatbot.procedure_embeddings = embedder.encode(
+        [chatbot.get_full_procedure_text(pid) for pid in ids], batch_size=64,
+        convert_to_numpy=True, normalize_embeddings=True).astype("float32")
+    chatbot.procedure_emb_row = {pid: row for row, pid in enumerate(ids)}
+    (chatbot.procedure_public_ids, chatbot.procedure_by_public_id,
+     chatbot.procedure_names) = chatbot.build_procedure_index(chatbot.procedure_dict)
+
+    model = StubGenerativeModel(args.llm_latency_ms, args.llm_jitter_ms, timer)
+    chatbot.generation_pool = GenerationPool([
+        LLMKey("stub", model, rpm=None, burst=None, daily_quota=None,
+               breaker_threshold=10 ** 9, breaker_cooldown=1)
+    ])
+
+    # Bọc các bước của pipeline (hàm được gọi qua biến global của module)
+    chatbot.encode_query = timer.wrap("embedding", chatbot.encode_query)
+    chatbot._lexical_candidates = timer.wrap("bm25", chatbot._lexical_candidates)
+    chatbot.retrieve_procedures = timer.wrap("retrieval", chatbot.retrieve_procedures)
+    chatbot.ContextManager.get_context_for_query = staticmethod(
+        timer.wrap("context", chatbot.ContextManager.get_context_for_query))
+    chatbot.fast_path_answer = timer.wrap("fast_path", chatbot.fast_path_answer)
+    chatbot.build_prompt = timer.wrap("prompt", chatbot.build_prompt)
+    chatbot.complete_chat_turn = timer.wrap("store", chatbot.complete_chat_turn)
+
+    chatbot.startup.ready = True
+    return chatbot, work_dir
+
+
+# ======================================================
+# III. PHÁT LẠI PHIÊN NHIỀU LƯỢT
+# ======================================================
+
+def make_sessions(procedures, args):
+    from vn_text import fold
+
+    rng = random.Random(args.seed)
+    # Phân phối lệch (Zipf) giống lưu lượng thật: vài thủ tục được hỏi rất nhiều
+    weights = 1.0 / np.arange(1, len(procedures) + 1) ** args.zipf
+    picks = rng.choices(procedures, weights=weights.tolist(), k=args.sessions)
+    sessions = []
+    for i, proc in enumerate(picks):
+        name = proc["ten_thu_tuc"].rsplit(" (", 1)[0].lower()
+        turns = [rng.choice([f"Thủ tục {name} cần những giấy tờ gì?", f"Làm {name} như thế nào?",
+                             f"Tôi muốn {name} thì làm sao?"])]
+        turns += rng.sample(FOLLOW_UPS, rng.randint(0, min(args.max_followups, len(FOLLOW_UPS))))
+        # Một phần người dùng gõ không dấu (điện thoại)
+        if rng.random() < args.no_accent_ratio:
+            turns = [fold(t) for t in turns]
+        sessions.append({"session_id": f"bench-{i}", "turns": turns})
+    return sessions
+
+
+def run_session(chatbot, session, args, timer, sources, errors):
+    client = chatbot.app.test_client()
+    for question in session["turns"]:
+        payload = {"question": question, "session_id": session["session_id"]}
+        headers = {}
+        if args.stream:
+            payload["stream"] = "sse"
+            headers["Accept"] = "text/event-stream"
+        start = time.perf_counter()
+        response = client.post("/chat", json=payload, headers=headers)
+        body = response.get_data()  # stream: đọc hết mới tính xong
+        timer.record("total", (time.perf_counter() - start) * 1000)
+        if response.status_code != 200:
+            errors[response.status_code] += 1
+        elif not args.stream:
+            sources[response.get_json().get("answer_source", "?")] += 1
+        elif b"event: error" in body:
+            errors["stream_error"] += 1
+        if args.think_time_ms:
+            time.sleep(args.think_time_ms / 1000.0)
+
+
+def cmd_run(args):
+    timer = StageTimer()
+    chatbot, work_dir = load_app(args, timer)
+    try:
+        procedures = list(chatbot.procedure_dict.values())
+        sessions = make_sessions(procedures, args)
+        sources, errors = Counter(), Counter()
+
+        print(f"Phát lại {len(sessions)} phiên ({sum(len(s['turns']) for s in sessions)} lượt), "
+              f"concurrency={args.concurrency}, rate={args.rate or 'tối đa'} phiên/s")
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = []
+            for i, session in enumerate(sessions):
+                if args.rate:
+                    # Open loop: phiên thứ i bắt đầu ở giây i / rate
+                    delay = start + i / args.rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                futures.append(pool.submit(run_session, chatbot, session, args, timer, sources, errors))
+            for future in futures:
+                future.result()
+        duration = time.perf_counter() - start
+
+        requests_done = len(timer.samples["total"])
+        report = {
+            "config": {k: v for k, v in vars(args).items() if k != "func"},
+            "requests": requests_done,
+            "sessions": len(sessions),
+            "duration_s": round(duration, 2),
+            "throughput_rps": round(requests_done / duration, 2) if duration else None,
+            "answer_sources": dict(sources),
+            "errors": dict(errors),
+            "stages": timer.summary(),
+            "query_embedding_cache": chatbot.query_embedding_cache.stats(),
+            "semantic_cache": chatbot.semantic_answer_cache.stats(),
+        }
+    finally:
+        chatbot.analytics.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"\n{requests_done} request trong {report['duration_s']}s -> {report['throughput_rps']} req/s")
+    print(f"answer_source: {report['answer_sources']}  lỗi: {report['errors']}")
+    print(f"{'stage':<12}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}  (ms)")
+    for stage, row in report["stages"].items():
+        print(f"{stage:<12}{row['count']:>8}{row['mean_ms']:>10}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /chat với corpus giả lập và LLM giả")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_corpus = sub.add_parser("corpus")
+    p_corpus.add_argument("--out-dir", required=True)
+    p_corpus.add_argument("--procedures", type=int, default=2000)
+    p_corpus.add_argument("--embedder", choices=["hash", "model"], default="hash")
+    p_corpus.add_argument("--seed", type=int, default=42)
+
+    p_run = sub.add_parser("run")
+    p_run.add_argument("--data-dir", required=True, help="thư mục tạo bởi lệnh corpus")
+    p_run.add_argument("--embedder", choices=["hash", "model"], default="hash")
+    p_run.add_argument("--encode-ms", type=float, default=0.0, help="độ trễ giả lập mỗi batch encode (hash)")
+    p_run.add_argument("--sessions", type=int, default=200)
+    p_run.add_argument("--max-followups", type=int, default=3)
+    p_run.add_argument("--concurrency", type=int, default=8)
+    p_run.add_argument("--rate", type=float, default=0.0, help="số phiên bắt đầu mỗi giây (0 = hết tốc lực)")
+    p_run.add_argument("--think-time-ms", type=float, default=0.0, help="nghỉ giữa các lượt trong một phiên")
+    p_run.add_argument("--llm-latency-ms", type=float, default=800.0)
+    p_run.add_argument("--llm-jitter-ms", type=float, default=200.0)
+    p_run.add_argument("--stream", action="store_true", help="gọi /chat dạng SSE")
+    p_run.add_argument("--zipf", type=float, default=1.1, help="độ lệch phân phối thủ tục được hỏi")
+    p_run.add_argument("--no-accent-ratio", type=float, default=0.2)
+    p_run.add_argument("--seed", type=int, default=7)
+    p_run.add_argument("--output", default=None, help="ghi báo cáo JSON")
+
+    args = parser.parse_args()
+    if args.command == "corpus":
+        cmd_corpus(args)
+    else:
+        cmd_run(args)
+
+
+if __name__ == "__main__":
+    main()
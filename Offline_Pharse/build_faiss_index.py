@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# ======================================================
+# BUILD CÁC BIẾN THỂ FAISS INDEX (flat / hnsw / ivfpq) VÀ BENCHMARK RECALL
+#
+#   # Lấy lại vector chunk từ index.faiss (flat) hiện tại, không cần encode lại
+#   python build_faiss_index.py build --source index.faiss --type hnsw --out index_hnsw.faiss
+#   python build_faiss_index.py build --source index.faiss --type ivfpq --nlist 1024 --pq-m 64 --out index_ivfpq.faiss
+#
+#   # Latency + recall@k so với tìm kiếm chính xác (flat) trên testset của Model_Evaluation.py
+#   python build_faiss_index.py benchmark --exact index.faiss \
+#       --candidate index_hnsw.faiss --candidate index_ivfpq.faiss \
+#       --testset testset.jsonl --k 10 --mmap
+#
+# --mmap đọc index bằng IO_FLAG_MMAP như app.py (FAISS_MMAP=1). FAISS chỉ mmap được
+# inverted list của index IVF (ivfpq); flat và hnsw vẫn bị đọc hết vào RAM, nên cột
+# "mmap" trong báo cáo chỉ là true với index IVF.
+#
+# Mỗi index được ghi kèm file <tên>.json chứa tham số build và "search_params";
+# app.py đọc file này để đặt nprobe / efSearch khi load (Config.FAISS_INDEX_FILE).
+# ======================================================
+
+import argparse
+import gzip
+import json
+import os
+import pickle
+import time
+
+import faiss
+import numpy as np
+
+from offline_common import EMBED_MODEL_NAME, load_questions
+
+
+def params_path(index_path):
+    return os.path.splitext(index_path)[0] + ".json"
+
+
+def read_index(path, mmap=False):
+    """Đọc index; với mmap trả thêm cờ index có thật sự được mmap không (chỉ IVF)"""
+    if not mmap:
+        return faiss.read_index(path), False
+    index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    try:
+        faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return index, False
+    return index, True
+
+
+def load_vectors(source, metas=None):
+    """Lấy toàn bộ vector chunk: từ .npy hoặc reconstruct từ một FAISS index"""
+    if source.endswith(".npy"):
+        vectors = np.load(source).astype("float32")
+    else:
+        index = faiss.read_index(source)
+        vectors = index.reconstruct_n(0, index.ntotal)
+    if metas:
+        with gzip.open(metas, "rb") as f:
+            corpus = pickle.load(f)
+        corpus = corpus.get("corpus", corpus) if isinstance(corpus, dict) else corpus
+        if len(corpus) != len(vectors):
+            raise ValueError(f"metas có {len(corpus)} chunk nhưng có {len(vectors)} vector")
+    return np.ascontiguousarray(vectors, dtype="float32")
+
+
+# ======================================================
+# I. BUILD
+# ======================================================
+
+def build_index(vectors, index_type, args):
+    dim = vectors.shape[1]
+    params = {"type": index_type, "dim": dim, "metric": "inner_product"}
+
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(dim)
+        params["search_params"] = ""
+
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, args.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = args.ef_construction
+        params.update(M=args.hnsw_m, efConstruction=args.ef_construction,
+                      search_params=f"efSearch={args.ef_search}")
+
+    elif index_type == "ivfpq":
+        nlist = min(args.nlist, max(1, len(vectors) // 39))  # FAISS cần ~39 điểm train / centroid
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, args.pq_m, args.pq_nbits, faiss.METRIC_INNER_PRODUCT)
+        rng = np.random.default_rng(0)
+        train = vectors[rng.choice(len(vectors), min(len(vectors), args.train_size), replace=False)]
+        index.train(train)
+        params.update(nlist=nlist, m=args.pq_m, nbits=args.pq_nbits, train_size=len(train),
+                      search_params=f"nprobe={min(args.nprobe, nlist)}")
+
+    else:
+        raise ValueError(f"Loại index không hỗ trợ: {index_type}")
+
+    index.add(vectors)
+    return index, params
+
+
+def cmd_build(args):
+    vectors = load_vectors(args.source, args.metas)
+    print(f"Vectors: {vectors.shape}")
+
+    start = time.perf_counter()
+    index, params = build_index(vectors, args.type, args)
+    params.update(
+        ntotal=int(index.ntotal),
+        source=os.path.basename(args.source),
+        build_seconds=round(time.perf_counter() - start, 2),
+    )
+
+    faiss.write_index(index, args.out)
+    params["file_bytes"] = os.path.getsize(args.out)
+    with open(params_path(args.out), "w", encoding="utf-8") as f:
+        json.dump(params, f, ensure_ascii=False, indent=2)
+    print(f"✅ {args.out}: {json.dumps(params, ensure_ascii=False)}")
+
+
+# ======================================================
+# II. BENCHMARK: LATENCY + RECALL@K SO VỚI EXACT SEARCH
+# ======================================================
+
+def load_queries(args, exact):
+    if args.testset:
+        from sentence_transformers import SentenceTransformer
+
+        questions = load_questions(args.testset, args.limit)
+        model = SentenceTransformer(args.model, device="cpu")
+        return model.encode(questions, batch_size=32, convert_to_numpy=True,
+                            normalize_embeddings=True).astype("float32")
+
+    # Không có testset: lấy ngẫu nhiên vector chunk làm query
+    rng = np.random.default_rng(0)
+    ids = rng.choice(exact.ntotal, min(exact.ntotal, args.limit or 1000), replace=False)
+    return np.vstack([exact.reconstruct(int(i)) for i in ids]).astype("float32")
+
+
+def search_latencies(index, queries, k):
+    """Tìm từng query một (giống request path) để đo latency"""
+    results, latencies = [], []
+    for q in queries:
+        start = time.perf_counter()
+        _, I = index.search(q.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(I[0])
+    return np.vstack(results), np.array(latencies)
+
+
+def report_row(name, search_params, top, exact_top, latencies, k, file_bytes, mmapped):
+    recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(top.tolist(), exact_top.tolist())])
+    return {
+        "index": name,
+        "search_params": search_params,
+        f"recall@{k}": round(float(recall), 4),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "mb": round(file_bytes / 1e6, 1),
+        "mmap": mmapped,
+    }
+
+
+def cmd_benchmark(args):
+    exact, exact_mmapped = read_index(args.exact, args.mmap)
+    queries = load_queries(args, exact)
+    print(f"Queries: {queries.shape}")
+
+    exact_top, exact_lat = search_latencies(exact, queries, args.k)
+    rows = [report_row(os.path.basename(args.exact), "", exact_top, exact_top, exact_lat,
+                       args.k, os.path.getsize(args.exact), exact_mmapped)]
+
+    ps = faiss.ParameterSpace()
+    for path in args.candidate or []:
+        index, mmapped = read_index(path, args.mmap)
+        sweeps = list(args.search_params or [])
+        if not sweeps and os.path.exists(params_path(path)):
+            with open(params_path(path), "r", encoding="utf-8") as f:
+                sweeps = [json.load(f).get("search_params", "")]
+        for search_params in sweeps or [""]:
+            if search_params:
+                ps.set_index_parameters(index, search_params)
+            top, lat = search_latencies(index, queries, args.k)
+            rows.append(report_row(os.path.basename(path), search_params, top, exact_top, lat,
+                                   args.k, os.path.getsize(path), mmapped))
+
+    for row in rows:
+        print(json.dumps(row, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build & benchmark FAISS index variants")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_build = sub.add_parser("build")
+    p_build.add_argument("--source", required=True, help="index.faiss (flat) hoặc file .npy chứa vector chunk")
+    p_build.add_argument("--metas", default=None, help="metas.pkl.gz để kiểm tra số chunk khớp")
+    p_build.add_argument("--type", choices=["flat", "hnsw", "ivfpq"], required=True)
+    p_build.add_argument("--out", required=True)
+    p_build.add_argument("--hnsw-m", type=int, default=32)
+    p_build.add_argument("--ef-construction", type=int, default=200)
+    p_build.add_argument("--ef-search", type=int, default=64)
+    p_build.add_argument("--nlist", type=int, default=1024)
+    p_build.add_argument("--nprobe", type=int, default=16)
+    p_build.add_argument("--pq-m", type=int, default=64, help="số sub-quantizer (dim phải chia hết)")
+    p_build.add_argument("--pq-nbits", type=int, default=8)
+    p_build.add_argument("--train-size", type=int, default=100000)
+
+    p_bench = sub.add_parser("benchmark")
+    p_bench.add_argument("--exact", required=True, help="index flat làm chuẩn")
+    p_bench.add_argument("--candidate", action="append", help="index cần đo (lặp lại được)")
+    p_bench.add_argument("--search-params", action="append",
+                         help='vd "nprobe=8" hoặc "efSearch=128" (lặp lại để quét)')
+    p_bench.add_argument("--testset", default=None, help="testset.jsonl của Model_Evaluation.py testset (JSON cũ vẫn đọc được)")
+    p_bench.add_argument("--model", default=EMBED_MODEL_NAME)
+    p_bench.add_argument("--limit", type=int, default=None)
+    p_bench.add_argument("--k", type=int, default=10)
+    p_bench.add_argument("--mmap", action="store_true",
+                         help="đọc index bằng IO_FLAG_MMAP như app.py (chỉ có tác dụng với IVF)")
+    p_bench.add_argument("--output", default=None, help="ghi kết quả ra JSON")
+
+    args = parser.parse_args()
+    if args.command == "build":
+        cmd_build(args)
+    else:
+        cmd_benchmark(args)
+
+
+if __name__ == "__main__":
+    main()
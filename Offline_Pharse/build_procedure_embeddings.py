@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# ======================================================
+# BUILD MA TRẬN EMBEDDING CHO TỪNG THỦ TỤC (theo parent_id)
+# Kết quả upload lên HF dataset cùng index.faiss / metas.pkl.gz:
+#   - procedure_embs.npy  : float32 [số thủ tục, dim], đã normalize
+#   - procedure_ids.json  : danh sách parent_id (= nguon) theo thứ tự hàng
+# app.py memory-map file .npy và tra embedding context theo parent_id,
+# không cần encode toàn văn thủ tục trên request path nữa.
+# ======================================================
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Cùng hàm ghép text với get_full_procedure_text trong app.py
+from procedure_fields import procedure_text  # noqa: E402
+from offline_common import EMBED_MODEL_NAME  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build procedure embedding matrix keyed by parent_id")
+    parser.add_argument("--raw", default="toan_bo_du_lieu_final.json", help="File JSON toàn bộ thủ tục")
+    parser.add_argument("--out-dir", default=".", help="Thư mục ghi procedure_embs.npy / procedure_ids.json")
+    parser.add_argument("--model", default=EMBED_MODEL_NAME)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args()
+
+    with open(args.raw, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    # Cùng khóa với procedure_dict trong app.py: bản ghi sau ghi đè bản ghi trước
+    procedures = {}
+    for obj in data:
+        if obj.get("nguon"):
+            procedures[obj["nguon"]] = obj
+    ids = list(procedures)
+    texts = [procedure_text(procedures[pid]) for pid in ids]
+    print(f"Số thủ tục: {len(ids)}")
+
+    model = SentenceTransformer(args.model, device=args.device)
+    emb = model.encode(
+        texts,
+        batch_size=args.batch_size,
+        show_progress_bar=True,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+    ).astype("float32")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    emb_path = os.path.join(args.out_dir, "procedure_embs.npy")
+    ids_path = os.path.join(args.out_dir, "procedure_ids.json")
+    np.save(emb_path, np.ascontiguousarray(emb))
+    with open(ids_path, "w", encoding="utf-8") as f:
+        json.dump(ids, f, ensure_ascii=False)
+
+    print(f"✅ Đã lưu {emb.shape} -> {emb_path}, {ids_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# ======================================================
+# EXPORT EMBEDDING MODEL SANG ONNX (+ INT8) VÀ KIỂM TRA PARITY
+#
+#   python export_onnx_embedding.py export --out-dir /tmp/onnx_emb
+#   python export_onnx_embedding.py parity --onnx-dir /tmp/onnx_emb \
+#       --faiss index.faiss --testset testset.jsonl --k 10
+#
+# Chạy app với: EMB_BACKEND=onnx ONNX_MODEL_DIR=/tmp/onnx_emb python app.py
+# ======================================================
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from onnx_embedding import FP32_FILE, QUANT_FILE, POOLING_FILE, OnnxEmbeddingModel  # noqa: E402
+from offline_common import EMBED_MODEL_NAME, load_questions  # noqa: E402
+
+
+# ======================================================
+# I. EXPORT
+# ======================================================
+
+def export(model_name, out_dir, opset=14, quantize=True):
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    os.makedirs(out_dir, exist_ok=True)
+    st = SentenceTransformer(model_name, device="cpu")
+    transformer = st[0].auto_model.eval()
+    pooling_module = st[1]
+    pooling = "mean" if getattr(pooling_module, "pooling_mode_mean_tokens", False) else "cls"
+
+    class HiddenStates(torch.nn.Module):
+        """Chỉ trả last_hidden_state để graph ONNX đơn giản"""
+
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+    dummy = st.tokenizer(["thủ tục đăng ký khai sinh"], return_tensors="pt")
+    fp32_path = os.path.join(out_dir, FP32_FILE)
+    print(f"... Export {model_name} -> {fp32_path} (pooling={pooling})")
+    with torch.no_grad():
+        torch.onnx.export(
+            HiddenStates(transformer),
+            (dummy["input_ids"], dummy["attention_mask"]),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "last_hidden_state": {0: "batch", 1: "sequence"},
+            },
+            opset_version=opset,
+        )
+
+    st.tokenizer.save_pretrained(out_dir)
+    with open(os.path.join(out_dir, POOLING_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "model": model_name,
+            "pooling": pooling,
+            "dim": st.get_sentence_embedding_dimension(),
+            "max_seq_length": st.max_seq_length,
+        }, f, ensure_ascii=False, indent=2)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quant_path = os.path.join(out_dir, QUANT_FILE)
+        print(f"... Dynamic int8 quantization -> {quant_path}")
+        quantize_dynamic(fp32_path, quant_path, weight_type=QuantType.QInt8, use_external_data_format=True)
+
+    print(f"✅ Export xong: {out_dir}")
+
+
+# ======================================================
+# II. PARITY: RECALL@K SO VỚI BACKEND FP32
+# ======================================================
+
+def timed_encode(model, questions, batch_size):
+    start = time.perf_counter()
+    embs = model.encode(questions, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+    return np.asarray(embs, dtype=np.float32), time.perf_counter() - start
+
+
+def parity(model_name, onnx_dir, faiss_path, testset, k=10, limit=None, quantized=True, num_threads=0, batch_size=1):
+    import faiss
+    from sentence_transformers import SentenceTransformer
+
+    questions = load_questions(testset, limit)
+    print(f"Số câu hỏi: {len(questions)}")
+
+    reference = SentenceTransformer(model_name, device="cpu")
+    candidate = OnnxEmbeddingModel(onnx_dir, quantized=quantized, num_threads=num_threads)
+
+    ref_emb, ref_time = timed_encode(reference, questions, batch_size)
+    onnx_emb, onnx_time = timed_encode(candidate, questions, batch_size)
+
+    index = faiss.read_index(faiss_path)
+    _, ref_top = index.search(ref_emb, k)
+    _, onnx_top = index.search(onnx_emb, k)
+
+    recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(ref_top.tolist(), onnx_top.tolist())])
+    top1 = np.mean(ref_top[:, 0] == onnx_top[:, 0])
+    cosine = np.mean(np.sum(ref_emb * onnx_emb, axis=1))
+
+    report = {
+        "backend": "onnx-int8" if quantized else "onnx-fp32",
+        "questions": len(questions),
+        "k": k,
+        f"recall@{k}": round(float(recall), 4),
+        "top1_agreement": round(float(top1), 4),
+        "mean_cosine": round(float(cosine), 4),
+        "fp32_ms_per_query": round(ref_time * 1000 / len(questions), 2),
+        "onnx_ms_per_query": round(onnx_time * 1000 / len(questions), 2),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ONNX export & parity check cho embedding model")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_export = sub.add_parser("export")
+    p_export.add_argument("--model", default=EMBED_MODEL_NAME)
+    p_export.add_argument("--out-dir", required=True)
+    p_export.add_argument("--opset", type=int, default=14)
+    p_export.add_argument("--no-quantize", action="store_true")
+
+    p_parity = sub.add_parser("parity")
+    p_parity.add_argument("--model", default=EMBED_MODEL_NAME)
+    p_parity.add_argument("--onnx-dir", required=True)
+    p_parity.add_argument("--faiss", required=True, help="index.faiss hiện tại")
+    p_parity.add_argument("--testset", required=True, help="testset.jsonl của Model_Evaluation.py testset (JSON cũ vẫn đọc được)")
+    p_parity.add_argument("--k", type=int, default=10)
+    p_parity.add_argument("--limit", type=int, default=None)
+    p_parity.add_argument("--fp32", action="store_true", help="So sánh model.onnx thay vì bản int8")
+    p_parity.add_argument("--threads", type=int, default=0)
+    p_parity.add_argument("--batch-size", type=int, default=1)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export(args.model, args.out_dir, opset=args.opset, quantize=not args.no_quantize)
+    else:
+        parity(args.model, args.onnx_dir, args.faiss, args.testset, k=args.k, limit=args.limit,
+               quantized=not args.fp32, num_threads=args.threads, batch_size=args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
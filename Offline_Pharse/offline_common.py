@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# ======================================================
+# HẰNG SỐ VÀ HÀM DÙNG CHUNG CHO CÁC SCRIPT OFFLINE
+# (Model_Evaluation, export_onnx_embedding, build_faiss_index, build_procedure_embeddings,
+# benchmark_pipeline)
+# Không import thư viện nặng ở đây: mỗi script chỉ kéo theo phần nó cần.
+# ======================================================
+
+import json
+
+# Cùng model với Config.EMB_MODEL trong app.py
+EMBED_MODEL_NAME = "AITeamVN/Vietnamese_Embedding"
+
+
+def read_items(path):
+    """Đọc testset JSON (list) hoặc JSONL; định dạng cũ {"dialogue": [...]} được trải phẳng.
+
+    Câu hỏi không có "id" nhận id theo vị trí trong file, nên file testset phải giữ
+    nguyên giữa các lần chạy tiếp.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            raw = [json.loads(line) for line in f if line.strip()]
+        else:
+            raw = json.load(f)
+
+    items = []
+    for rec in raw:
+        turns = rec.get("dialogue") or [rec]
+        for turn in turns:
+            item = dict(turn)
+            item.setdefault("context", rec.get("context", ""))
+            item["id"] = str(item.get("id", len(items)))
+            items.append(item)
+    return items
+
+
+def load_questions(path, limit=None):
+    """Câu hỏi của testset (JSONL của Model_Evaluation.py testset, hoặc JSON cũ)"""
+    questions = [item["question"] for item in read_items(path) if item.get("question")]
+    return questions[:limit] if limit else questions
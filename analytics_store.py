@@ -0,0 +1,319 @@
+# analytics_store.py - Popular-procedure views and like/dislike counts, written behind
+#
+# Requests only bump in-memory counters. A background thread flushes the pending
+# deltas in one SQLite transaction every ``flush_interval`` seconds (or sooner once
+# ``flush_batch`` events are pending). Deltas are applied with
+# ``total = total + ?``, so several gunicorn / uvicorn workers sharing the same
+# database never overwrite each other's counts.
+#
+# Views are also kept per hour (``procedure_views_hourly``) for ``retention``
+# seconds, so ``top()`` can rank procedures over a sliding window. Ranked lists
+# are cached in memory for ``top_cache_ttl`` seconds; /popular serves from there.
+# Like/dislike totals are re-read by the writer thread after every flush, so
+# ``feedback_summary()`` on the request path never touches SQLite.
+#
+# After each flush the JSON snapshots (user_data/popular_procedures.json, capped
+# at ``export_limit`` entries, and user_data/user_feedback.json) are rewritten
+# through a temp file + os.replace, so readers never see a half-written file.
+import atexit
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+FEEDBACK_TYPES = ("like", "dislike")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS procedure_views (
+    name TEXT PRIMARY KEY,
+    total INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS procedure_views_hourly (
+    bucket INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, name)
+);
+CREATE TABLE IF NOT EXISTS feedback (
+    kind TEXT PRIMARY KEY,
+    total INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def atomic_write_json(path: str, data: Any) -> None:
+    """Write JSON to a temp file in the same directory, then swap it in"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class AnalyticsStore:
+    """In-memory counters flushed in batches to SQLite by a background writer"""
+
+    def __init__(self, db_path: str, popular_json_path: Optional[str] = None,
+                 feedback_json_path: Optional[str] = None, flush_interval: float = 5.0,
+                 flush_batch: int = 200, retention: int = 7 * 86400, top_cache_ttl: float = 30.0,
+                 export_limit: Optional[int] = 100):
+        self.db_path = db_path
+        self.popular_json_path = popular_json_path
+        self.feedback_json_path = feedback_json_path
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.retention = retention
+        self.top_cache_ttl = top_cache_ttl
+        self.export_limit = export_limit
+
+        self._views: Counter = Counter()  # (hour bucket, name) -> pending views
+        self._feedback: Counter = Counter()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._top_cache: Dict[Any, Any] = {}
+        self._feedback_totals: Dict[str, int] = {}  # đã ghi trong DB (mọi worker)
+        self._feedback_flushing: Counter = Counter()  # đang được flush, chưa có trong totals
+        self.flushes = 0
+        self.flush_errors = 0
+
+        self._init_db()
+        self._thread = threading.Thread(target=self._run, name="analytics-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @contextmanager
+    def _connect(self):
+        """Short-lived connection; commits on success, always closed"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self) -> None:
+        """Create the schema; a new database is seeded from the existing JSON files"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            # BEGIN IMMEDIATE: chỉ một worker seed dữ liệu cũ
+            conn.execute("BEGIN IMMEDIATE")
+            seeded = conn.execute("SELECT COUNT(*) FROM feedback").fetchone()[0]
+            if not seeded:
+                self._seed(conn)
+            conn.commit()
+            self._feedback_totals = dict(conn.execute("SELECT kind, total FROM feedback"))
+
+    def _seed(self, conn: sqlite3.Connection) -> None:
+        views = self._read_json(self.popular_json_path).get("popular_procedures", [])
+        conn.executemany(
+            "INSERT OR IGNORE INTO procedure_views (name, total) VALUES (?, ?)",
+            [(p["name"], int(p.get("total_queries", 0))) for p in views if p.get("name")],
+        )
+        summary = self._read_json(self.feedback_json_path).get("feedback_summary", {})
+        conn.executemany(
+            "INSERT OR IGNORE INTO feedback (kind, total) VALUES (?, ?)",
+            [(kind, int(summary.get(kind + "s", 0))) for kind in FEEDBACK_TYPES],
+        )
+        logger.info(f"Analytics DB seeded with {len(views)} procedures from JSON")
+
+    @staticmethod
+    def _read_json(path: Optional[str]) -> Dict[str, Any]:
+        if not path:
+            return {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    BUCKET_SECONDS = 3600
+
+    @classmethod
+    def _bucket_of(cls, ts: float) -> int:
+        return int(ts // cls.BUCKET_SECONDS)
+
+    # --- request path: memory only -------------------------------------------------
+
+    def _bump(self) -> None:
+        self._pending += 1
+        if self._pending >= self.flush_batch:
+            self._wake.set()
+
+    def record_view(self, name: str) -> None:
+        name = (name or "").strip()
+        if not name:
+            return
+        bucket = self._bucket_of(time.time())
+        with self._lock:
+            self._views[(bucket, name)] += 1
+            self._bump()
+
+    def record_feedback(self, new: Optional[str], previous: Optional[str] = None) -> None:
+        """Move one vote from ``previous`` to ``new`` (either may be None)"""
+        for kind in (new, previous):
+            if kind and kind not in FEEDBACK_TYPES:
+                raise ValueError("feedback_type phải là 'like' hoặc 'dislike'")
+        with self._lock:
+            if previous:
+                self._feedback[previous] -= 1
+            if new:
+                self._feedback[new] += 1
+            self._bump()
+
+    # --- reads: flushed totals + this worker's pending deltas ----------------------
+
+    def _pending_views(self, since_bucket: Optional[int] = None) -> Counter:
+        pending: Counter = Counter()
+        with self._lock:
+            for (bucket, name), count in self._views.items():
+                if since_bucket is None or bucket >= since_bucket:
+                    pending[name] += count
+        return pending
+
+    def popular(self, limit: Optional[int] = None, window: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Most viewed procedures, all time or over the last ``window`` seconds"""
+        if window:
+            since = self._bucket_of(time.time() - min(window, self.retention))
+            query, args = ("SELECT name, SUM(total) FROM procedure_views_hourly "
+                           "WHERE bucket >= ? GROUP BY name"), (since,)
+        else:
+            since, query, args = None, "SELECT name, total FROM procedure_views", ()
+        totals = self._pending_views(since)
+        with self._connect() as conn:
+            for name, total in conn.execute(query, args):
+                totals[name] += total
+        ranked = heapq.nlargest(limit, totals.items(), key=lambda item: item[1]) if limit \
+            else totals.most_common()
+        return [{"name": name, "total_queries": total} for name, total in ranked]
+
+    def top(self, limit: int, window: Optional[int] = None) -> Dict[str, Any]:
+        """``popular`` cached in memory for ``top_cache_ttl`` seconds per (limit, window)"""
+        key = (limit, window)
+        now = time.time()
+        cached = self._top_cache.get(key)
+        if cached is not None and cached["generated_at"] + self.top_cache_ttl > now:
+            return cached
+        result = {"popular_procedures": self.popular(limit, window), "generated_at": now}
+        self._top_cache[key] = result
+        return result
+
+    def feedback_summary(self) -> Dict[str, int]:
+        """Totals last read from the DB plus this worker's pending votes (no SQLite access)"""
+        with self._lock:
+            pending = Counter(self._feedback)
+            pending.update(self._feedback_flushing)  # update() giữ delta âm, "+" thì không
+            totals = dict(self._feedback_totals)
+        return {kind + "s": max(0, totals.get(kind, 0) + pending[kind]) for kind in FEEDBACK_TYPES}
+
+    def refresh_feedback_totals(self) -> None:
+        """Re-read like/dislike totals (including other workers' votes); writer thread only"""
+        with self._flush_lock:
+            with self._connect() as conn:
+                totals = dict(conn.execute("SELECT kind, total FROM feedback"))
+            with self._lock:
+                self._feedback_totals = totals
+
+    # --- background writer ---------------------------------------------------------
+
+    def flush(self) -> int:
+        """Write pending deltas in one transaction; returns the number of events written"""
+        with self._flush_lock:
+            with self._lock:
+                views, feedback, pending = self._views, self._feedback, self._pending
+                self._views, self._feedback, self._pending = Counter(), Counter(), 0
+                self._feedback_flushing = feedback
+            if not pending:
+                return 0
+            try:
+                with self._connect() as conn:
+                    by_name: Counter = Counter()
+                    for (_, name), count in views.items():
+                        by_name[name] += count
+                    conn.executemany(
+                        "INSERT INTO procedure_views (name, total) VALUES (?, ?) "
+                        "ON CONFLICT(name) DO UPDATE SET total = total + excluded.total",
+                        by_name.items(),
+                    )
+                    conn.executemany(
+                        "INSERT INTO procedure_views_hourly (bucket, name, total) VALUES (?, ?, ?) "
+                        "ON CONFLICT(bucket, name) DO UPDATE SET total = total + excluded.total",
+                        [(bucket, name, count) for (bucket, name), count in views.items()],
+                    )
+                    conn.execute("DELETE FROM procedure_views_hourly WHERE bucket < ?",
+                                 (self._bucket_of(time.time() - self.retention),))
+                    conn.executemany(
+                        "INSERT INTO feedback (kind, total) VALUES (?, ?) "
+                        "ON CONFLICT(kind) DO UPDATE SET total = MAX(0, total + excluded.total)",
+                        [(kind, delta) for kind, delta in feedback.items() if delta],
+                    )
+                    totals = dict(conn.execute("SELECT kind, total FROM feedback"))
+            except Exception:
+                # Trả lại delta để lần flush sau ghi tiếp
+                with self._lock:
+                    self._views.update(views)
+                    self._feedback.update(feedback)
+                    self._feedback_flushing = Counter()
+                    self._pending += pending
+                self.flush_errors += 1
+                raise
+            with self._lock:
+                self._feedback_totals = totals
+                self._feedback_flushing = Counter()
+            self.flushes += 1
+            self._export()
+            return pending
+
+    def _export(self) -> None:
+        if self.popular_json_path:
+            atomic_write_json(self.popular_json_path, {"popular_procedures": self.popular(self.export_limit)})
+        if self.feedback_json_path:
+            atomic_write_json(self.feedback_json_path, {"feedback_summary": self.feedback_summary()})
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                if not self.flush():
+                    self.refresh_feedback_totals()
+            except Exception as e:
+                logger.error(f"Analytics flush failed: {e}")
+
+    def close(self) -> None:
+        """Stop the writer and flush what is left (registered with atexit)"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=self.flush_interval + 5)
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Final analytics flush failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pending = self._pending
+        return {"pending_events": pending, "flushes": self.flushes, "flush_errors": self.flush_errors}
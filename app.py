@@ -1,15 +1,21 @@
 # app.py - Optimized eGov Chatbot with improved performance and error handling
 import os
+import asyncio
 import shutil
 import time
 import hashlib
+import hmac
 import gzip
 import pickle
 import json
 import traceback
 import re
-from typing import Optional, List, Dict, Tuple, Any
-from functools import lru_cache
+import math
+import queue
+import bisect
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, List, Dict, Tuple, Any, Mapping, Sequence
 import logging
 from huggingface_hub import login, hf_hub_download
 
@@ -40,10 +46,20 @@ import faiss
 from flask import Flask, request, jsonify, Response, render_template, send_from_directory, abort
 from flask_cors import CORS
 from sentence_transformers import SentenceTransformer
-from rank_bm25 import BM25Okapi
 import google.generativeai as genai
+from google.ai import generativelanguage as glm
+from google.api_core.client_options import ClientOptions
 from cachetools import TTLCache, LRUCache
-import unicodedata
+from compact_store import (
+    ColumnarMetas, RecordStore, SortedStringIndex, StringColumn, build_lock, current_version, load_array,
+    read_manifest, write_store
+)
+from llm_pool import CircuitBreaker, GenerationPool, LLMKey, NoAvailableKeyError, is_retryable_error
+from session_store import MemorySessionStore, RedisSessionStore, SessionStore
+from analytics_store import AnalyticsStore
+from metrics import StackSampler, observe_stage, registry, stage
+from procedure_fields import FIELD_MAP, classify_field_intent, procedure_text, question_fields
+from vn_text import TOKENIZER_VERSION, fold, index_terms, normalize_text, query_terms
 
 # Configuration with hardcoded repo_id
 class Config:
@@ -55,17 +71,132 @@ class Config:
     # Performance tuning
     TOP_K = 3
     FAISS_CANDIDATES = 50
+    # Index build bằng Offline_Pharse/build_faiss_index.py (flat / hnsw / ivfpq)
+    FAISS_INDEX_FILE = os.getenv("FAISS_INDEX_FILE", "index.faiss")
+    FAISS_SEARCH_PARAMS = os.getenv("FAISS_SEARCH_PARAMS", "")  # vd "nprobe=16", "efSearch=64"
+    FAISS_MMAP = os.getenv("FAISS_MMAP", "1") == "1"
+
+    # Startup: số thread tải artifact / model song song
+    STARTUP_WORKERS = 8
+    # True: server nhận request ngay, tài nguyên load nền (xem /health/ready)
+    BACKGROUND_INIT = os.getenv("BACKGROUND_INIT", "1") == "1"
+
+    # Kho dữ liệu dạng cột mmap, dùng chung giữa các worker ("" = unpickle như cũ)
+    COMPACT_STORE_DIR = os.getenv("COMPACT_STORE_DIR", "/tmp/egov_store")
     BM25_PREFILTER = 200
+
+    # Hybrid fusion: "rrf" (reciprocal rank) hoặc "weighted" (min-max)
+    FUSION_METHOD = "rrf"
+    FUSION_DENSE_WEIGHT = 0.6
+    FUSION_BM25_WEIGHT = 0.4
+    RRF_K = 60
+    RETRIEVAL_WORKERS = 4
+    ASYNC_RETRIEVAL_WORKERS = 8  # asgi.py: thread pool cho retrieval + build prompt
+
+    # Streaming failover: số ký tự đầu của model dự phòng được giữ lại để cắt phần lặp
+    RESUME_OVERLAP_WINDOW = 200
+    RESUME_MIN_OVERLAP = 20
+
+    # Gemini key pool: GOOGLE_API_KEY, GOOGLE_API_KEY_2..N hoặc GOOGLE_API_KEYS="k1,k2,..."
+    # Giới hạn theo key là tùy chọn (không đặt = không giới hạn, lỗi 429 thật vẫn do
+    # circuit breaker xử lý). Bộ đếm nằm trong từng process: chạy N worker thì mỗi
+    # worker có quota riêng, nên đặt LLM_DAILY_QUOTA_PER_KEY = quota thật / N
+    LLM_RPM_PER_KEY = float(os.getenv("LLM_RPM_PER_KEY", "0")) or None
+    LLM_BURST_PER_KEY = float(os.getenv("LLM_BURST_PER_KEY", "0")) or None
+    LLM_DAILY_QUOTA_PER_KEY = int(os.getenv("LLM_DAILY_QUOTA_PER_KEY", "0")) or None
+    LLM_BREAKER_THRESHOLD = 3      # số lỗi 429/5xx liên tiếp trước khi ngắt key
+    LLM_BREAKER_COOLDOWN = 60.0    # giây trước khi thử lại key bị ngắt
+    LLM_MAX_WAIT = float(os.getenv("LLM_MAX_WAIT", "2.0"))  # chờ tối đa (giây) khi mọi key đều hết token
+
+    # Gộp điểm chunk theo thủ tục (parent_id): "max" hoặc "sum"
+    PARENT_POOLING = "max"
+    PARENT_CHUNK_CANDIDATES = 50
+
+    # Ma trận embedding thủ tục build offline (Offline_Pharse/build_procedure_embeddings.py)
+    PROCEDURE_EMB_FILE = "procedure_embs.npy"
+    PROCEDURE_IDS_FILE = "procedure_ids.json"
+    PROCEDURE_EMB_DIR = os.getenv("PROCEDURE_EMB_DIR", "")
+
+    # Micro-batching query embedding (gom các query đến gần nhau thành 1 batch)
+    EMB_BATCH_MAX_SIZE = 32
+    EMB_BATCH_MAX_WAIT_MS = 5
+
+    # Embedding backend: "torch" (SentenceTransformer fp32) hoặc "onnx"
+    # (ONNX Runtime, export bằng Offline_Pharse/export_onnx_embedding.py)
+    EMB_BACKEND = os.getenv("EMB_BACKEND", "torch")
+    ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "/tmp/onnx_emb")
+    ONNX_QUANTIZED = os.getenv("ONNX_QUANTIZED", "1") == "1"
+    EMB_NUM_THREADS = int(os.getenv("EMB_NUM_THREADS", "0"))  # 0 = mặc định của thư viện
     
     # Caching
     CACHE_TTL = 3600
     CACHE_MAX = 2000
+
+    # Session store: "memory" (mỗi worker một bản) hoặc "redis" (dùng chung giữa các worker)
+    SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+    REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    SESSION_TTL = int(os.getenv("SESSION_TTL", str(6 * 3600)))
+    SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+    QUERY_EMB_CACHE_BYTES = 32 * 1024 * 1024
+    PROCEDURE_TEXT_CACHE_MAX = 1000
+
+    # Semantic answer cache: câu hỏi mới (không phải follow-up) cùng thủ tục,
+    # gần nghĩa với câu đã trả lời => dùng lại câu trả lời, không gọi Gemini
+    SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "1") == "1"
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+    SEMANTIC_CACHE_TTL = 6 * 3600
+    SEMANTIC_CACHE_MAX = 5000
     
     # Similarity thresholds
     CONTEXT_SIM_THRESHOLD = 0.62
     MIN_CONTEXT_LEN_FOR_SIM = 50
     SWITCH_MARGIN = 0.15
     
+    # Prompt budget (ước lượng token = ký tự / PROMPT_CHARS_PER_TOKEN)
+    PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+    PROMPT_HISTORY_TOKENS = 600    # phần dành cho lịch sử trò chuyện
+    PROMPT_HISTORY_ITEMS = 6       # số lượt gần nhất được xét
+    PROMPT_HISTORY_ITEM_CHARS = 500
+    PROMPT_CHARS_PER_TOKEN = 3.0
+
+    # Fast path: câu hỏi chỉ hỏi đúng một mục (hồ sơ, cơ quan, nguồn...) của thủ tục
+    # đã xác định => trả thẳng nội dung mục đó, không gọi Gemini
+    FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "1") == "1"
+    FAST_PATH_MIN_CONFIDENCE = 0.8
+    FAST_PATH_MAX_QUERY_CHARS = 120
+    # Câu hỏi mới chỉ đi fast path khi retrieval chắc chắn về thủ tục:
+    #   điểm top-1 >= FAST_PATH_MIN_TOP_SCORE x điểm fused tối đa (RRF: FAISS và BM25 cùng
+    #   xếp nó hạng nhất) và vượt top-2 ít nhất FAST_PATH_MIN_MARGIN ((s1 - s2) / s1;
+    #   top-2 đứng nhì ở cả hai danh sách => ~0.016)
+    FAST_PATH_MIN_TOP_SCORE = float(os.getenv("FAST_PATH_MIN_TOP_SCORE", "0.98"))
+    FAST_PATH_MIN_MARGIN = float(os.getenv("FAST_PATH_MIN_MARGIN", "0.015"))
+
+    # /search và /procedure
+    SEARCH_MAX_RESULTS = 100
+    # Kết quả retrieval (sau các tên khớp) phải đạt tỷ lệ này của điểm fused tối đa:
+    # 0.6 = chỉ FAISS xếp hạng nhất, nên chuỗi vô nghĩa (BM25 không khớp gì) không trả về gì
+    SEARCH_MIN_SCORE = float(os.getenv("SEARCH_MIN_SCORE", "0.65"))
+    SEARCH_MAX_PAGE_SIZE = 50
+    SEARCH_CACHE_MAX = 2000
+    PROCEDURE_MAX_AGE = 3600  # giây; trình duyệt kiểm tra lại bằng ETag sau đó
+
+    # Thống kê (lượt xem thủ tục, like/dislike): đếm trong RAM, ghi nền vào SQLite
+    # Không đặt trong user_data/: thư mục đó được phục vụ công khai qua /user_data/
+    ANALYTICS_DB = os.getenv("ANALYTICS_DB", "analytics_data/analytics.db")
+    ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "5"))
+    ANALYTICS_FLUSH_BATCH = 200
+    # /popular: top-N theo cửa sổ trượt (giờ), giữ trong RAM POPULAR_CACHE_SECONDS giây
+    POPULAR_WINDOW_HOURS = int(os.getenv("POPULAR_WINDOW_HOURS", "168"))
+    POPULAR_DEFAULT_LIMIT = 10
+    POPULAR_MAX_LIMIT = 50
+    POPULAR_CACHE_SECONDS = 30
+
+    # Sampling profiler (ms giữa hai lần lấy mẫu stack, 0 = tắt); xem /debug/profile
+    PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "0"))
+    # Endpoint chẩn đoán (/session_memory, /debug/profile) cần header X-Debug-Token;
+    # không đặt token = tắt các endpoint này
+    DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+
     # Query processing
     LONG_QUERY_THRESHOLD = 50
     HISTORY_FOLLOWUP_THRESHOLD = 40
@@ -76,140 +207,598 @@ config = Config()
 faiss_index = None
 metadatas = None
 bm25 = None
-parent_id_to_chunks = {}
+bm25_sparse = None
+parent_id_to_chunks = {}  # parent_id -> chunk indices
+parent_keys: Sequence[str] = []
+chunk_parent_codes = None  # int32 row in parent_keys per chunk, -1 = none
 embedding_model = None
-generation_model = None
-generation_model_2 = None
+embedding_backend = "torch"
+embedding_batcher = None
+generation_pool: Optional[GenerationPool] = None
 procedure_dict = {}
+procedure_embeddings = None
+procedure_emb_row: Dict[str, int] = {}
+# Short public ids for /procedure/<id> (parent ids are source URLs)
+procedure_public_ids: Dict[str, str] = {}   # parent_id -> public id
+procedure_by_public_id: Dict[str, str] = {}  # public id -> parent_id
+procedure_names: List[Tuple[str, str]] = []   # (name_search_key(name), parent_id), sorted
+
+# Lexical candidates run alongside embedding + FAISS
+retrieval_executor = ThreadPoolExecutor(max_workers=config.RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
 
 # Caches
-answer_cache = TTLCache(maxsize=config.CACHE_MAX, ttl=config.CACHE_TTL)
-embedding_cache = LRUCache(maxsize=1000)  # Cache for embeddings
-
-# Field mapping for response formatting
-FIELD_MAP = {
-    "ten_thu_tuc": "Tên thủ tục",
-    "cach_thuc_thuc_hien": "Cách thức thực hiện",
-    "thanh_phan_ho_so": "Thành phần hồ sơ",
-    "trinh_tu_thuc_hien": "Trình tự thực hiện",
-    "co_quan_thuc_hien": "Cơ quan thực hiện",
-    "yeu_cau_dieu_kien": "Yêu cầu, điều kiện",
-    "thu_tuc_lien_quan": "Thủ tục liên quan",
-    "nguon": "Nguồn",
-}
+procedure_text_cache = LRUCache(maxsize=config.PROCEDURE_TEXT_CACHE_MAX)  # parent_id -> full procedure text
+
+# Session storage (chat histories + exact answer cache)
+def create_session_store() -> SessionStore:
+    if config.SESSION_BACKEND == "redis":
+        logger.info(f"Session store: redis ({config.REDIS_URL.rsplit('@', 1)[-1]})")
+        return RedisSessionStore(config.REDIS_URL, session_ttl=config.SESSION_TTL, answer_ttl=config.CACHE_TTL)
+    return MemorySessionStore(max_sessions=config.SESSION_MAX, session_ttl=config.SESSION_TTL,
+                              max_answers=config.CACHE_MAX, answer_ttl=config.CACHE_TTL)
+
+session_store = create_session_store()
+
+# Always part of the context: what the procedure is and where it comes from
+CONTEXT_BASE_FIELDS = ("ten_thu_tuc", "nguon")
 
 popular_procedures_path = "user_data/popular_procedures.json"
 user_feedback_path = "user_data/user_feedback.json"
-logger.info("Loading popular_procedures data...")
-with open(popular_procedures_path, "r", encoding="utf-8") as f:
-    popular_procedures_data = json.load(f)
-logger.info("Loading user_feedback data...")
-with open(user_feedback_path, "r", encoding="utf-8") as f:
-    user_feedback_data = json.load(f) 
+# File /user_data/ được phép tải về (frontend); mọi file khác trong thư mục -> 404
+PUBLIC_USER_DATA_FILES = {os.path.basename(popular_procedures_path), os.path.basename(user_feedback_path)}
+
+LEGACY_ANALYTICS_DB = "user_data/analytics.db"
+
+# Tạo trong load_resources (import app.py không mở DB / không chạy writer thread)
+analytics: Optional[AnalyticsStore] = None
+
+def init_analytics() -> AnalyticsStore:
+    """Analytics store with its write-behind thread; moves a DB left in user_data/"""
+    if "ANALYTICS_DB" not in os.environ and os.path.exists(LEGACY_ANALYTICS_DB) \
+            and not os.path.exists(config.ANALYTICS_DB):
+        # Chuyển DB từ vị trí cũ (công khai) sang vị trí mới, kèm -wal / -shm nếu có
+        os.makedirs(os.path.dirname(config.ANALYTICS_DB), exist_ok=True)
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.replace(LEGACY_ANALYTICS_DB + suffix, config.ANALYTICS_DB + suffix)
+            except FileNotFoundError:  # không có file này, hoặc worker khác đã chuyển
+                pass
+        logger.info(f"Moved analytics DB from {LEGACY_ANALYTICS_DB} to {config.ANALYTICS_DB}")
+
+    return AnalyticsStore(
+        config.ANALYTICS_DB,
+        popular_json_path=popular_procedures_path,
+        feedback_json_path=user_feedback_path,
+        flush_interval=config.ANALYTICS_FLUSH_INTERVAL,
+        flush_batch=config.ANALYTICS_FLUSH_BATCH,
+        retention=config.POPULAR_WINDOW_HOURS * 3600,
+        top_cache_ttl=config.POPULAR_CACHE_SECONDS,
+    )
+
+def fetch_procedure_embeddings() -> Optional[Tuple[np.ndarray, List[str]]]:
+    """Memory-map the offline procedure embedding matrix and its row ids; None if unavailable"""
+    try:
+        if config.PROCEDURE_EMB_DIR:
+            emb_path = os.path.join(config.PROCEDURE_EMB_DIR, config.PROCEDURE_EMB_FILE)
+            ids_path = os.path.join(config.PROCEDURE_EMB_DIR, config.PROCEDURE_IDS_FILE)
+        else:
+            emb_path = hf_hub_download(repo_id=config.HF_REPO_ID, filename=config.PROCEDURE_EMB_FILE, repo_type=config.REPO_TYPE)
+            ids_path = hf_hub_download(repo_id=config.HF_REPO_ID, filename=config.PROCEDURE_IDS_FILE, repo_type=config.REPO_TYPE)
+
+        matrix = np.load(emb_path, mmap_mode="r")
+        with open(ids_path, "r", encoding="utf-8") as f:
+            ids = json.load(f)
+        return matrix, ids
+    except Exception as e:
+        logger.warning(f"Procedure embeddings unavailable, falling back to runtime encoding: {e}")
+        return None
+
+def load_procedure_embeddings(fetched: Optional[Tuple[np.ndarray, List[str]]], dim: int) -> Tuple[Optional[np.ndarray], Dict[str, int]]:
+    """Validate the fetched matrix against the model dimension; (None, {}) if unusable"""
+    if fetched is None:
+        return None, {}
+
+    matrix, ids = fetched
+    if matrix.dtype != np.float32 or matrix.ndim != 2 or matrix.shape != (len(ids), dim):
+        logger.warning(f"Procedure embeddings ignored: shape {matrix.shape} {matrix.dtype}, expected ({len(ids)}, {dim}) float32")
+        return None, {}
+
+    logger.info(f"Procedure embeddings mapped. rows = {matrix.shape[0]}")
+    return matrix, {parent_id: row for row, parent_id in enumerate(ids)}
+
+def load_embedding_model() -> Tuple[Any, str]:
+    """Load the configured embedding backend; falls back to SentenceTransformer"""
+    if config.EMB_BACKEND == "onnx":
+        try:
+            from onnx_embedding import OnnxEmbeddingModel
+            model = OnnxEmbeddingModel(
+                config.ONNX_MODEL_DIR, quantized=config.ONNX_QUANTIZED, num_threads=config.EMB_NUM_THREADS
+            )
+            backend = "onnx-int8" if config.ONNX_QUANTIZED else "onnx-fp32"
+            logger.info(f"Loaded embedding model: {model.model_path} ({backend})")
+            return model, backend
+        except Exception as e:
+            logger.warning(f"ONNX embedding backend unavailable, using SentenceTransformer: {e}")
+
+    if config.EMB_NUM_THREADS:
+        torch.set_num_threads(config.EMB_NUM_THREADS)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    logger.info(f"Loading embedding model: {config.EMB_MODEL} on {device}")
+    return SentenceTransformer(config.EMB_MODEL, device=device), "torch"
+
+def apply_faiss_search_params(index) -> None:
+    """Set nprobe / efSearch from Config or the index's build sidecar (<index>.json)"""
+    search_params = config.FAISS_SEARCH_PARAMS
+    if not search_params:
+        sidecar = os.path.splitext(config.FAISS_INDEX_FILE)[0] + ".json"
+        try:
+            params_path = hf_hub_download(repo_id=config.HF_REPO_ID, filename=sidecar, repo_type=config.REPO_TYPE)
+            with open(params_path, "r", encoding="utf-8") as f:
+                params = json.load(f)
+            search_params = params.get("search_params", "")
+            logger.info(f"FAISS build params: {params}")
+        except Exception:
+            return  # index.faiss gốc không có sidecar
+
+    if search_params:
+        faiss.ParameterSpace().set_index_parameters(index, search_params)
+        logger.info(f"FAISS search params: {search_params}")
+
+def faiss_index_is_mmapped(index) -> bool:
+    """IO_FLAG_MMAP only maps IVF inverted lists; flat / HNSW vectors are always read into RAM"""
+    if not config.FAISS_MMAP:
+        return False
+    try:
+        faiss.extract_index_ivf(index)
+    except Exception:
+        return False
+    return True
+
+def read_faiss_index(path: str):
+    """Read the FAISS index, memory-mapped read-only when the index type supports it (IVF only)"""
+    if config.FAISS_MMAP:
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except Exception as e:
+            logger.warning(f"FAISS mmap load failed, reading into memory: {e}")
+    return faiss.read_index(path)
+
+def load_pickled_corpus(metas_path: str, bm25_path: str, raw_path: str) -> Tuple[List[Dict], Any, Dict[str, Dict]]:
+    """Unpickle metadata / BM25 and parse the raw procedures JSON"""
+    logger.info("Loading metadata...")
+    with gzip.open(metas_path, "rb") as f:
+        metas = pickle.load(f)
+    metas = metas.get("corpus", metas) if isinstance(metas, dict) else metas
+
+    logger.info("Loading BM25...")
+    with gzip.open(bm25_path, "rb") as f:
+        okapi = pickle.load(f)
+
+    logger.info("Loading raw JSON data...")
+    with open(raw_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    records = {obj.get("nguon"): obj for obj in data}
+
+    return metas, okapi, records
+
+def build_parent_codes(metas: List[Dict]) -> Tuple[List[str], np.ndarray]:
+    """Distinct parent keys and, per chunk, its row in that list (-1 = none)"""
+    keys: Dict[str, int] = {}
+    codes = np.full(len(metas), -1, dtype=np.int32)
+    for idx, chunk in enumerate(metas):
+        key = chunk.get("parent_id") or chunk.get("nguon")
+        if key:
+            codes[idx] = keys.setdefault(key, len(keys))
+    return list(keys), codes
+
+def load_compact_corpus(metas_path: str, bm25_path: str, raw_path: str):
+    """Memory-map the columnar store, building it once from the pickles if stale"""
+    store_dir = config.COMPACT_STORE_DIR
+    sources = {name: os.path.realpath(path) for name, path in
+               (("metas", metas_path), ("bm25", bm25_path), ("raw", raw_path))}
+    sources["tokenizer"] = f"vn_text/{TOKENIZER_VERSION}"
+
+    manifest = read_manifest(store_dir)
+    if manifest is None or manifest.get("sources") != sources:
+        with build_lock(store_dir):
+            # Worker khác có thể đã build xong trong lúc chờ lock
+            manifest = read_manifest(store_dir)
+            if manifest is None or manifest.get("sources") != sources:
+                logger.info(f"Building compact store in {store_dir}...")
+                metas, okapi, records = load_pickled_corpus(metas_path, bm25_path, raw_path)
+                sparse = SparseBM25.from_metas(metas, okapi)
+                keys, codes = build_parent_codes(metas)
+                write_store(
+                    store_dir, metas, keys, codes, list(sparse.vocab), sparse.offsets,
+                    sparse.doc_ids, sparse.weights, sparse.corpus_size, records, sources
+                )
+
+    # Chỉ resolve symlink một lần: mọi file được map từ cùng một version
+    store_dir = current_version(store_dir)
+    manifest = read_manifest(store_dir)
+    logger.info(f"Mapping compact store {store_dir}...")
+    # Vocab và parent_keys tra thẳng trên cột mmap (bisect), không dựng dict/list riêng mỗi worker
+    sparse = SparseBM25(
+        SortedStringIndex(os.path.join(store_dir, "bm25_vocab")),
+        load_array(store_dir, "bm25_offsets"),
+        load_array(store_dir, "bm25_doc_ids"),
+        load_array(store_dir, "bm25_weights"),
+        manifest["bm25_corpus_size"],
+    )
+    return (
+        ColumnarMetas(store_dir, manifest["fields"]),
+        sparse,
+        RecordStore(store_dir),
+        StringColumn(os.path.join(store_dir, "parent_keys")),
+        load_array(store_dir, "chunk_parent_codes"),
+    )
+
+class StartupTracker:
+    """Per-component startup state and timings, reported by /health"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.components: Dict[str, Dict[str, Any]] = {}
+        self.ready = False
+        self.failed = False
+        self._lock = threading.Lock()
+
+    def run(self, name: str, fn, *args, **kwargs):
+        """Run one startup step, recording its state and duration"""
+        with self._lock:
+            self.components[name] = {"state": "loading"}
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            with self._lock:
+                self.components[name] = {"state": "failed", "seconds": round(time.perf_counter() - start, 3), "error": str(e)}
+            raise
+        with self._lock:
+            self.components[name] = {"state": "ready", "seconds": round(time.perf_counter() - start, 3)}
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "failed": self.failed,
+                "uptime_s": round(time.time() - self.started_at, 1),
+                "components": {name: dict(info) for name, info in self.components.items()},
+            }
+
+startup = StartupTracker()
+
+def download_artifact(filename: str) -> str:
+    return hf_hub_download(repo_id=config.HF_REPO_ID, filename=filename, repo_type=config.REPO_TYPE)
+
+def load_faiss(path: str):
+    index = read_faiss_index(path)
+    apply_faiss_search_params(index)
+    logger.info(f"FAISS loaded. ntotal = {getattr(index, 'ntotal', 'unknown')}, mmap = {faiss_index_is_mmapped(index)}")
+    return index
+
+def load_corpus(metas_path: str, bm25_path: str, raw_path: str):
+    """Metadata, BM25 postings, procedures and parent mapping (compact store or pickles)"""
+    if config.COMPACT_STORE_DIR:
+        metas, sparse, records, keys, codes = load_compact_corpus(metas_path, bm25_path, raw_path)
+        okapi = None
+    else:
+        metas, okapi, records = load_pickled_corpus(metas_path, bm25_path, raw_path)
+        sparse = SparseBM25.from_metas(metas, okapi)
+        keys, codes = build_parent_codes(metas)
+    logger.info(f"BM25 postings ready. vocab = {len(sparse.vocab)}, postings = {len(sparse.doc_ids)}")
+    logger.info(f"Loaded {len(records)} procedures.")
+
+    logger.info("Building parent_id mapping...")
+    parent_map: Dict[str, List[int]] = {}
+    for idx, code in enumerate(codes.tolist()):
+        if code >= 0:
+            parent_map.setdefault(keys[code], []).append(idx)
+    return metas, okapi, sparse, records, keys, codes, parent_map
+
+def google_api_keys() -> List[str]:
+    """API keys from GOOGLE_API_KEYS and GOOGLE_API_KEY, GOOGLE_API_KEY_2, ..."""
+    keys = [k.strip() for k in os.getenv("GOOGLE_API_KEYS", "").split(",")]
+    keys.append(os.getenv("GOOGLE_API_KEY", ""))
+    n = 2
+    while os.getenv(f"GOOGLE_API_KEY_{n}"):
+        keys.append(os.getenv(f"GOOGLE_API_KEY_{n}"))
+        n += 1
+    return list(dict.fromkeys(k for k in keys if k))
+
+def make_generation_model(api_key: str):
+    """GenerativeModel bound to its own API key.
+
+    genai.configure() sets one process-wide key, so configuring it once per key
+    left every model on the last key; each model gets its own clients instead.
+    Only the sync client is built here (startup thread, no event loop); the async
+    one is created by ``bind_async_client`` on the serving loop.
+    """
+    options = ClientOptions(api_key=api_key)
+    model = genai.GenerativeModel(config.GENAI_MODEL)
+    model._client = glm.GenerativeServiceClient(client_options=options)
+    model._async_client = None
+    model._egov_client_options = options
+    return model
+
+def bind_async_client(model) -> None:
+    """grpc.aio client for ``model``'s key, created on the running event loop"""
+    model._async_client = glm.GenerativeServiceAsyncClient(client_options=model._egov_client_options)
+
+def init_generation_pool() -> GenerationPool:
+    keys = [
+        LLMKey(f"key{i}", make_generation_model(api_key),
+               rpm=config.LLM_RPM_PER_KEY, burst=config.LLM_BURST_PER_KEY,
+               daily_quota=config.LLM_DAILY_QUOTA_PER_KEY,
+               breaker_threshold=config.LLM_BREAKER_THRESHOLD,
+               breaker_cooldown=config.LLM_BREAKER_COOLDOWN,
+               bind_async=bind_async_client)
+        for i, api_key in enumerate(google_api_keys(), 1)
+    ]
+    if keys:
+        logger.info(f"Generation pool initialized with {len(keys)} API key(s)")
+    else:
+        logger.warning("GOOGLE_API_KEY missing - LLM calls will fail")
+    return GenerationPool(keys, max_wait=config.LLM_MAX_WAIT)
 
 def load_resources():
-    """Load all required resources từ Hugging Face Hub"""
-    global faiss_index, metadatas, bm25, parent_id_to_chunks, embedding_model, generation_model, generation_model_2, procedure_dict
+    """Load all required resources từ Hugging Face Hub.
+
+    Artifact downloads, the embedding model and corpus parsing run concurrently;
+    each step's state and duration is recorded in ``startup`` for /health.
+    """
+    global faiss_index, metadatas, bm25, bm25_sparse, parent_id_to_chunks, embedding_model, generation_pool, procedure_dict
+    global procedure_embeddings, procedure_emb_row, embedding_batcher, embedding_backend
+    global parent_keys, chunk_parent_codes
+    global procedure_public_ids, procedure_by_public_id, procedure_names, analytics
     
     start_time = time.perf_counter()
     logger.info("Starting resource loading...")
 
     try:
-        # ✅ Tải file từ Hugging Face
-        logger.info(f"Downloading files from HF repo: {config.HF_REPO_ID}")
-        faiss_path = hf_hub_download(repo_id=config.HF_REPO_ID, filename="index.faiss", repo_type=config.REPO_TYPE)
-        metas_path = hf_hub_download(repo_id=config.HF_REPO_ID, filename="metas.pkl.gz", repo_type=config.REPO_TYPE)
-        bm25_path = hf_hub_download(repo_id=config.HF_REPO_ID, filename="bm25.pkl.gz", repo_type=config.REPO_TYPE)
-        raw_path = hf_hub_download(repo_id=config.HF_REPO_ID, filename="toan_bo_du_lieu_final.json", repo_type=config.REPO_TYPE)
-
-        # Load FAISS index
-        logger.info("Loading FAISS index...")
-        faiss_index = faiss.read_index(faiss_path)
-        logger.info(f"FAISS loaded. ntotal = {getattr(faiss_index, 'ntotal', 'unknown')}")
-
-        # Load metadata
-        logger.info("Loading metadata...")
-        with gzip.open(metas_path, "rb") as f:
-            metas = pickle.load(f)
-        metadatas = metas.get("corpus", metas) if isinstance(metas, dict) else metas
-
-        # Load BM25
-        logger.info("Loading BM25...")
-        with gzip.open(bm25_path, "rb") as f:
-            bm25 = pickle.load(f)
-
-        # Load raw data once
-        logger.info("Loading raw JSON data...")
-        with open(raw_path, "r", encoding="utf-8") as f:
-            data = json.load(f)       
-
-        # Dictionary lookup
-        procedure_dict = {obj.get("nguon"): obj for obj in data}
-        logger.info(f"Loaded {len(procedure_dict)} procedures into memory.")
-
-        # Build parent_id mapping
-        logger.info("Building parent_id mapping...")
-        parent_id_to_chunks = {}
-        for chunk in metadatas:
-            key = chunk.get("parent_id") or chunk.get("nguon")
-            if key:
-                parent_id_to_chunks.setdefault(key, []).append(chunk)
-
-        # Load embedding model
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        logger.info(f"Loading embedding model: {config.EMB_MODEL} on {device}")
-        embedding_model = SentenceTransformer(config.EMB_MODEL, device=device)
-
-        # Initialize generation model
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if api_key:
-            genai.configure(api_key=api_key)
-            generation_model = genai.GenerativeModel(config.GENAI_MODEL)
-            logger.info("Generation model initialized")
-        else:
-            logger.warning("GOOGLE_API_KEY missing - LLM calls will fail")
-
-        api_key_2 = os.getenv("GOOGLE_API_KEY_2")
-        if api_key_2:
-            genai.configure(api_key=api_key_2)
-            generation_model_2 = genai.GenerativeModel(config.GENAI_MODEL)
-            logger.info("Generation model 2 initialized")
-        else:
-            logger.warning("GOOGLE_API_KEY 2 missing - LLM calls will fail")
+        if analytics is None:
+            analytics = startup.run("analytics", init_analytics)
+        with ThreadPoolExecutor(max_workers=config.STARTUP_WORKERS, thread_name_prefix="startup") as pool:
+            # Model tải song song với dữ liệu (không phụ thuộc nhau)
+            model_future = pool.submit(startup.run, "embedding_model", load_embedding_model)
+            proc_emb_future = pool.submit(startup.run, "procedure_embeddings_download", fetch_procedure_embeddings)
+
+            # ✅ Tải file từ Hugging Face (song song)
+            logger.info(f"Downloading files from HF repo: {config.HF_REPO_ID}")
+            downloads = {
+                filename: pool.submit(startup.run, f"download:{filename}", download_artifact, filename)
+                for filename in (config.FAISS_INDEX_FILE, "metas.pkl.gz", "bm25.pkl.gz", "toan_bo_du_lieu_final.json")
+            }
+            faiss_future = pool.submit(
+                lambda: startup.run("faiss", load_faiss, downloads[config.FAISS_INDEX_FILE].result())
+            )
+            generation_future = pool.submit(startup.run, "generation", init_generation_pool)
+
+            # Corpus parse ngay trên thread này khi đủ 3 file
+            (metadatas, bm25, bm25_sparse, procedure_dict, parent_keys,
+             chunk_parent_codes, parent_id_to_chunks) = startup.run(
+                "corpus", load_corpus,
+                downloads["metas.pkl.gz"].result(),
+                downloads["bm25.pkl.gz"].result(),
+                downloads["toan_bo_du_lieu_final.json"].result(),
+            )
+
+            search_future = pool.submit(startup.run, "search_index", build_procedure_index, procedure_dict)
+
+            faiss_index = faiss_future.result()
+            embedding_model, embedding_backend = model_future.result()
+            embedding_batcher = EmbeddingBatcher(
+                embedding_model, config.EMB_BATCH_MAX_SIZE, config.EMB_BATCH_MAX_WAIT_MS
+            )
+
+            # Load precomputed procedure embeddings (optional artifact)
+            procedure_embeddings, procedure_emb_row = load_procedure_embeddings(
+                proc_emb_future.result(), embedding_model.get_sentence_embedding_dimension()
+            )
+            generation_pool = generation_future.result()
+            procedure_public_ids, procedure_by_public_id, procedure_names = search_future.result()
 
         load_time = time.perf_counter() - start_time
         logger.info(f"Resources loaded successfully in {load_time:.2f}s")
         logger.info(f"Corpus size: {len(metadatas)}")
 
+        startup.ready = True
         return True
 
     except Exception as e:
         logger.error(f"Failed to load resources: {e}")
         traceback.print_exc()
+        startup.failed = True
         return False
 
 
 # Utility functions
-@lru_cache(maxsize=1000)
-def normalize_text(text: str) -> str:
-    """Normalize text for consistent processing"""
-    return " ".join(text.lower().strip().split())
-
 def cache_key_for_query(query: str, session_id: str = "", parent_id: str = "") -> str:
     """Generate cache key for query"""
     raw = f"{session_id}|{parent_id}|{normalize_text(query)}|{config.EMB_MODEL}|{config.TOP_K}"
     return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-@lru_cache(maxsize=100)
+class EmbeddingBatcher:
+    """Collects queries arriving within a short window and encodes them in one pass.
+
+    Request threads call ``encode`` and block on a per-request future; a single
+    worker thread drains the queue into batches of up to ``max_batch_size``,
+    waiting at most ``max_wait_ms`` after the first query for more to arrive.
+    """
+
+    def __init__(self, model, max_batch_size: int = 32, max_wait_ms: float = 5):
+        self.model = model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0
+        self.items = 0
+        self._queue: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def encode(self, text: str) -> np.ndarray:
+        """Normalized float32 embedding of one text (blocks until its batch is done)"""
+        future: Future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _collect(self) -> List[Tuple[str, Future]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            # Query trùng nhau trong cùng batch chỉ encode một lần
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                embs = self.model.encode(
+                    texts, batch_size=len(texts), convert_to_numpy=True, normalize_embeddings=True
+                ).astype("float32")
+                by_text = dict(zip(texts, embs))
+                for text, future in batch:
+                    future.set_result(by_text[text])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            self.batches += 1
+            self.items += len(batch)
+
+def encode_query(query: str) -> np.ndarray:
+    """Normalized float32 query embedding, micro-batched when the batcher is running"""
+    if embedding_batcher is not None:
+        return embedding_batcher.encode(query)
+    return embedding_model.encode([query], convert_to_numpy=True, normalize_embeddings=True).astype("float32")[0]
+
+class QueryEmbeddingCache:
+    """Byte-bounded LRU of query embeddings shared by every retrieval path.
+
+    Keys are ``model id:backend | normalize_text(query)`` so casing/spacing variants and
+    repeat questions across sessions reuse one vector.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._cache = LRUCache(maxsize=max_bytes, getsizeof=lambda emb: emb.nbytes)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(query: str) -> str:
+        return f"{config.EMB_MODEL}:{embedding_backend}|{normalize_text(query)}"
+
+    def get(self, query: str) -> np.ndarray:
+        """Cached embedding of ``query``; encodes (micro-batched) on a miss"""
+        key = self.key(query)
+        with self._lock:
+            emb = self._cache.get(key)
+            if emb is not None:
+                self.hits += 1
+                return emb
+            self.misses += 1
+
+        with stage("embedding"):
+            emb = encode_query(query)
+        emb.setflags(write=False)  # shared between requests
+        with self._lock:
+            self._cache[key] = emb
+        return emb
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._cache),
+                "bytes": self._cache.currsize,
+                "max_bytes": self._cache.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
+
+query_embedding_cache = QueryEmbeddingCache(config.QUERY_EMB_CACHE_BYTES)
+
 def get_query_embedding_cached(query: str) -> Optional[np.ndarray]:
     """Get cached query embedding"""
     try:
-        emb = embedding_model.encode([query], convert_to_numpy=True, normalize_embeddings=True).astype("float32")[0]
-        return emb
+        return query_embedding_cache.get(query)
     except Exception as e:
         logger.warning(f"Embedding failed for query: {e}")
         return None
 
+class SemanticAnswerCache:
+    """Session-independent answers keyed by resolved procedure + query embedding.
+
+    A fresh question reuses a stored answer when its embedding is within
+    ``threshold`` cosine similarity of an earlier question about the same
+    ``parent_id``. Entries expire after ``ttl`` and the least recently used are
+    evicted beyond ``maxsize``.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, threshold: float):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)  # (parent_id, query) -> (emb, answer)
+        self._by_parent: Dict[str, set] = {}
+        self._lock = threading.Lock()
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, parent_id: str, query_emb: np.ndarray) -> Optional[Tuple[str, float]]:
+        """(answer, similarity) of the closest earlier question above the threshold"""
+        with self._lock:
+            keys = self._by_parent.get(parent_id, set())
+            entries = []
+            for key in list(keys):
+                entry = self._entries.get(key)  # TTLCache: None khi đã hết hạn / bị loại
+                if entry is None:
+                    keys.discard(key)
+                else:
+                    entries.append((key, entry))
+            if not keys:
+                self._by_parent.pop(parent_id, None)
+
+            best = None
+            if entries:
+                sims = np.stack([emb for _, (emb, _) in entries]) @ query_emb
+                i = int(np.argmax(sims))
+                if sims[i] >= self.threshold:
+                    best = (entries[i][1][1], float(sims[i]))
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return best
+
+    def store(self, parent_id: str, query: str, query_emb: np.ndarray, answer: str) -> None:
+        key = (parent_id, normalize_text(query))
+        with self._lock:
+            self._entries[key] = (query_emb, answer)
+            self._by_parent.setdefault(parent_id, set()).add(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "procedures": len(self._by_parent),
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
+
+semantic_answer_cache = SemanticAnswerCache(
+    config.SEMANTIC_CACHE_MAX, config.SEMANTIC_CACHE_TTL, config.SEMANTIC_CACHE_THRESHOLD
+)
+
 def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
     """Fast cosine similarity for normalized vectors"""
     if a is None or b is None:
@@ -263,103 +852,335 @@ def classify_followup(text: str) -> bool:
     # Mặc định coi là follow-up
     return True
 
-def add_popular_procedures_data(name, popular_procedures_data, popular_procedures_path):
-    found = False
-    for proc in popular_procedures_data.get("popular_procedures", []):
-        if proc["name"] == name:
-            proc["total_queries"] += 1
-            found = True
-            break
+def record_procedure_view(parent_id: Optional[str]) -> None:
+    """Count one view of a procedure (in memory; written to disk by the analytics writer)"""
+    obj = procedure_dict.get(parent_id) if parent_id else None
+    if analytics is not None and obj and obj.get("ten_thu_tuc"):
+        analytics.record_view(obj["ten_thu_tuc"])
 
-    if not found:
-        popular_procedures_data.setdefault("popular_procedures", []).append({
-            "name": name,
-            "total_queries": 1
-        })
+class SparseBM25:
+    """Corpus-wide BM25 stored as term -> posting arrays (CSR layout).
 
-    # Ghi đè lại file JSON
-    with open(popular_procedures_path, "w", encoding="utf-8") as f:
-        json.dump(popular_procedures_data, f, ensure_ascii=False, indent=2)
+    Built once from the chunk texts with the shared ``vn_text`` tokenizer, so every
+    posting already carries its full BM25 contribution (idf * saturated tf).
+    Scoring a query is then a few vectorized lookups instead of rebuilding an
+    index per request.
+    """
 
-def add_user_feedback_data(feedback_type, user_feedback_path):
-    # Đọc dữ liệu cũ
-    try:
-        with open(user_feedback_path, "r", encoding="utf-8") as f:
-            user_feedback_data = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        user_feedback_data = {"feedback_summary": {"likes": 0, "dislikes": 0}}
-
-    # Cập nhật
-    if feedback_type == "like":
-        user_feedback_data["feedback_summary"]["likes"] += 1
-    elif feedback_type == "dislike":
-        user_feedback_data["feedback_summary"]["dislikes"] += 1
+    def __init__(self, vocab: Mapping[str, int], offsets: np.ndarray, doc_ids: np.ndarray,
+                 weights: np.ndarray, corpus_size: int):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.corpus_size = corpus_size
+
+    @classmethod
+    def from_texts(cls, texts: List[str], k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25) -> "SparseBM25":
+        """Index chunk texts with ``vn_text.index_terms`` (same scoring as rank_bm25 ``BM25Okapi``)"""
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+        for doc_id, text in enumerate(texts):
+            terms = index_terms(text or "")
+            doc_len[doc_id] = len(terms)
+            freqs: Dict[str, int] = {}
+            for term in terms:
+                freqs[term] = freqs.get(term, 0) + 1
+            for term, tf in freqs.items():
+                ids, tfs = postings.setdefault(term, ([], []))
+                ids.append(doc_id)
+                tfs.append(tf)
+
+        corpus_size = len(texts)
+        avgdl = float(doc_len.mean()) if corpus_size and doc_len.any() else 1.0
+        idf = {term: math.log(corpus_size - len(ids) + 0.5) - math.log(len(ids) + 0.5)
+               for term, (ids, _) in postings.items()}
+        # Như BM25Okapi: idf âm được thay bằng epsilon * idf trung bình
+        floor = epsilon * sum(idf.values()) / len(idf) if idf else 0.0
+
+        vocab: Dict[str, int] = {}
+        offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        doc_ids, weights = [], []
+        for term_id, (term, (ids, tfs)) in enumerate(postings.items()):
+            vocab[term] = term_id
+            offsets[term_id + 1] = offsets[term_id] + len(ids)
+            doc_ids.extend(ids)
+            tf = np.asarray(tfs, dtype=np.float32)
+            norm = k1 * (1 - b + b * doc_len[ids] / avgdl)
+            term_idf = idf[term] if idf[term] >= 0 else floor
+            weights.append(term_idf * tf * (k1 + 1) / (tf + norm))
+
+        return cls(
+            vocab,
+            offsets,
+            np.asarray(doc_ids, dtype=np.int32),
+            np.concatenate(weights).astype(np.float32) if weights else np.zeros(0, dtype=np.float32),
+            corpus_size,
+        )
+
+    @classmethod
+    def from_metas(cls, metas, okapi=None) -> "SparseBM25":
+        """Postings over each chunk's raw text, reusing the pickled index's k1 / b / epsilon"""
+        params = {name: getattr(okapi, name) for name in ("k1", "b", "epsilon") if hasattr(okapi, name)}
+        return cls.from_texts([chunk.get("raw") or chunk.get("text") or "" for chunk in metas], **params)
+
+    def _postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        term_id = self.vocab.get(term)
+        if term_id is None:
+            return self.doc_ids[:0], self.weights[:0]
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.doc_ids[start:end], self.weights[start:end]
+
+    def top_n(self, tokens: Sequence[str], n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-n documents over the whole corpus (only docs matching a token)"""
+        scores = np.zeros(self.corpus_size, dtype=np.float32)
+        for term in tokens:
+            ids, weights = self._postings(term)
+            if len(ids):
+                scores[ids] += weights  # ids are unique within one posting list
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > n:
+            matched = matched[np.argpartition(-scores[matched], n - 1)[:n]]
+        order = np.argsort(-scores[matched], kind="stable")
+        return matched[order], scores[matched[order]]
+
+
+def _dense_candidates(query: str, n: int) -> Tuple[List[int], np.ndarray]:
+    """FAISS candidates (chunk ids, inner-product scores) for the query"""
+    qv = np.array(query_embedding_cache.get(query), dtype=np.float32).reshape(1, -1)
+    with stage("faiss"):
+        D, I = faiss_index.search(qv, n)
+    ids, scores = [], []
+    for i, d in zip(I[0].tolist(), D[0].tolist()):
+        if 0 <= i < len(metadatas):  # FAISS trả -1 khi thiếu kết quả
+            ids.append(i)
+            scores.append(d)
+    return ids, np.asarray(scores, dtype=np.float32)
+
+def _lexical_candidates(query: str, n: int) -> Tuple[List[int], np.ndarray]:
+    """BM25 candidates (chunk ids, scores) over the whole corpus"""
+    if bm25_sparse is None:
+        return [], np.zeros(0, dtype=np.float32)
+    with stage("bm25"):
+        ids, scores = bm25_sparse.top_n(query_terms(query), n)
+    return ids.tolist(), scores
+
+def fuse_rankings(dense: Tuple[List[int], np.ndarray],
+                  lexical: Tuple[List[int], np.ndarray]) -> List[Tuple[int, float]]:
+    """Fuse dense and lexical rankings into one list of (chunk id, score), best first"""
+    dense_ids, dense_scores = dense
+    lex_ids, lex_scores = lexical
+    fused: Dict[int, float] = {}
+
+    if config.FUSION_METHOD == "weighted":
+        # Min-max trong từng danh sách; thiếu ở danh sách nào thì tính 0 ở đó
+        for ids, scores, weight in ((dense_ids, dense_scores, config.FUSION_DENSE_WEIGHT),
+                                    (lex_ids, lex_scores, config.FUSION_BM25_WEIGHT)):
+            for i, s in zip(ids, minmax_scale(scores).tolist()):
+                fused[i] = fused.get(i, 0.0) + weight * s
     else:
-        raise ValueError("feedback_type phải là 'like' hoặc 'dislike'")
+        for ids, weight in ((dense_ids, config.FUSION_DENSE_WEIGHT),
+                            (lex_ids, config.FUSION_BM25_WEIGHT)):
+            for rank, i in enumerate(ids):
+                fused[i] = fused.get(i, 0.0) + weight / (config.RRF_K + rank + 1)
 
-    # Ghi lại file
-    with open(user_feedback_path, "w", encoding="utf-8") as f:
-        json.dump(user_feedback_data, f, ensure_ascii=False, indent=2)
+    # sorted() ổn định: hòa điểm thì ưu tiên thứ tự dense
+    return sorted(fused.items(), key=lambda item: -item[1])
 
-def retrieve_documents(query: str, top_k: int = None) -> List[int]:
-    """Document retrieval using FAISS -> BM25 re-rank"""
-    if top_k is None:
-        top_k = config.TOP_K
+def hybrid_search(query: str, top_n: int) -> List[Tuple[int, float]]:
+    """Parallel FAISS + BM25 candidate generation followed by rank fusion"""
+    lexical_future = retrieval_executor.submit(_lexical_candidates, query, config.BM25_PREFILTER)
 
+    num_candidates = max(config.FAISS_CANDIDATES, top_n * 5)
     try:
-        # Query embedding
-        qv = embedding_model.encode(
-            [query], 
-            convert_to_numpy=True, 
-            normalize_embeddings=True
-        ).astype("float32")
-
-        # FAISS search
-        num_candidates = max(config.FAISS_CANDIDATES, top_k * 5)
-        try:
-            D, I = faiss_index.search(qv, num_candidates)
-            candidate_indices = I[0].tolist()
-        except Exception as e:
-            logger.error(f"Error during FAISS search: {e}")
-            return []
-
-        # Lọc candidate hợp lệ
-        valid_candidate_indices = [
-            i for i in candidate_indices
-            if 0 <= i < len(metadatas) and isinstance(metadatas[i], dict)
-        ]
-
-        # Lấy text từ metadata
-        candidate_docs_text = [
-            metadatas[i].get('text')
-            or metadatas[i].get('raw')
-            or metadatas[i].get('cach_thuc_thuc_hien')
-            or ""
-            for i in valid_candidate_indices
-        ]
-
-        if not any(candidate_docs_text):
-            return valid_candidate_indices[:top_k]
-
-        # BM25 re-rank
-        try:
-            temp_bm25 = BM25Okapi(candidate_docs_text)
-            tokenized_query = query.split()
-            scores = temp_bm25.get_scores(tokenized_query)
-        except Exception as e:
-            logger.error(f"BM25 re-rank error: {e}")
-            return valid_candidate_indices[:top_k]
+        dense = _dense_candidates(query, num_candidates)
+    except Exception as e:
+        logger.error(f"Error during FAISS search: {e}")
+        dense = ([], np.zeros(0, dtype=np.float32))
 
-        # Sắp xếp theo score giảm dần
-        order = np.argsort(-np.array(scores))
-        final = [valid_candidate_indices[i] for i in order[:top_k]]
+    try:
+        lexical = lexical_future.result()
+    except Exception as e:
+        logger.error(f"BM25 candidate error: {e}")
+        lexical = ([], np.zeros(0, dtype=np.float32))
+
+    with stage("fusion"):
+        return fuse_rankings(dense, lexical)[:top_n]
+
+def chunk_parent_id(idx: int) -> Optional[str]:
+    """Parent procedure key of a chunk (same key as parent_id_to_chunks)"""
+    code = chunk_parent_codes[idx]
+    return parent_keys[code] if code >= 0 else None
+
+def pool_by_parent(ranked_chunks: List[Tuple[int, float]], top_k: int) -> List[Tuple[str, float]]:
+    """Aggregate chunk scores per parent_id and return the top_k distinct procedures"""
+    pooled: Dict[str, float] = {}
+    for idx, score in ranked_chunks:
+        parent_id = chunk_parent_id(idx)
+        if not parent_id:
+            continue
+        if config.PARENT_POOLING == "sum":
+            pooled[parent_id] = pooled.get(parent_id, 0.0) + score
+        else:
+            pooled[parent_id] = max(pooled.get(parent_id, score), score)
+
+    # sorted() ổn định: hòa điểm thì giữ thứ tự xuất hiện đầu tiên
+    return sorted(pooled.items(), key=lambda item: -item[1])[:top_k]
 
-        logger.debug(f"Retrieved {len(final)} documents for query: {query[:50]}...")
+def retrieve_procedures(query: str, top_k: int = None) -> List[Tuple[str, float]]:
+    """Hybrid retrieval ranked over procedures: [(parent_id, score)], best first"""
+    if top_k is None:
+        top_k = config.TOP_K
+
+    try:
+        with stage("retrieval"):
+            ranked_chunks = hybrid_search(query, max(config.PARENT_CHUNK_CANDIDATES, top_k))
+            final = pool_by_parent(ranked_chunks, top_k)
+        logger.debug(f"Retrieved {len(final)} procedures for query: {query[:50]}...")
         return final
 
     except Exception as e:
-        logger.error(f"Retrieval failed: {e}")
+        logger.error(f"Procedure retrieval failed: {e}")
+        return []
+
+def max_fused_score() -> float:
+    """Score of a chunk ranked first by both FAISS and BM25"""
+    weights = config.FUSION_DENSE_WEIGHT + config.FUSION_BM25_WEIGHT
+    return weights if config.FUSION_METHOD == "weighted" else weights / (config.RRF_K + 1)
+
+def retrieval_confident(procedures: List[Tuple[str, float]]) -> bool:
+    """Best procedure is top-ranked by both retrievers and clearly ahead of the runner-up"""
+    if not procedures:
+        return False
+    best = procedures[0][1]
+    second = procedures[1][1] if len(procedures) > 1 else 0.0
+    return (best >= config.FAST_PATH_MIN_TOP_SCORE * max_fused_score()
+            and (best - second) / best >= config.FAST_PATH_MIN_MARGIN)
+
+def public_procedure_id(parent_id: str) -> str:
+    return hashlib.sha1(parent_id.encode("utf-8")).hexdigest()[:16]
+
+def name_search_key(text: str) -> str:
+    """Accent-insensitive form used to match procedure names in /search"""
+    return fold(normalize_text(text))
+
+def build_procedure_index(records) -> Tuple[Dict[str, str], Dict[str, str], List[Tuple[str, str]]]:
+    """Public ids and the sorted name list used by /search and /procedure"""
+    public_ids, by_public_id, names = {}, {}, []
+    for parent_id in records:
+        public_id = public_procedure_id(parent_id)
+        public_ids[parent_id] = public_id
+        by_public_id[public_id] = parent_id
+        name = name_search_key(records[parent_id].get("ten_thu_tuc") or "")
+        if name:
+            names.append((name, parent_id))
+    names.sort()
+    logger.info(f"Search index: {len(public_ids)} procedures")
+    return public_ids, by_public_id, names
+
+def prefix_name_matches(query: str, limit: int) -> List[Tuple[str, float]]:
+    """Typeahead over procedure names.
+
+    Names starting with the query come first (binary search on the sorted list),
+    then names containing every typed word, the last one as a prefix.
+    """
+    text = name_search_key(query)
+    words = text.split()
+    if not words:
         return []
+    results: List[Tuple[str, float]] = []
+    seen = set()
+    start = bisect.bisect_left(procedure_names, (text, ""))
+    for name, parent_id in procedure_names[start:]:
+        if not name.startswith(text) or len(results) >= limit:
+            break
+        results.append((parent_id, 1.0))
+        seen.add(parent_id)
+
+    *complete, partial = words
+    for name, parent_id in procedure_names:
+        if len(results) >= limit:
+            break
+        if parent_id in seen:
+            continue
+        name_words = name.split()
+        if all(w in name_words for w in complete) and any(w.startswith(partial) for w in name_words):
+            results.append((parent_id, 0.5))
+    return results
+
+def substring_name_matches(query: str) -> List[Tuple[str, float]]:
+    """Names containing the whole query (what the old in-browser search did)"""
+    text = name_search_key(query)
+    return [(parent_id, 1.0) for name, parent_id in procedure_names if text in name]
+
+search_cache = LRUCache(maxsize=config.SEARCH_CACHE_MAX)
+search_cache_lock = threading.Lock()
+
+def search_procedures(query: str, mode: str = "full") -> List[Tuple[str, float]]:
+    """Ranked [(parent_id, score)] for /search, cached per (mode, normalized query).
+
+    ``full``: exact name matches first, then hybrid BM25 + FAISS retrieval pooled
+    per procedure, cut at SEARCH_MIN_SCORE. ``prefix``: name typeahead only (no
+    embedding call).
+    """
+    key = (mode, normalize_text(query))
+    with search_cache_lock:
+        cached = search_cache.get(key)
+    if cached is not None:
+        return cached
+
+    if mode == "prefix":
+        ranked = prefix_name_matches(query, config.SEARCH_MAX_RESULTS)
+    else:
+        ranked = substring_name_matches(query)[:config.SEARCH_MAX_RESULTS]
+        seen = {parent_id for parent_id, _ in ranked}
+        min_score = config.SEARCH_MIN_SCORE * max_fused_score()
+        for parent_id, score in retrieve_procedures(query, top_k=config.SEARCH_MAX_RESULTS):
+            if score < min_score:
+                break  # điểm giảm dần
+            if parent_id not in seen and parent_id in procedure_dict:
+                ranked.append((parent_id, float(score)))
+                seen.add(parent_id)
+        ranked = ranked[:config.SEARCH_MAX_RESULTS]
+
+    with search_cache_lock:
+        search_cache[key] = ranked
+    return ranked
+
+def project_procedure(parent_id: str, fields: List[str]) -> Dict[str, Any]:
+    obj = procedure_dict.get(parent_id) or {}
+    return {field: obj.get(field, "") for field in fields}
+
+def parse_fields(value: Optional[str], default: List[str]) -> List[str]:
+    """``fields=a,b`` query parameter restricted to FIELD_MAP keys"""
+    if not value:
+        return default
+    fields = [f.strip() for f in value.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in FIELD_MAP]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+def get_procedure_embedding(parent_id: Optional[str], context: str = "") -> Optional[np.ndarray]:
+    """Normalized embedding of a procedure context.
+
+    O(1) row lookup in the precomputed matrix; only encodes ``context`` when the
+    procedure is missing from it.
+    """
+    row = procedure_emb_row.get(parent_id) if parent_id else None
+    if row is not None:
+        return np.asarray(procedure_embeddings[row], dtype=np.float32)
+
+    if not context or len(context) < config.MIN_CONTEXT_LEN_FOR_SIM:
+        return None
+    try:
+        return embedding_model.encode(
+            [context], convert_to_numpy=True, normalize_embeddings=True
+        ).astype("float32")[0]
+    except Exception as e:
+        logger.warning(f"Failed to compute context embedding: {e}")
+        return None
 
 def get_full_procedure_text(parent_id: str) -> str:
     """Get full procedure text by parent ID with caching"""
@@ -367,23 +1188,51 @@ def get_full_procedure_text(parent_id: str) -> str:
         return "Không tìm thấy thủ tục."
     
     cache_key = f"procedure_{parent_id}"
-    if cache_key in embedding_cache:
-        return embedding_cache[cache_key]
+    if cache_key in procedure_text_cache:
+        return procedure_text_cache[cache_key]
     
     obj = procedure_dict.get(parent_id)
     if obj:
-        parts = []
-        for key, value in obj.items():
-            if value and key in FIELD_MAP:
-                parts.append(f"{FIELD_MAP[key]}:\n{value.strip()}")
-                if key == "ten_thu_tuc":
-                    add_popular_procedures_data(value.strip(), popular_procedures_data, popular_procedures_path)
-        result = "\n\n".join(parts) if parts else "Không tìm thấy thông tin chi tiết."
-        embedding_cache[cache_key] = result
+        result = procedure_text(obj)
+        procedure_text_cache[cache_key] = result
         return result
     
     return "Không tìm thấy thủ tục."
 
+def history_context(entry: Dict) -> str:
+    """Procedure text of a history entry, rehydrated from its parent_id"""
+    parent_id = entry.get('parent_id')
+    if not parent_id or parent_id not in procedure_dict:
+        return ""
+    return get_full_procedure_text(parent_id)
+
+def history_context_embedding(entry: Dict) -> Optional[np.ndarray]:
+    """Context embedding of a history entry.
+
+    Precomputed procedures are looked up by parent_id; otherwise the vector is
+    encoded once and kept on the entry (stored as bytes by session_store).
+    """
+    parent_id = entry.get('parent_id')
+    if parent_id in procedure_emb_row:
+        return get_procedure_embedding(parent_id)
+    if entry.get('context_emb') is None:
+        entry['context_emb'] = get_procedure_embedding(parent_id, history_context(entry))
+    return entry['context_emb']
+
+def session_memory_report(history: List[Dict], encoded_bytes: int) -> Dict[str, Any]:
+    """Bytes held by one session's history, by component"""
+    text_bytes = sum(len((entry.get('content') or '').encode('utf-8')) for entry in history)
+    emb_bytes = sum(entry['context_emb'].nbytes for entry in history
+                    if isinstance(entry.get('context_emb'), np.ndarray))
+    return {
+        "entries": len(history),
+        "turns": sum(1 for entry in history if entry.get('role') == 'model'),
+        "text_bytes": text_bytes,
+        "embedding_bytes": emb_bytes,
+        "parent_refs": sorted({entry['parent_id'] for entry in history if entry.get('parent_id')}),
+        "stored_bytes": encoded_bytes,
+    }
+
 class ContextManager:
     """Manages conversation context and follow-up logic"""
     
@@ -400,8 +1249,8 @@ class ContextManager:
         return classify_followup(query)
     
     @staticmethod
-    def get_context_for_query(history: List[Dict], query: str) -> Tuple[str, Optional[str]]:
-        """Get appropriate context for the query"""
+    def get_context_for_query(history: List[Dict], query: str) -> Tuple[str, Optional[str], Optional[bool]]:
+        """(context, parent_id, retrieval_confident); the flag is None when the previous procedure is kept"""
         if not ContextManager.should_reuse_context(history, query):
             # New query - do fresh retrieval
             return ContextManager._fresh_retrieval(query)
@@ -409,7 +1258,7 @@ class ContextManager:
         # Follow-up query - check previous context
         prev_entry = history[-1]
         prev_parent = prev_entry.get('parent_id')
-        prev_context = prev_entry.get('context', '')
+        prev_context = history_context(prev_entry)
         
         if not (prev_parent and prev_context):
             return ContextManager._fresh_retrieval(query)
@@ -418,12 +1267,12 @@ class ContextManager:
         strong_refs = [r"\bnó\b", r"hồ sơ (này|đó)", r"thủ tục (này|đó)"]
         if any(re.search(pattern, query.lower()) for pattern in strong_refs):
             logger.debug(f"Strong follow-up reference detected, reusing context")
-            return prev_context, prev_parent
+            return prev_context, prev_parent, None
         
         # For short queries, prefer reusing context
         if len(query) < config.LONG_QUERY_THRESHOLD:
             logger.debug(f"Short follow-up query, reusing context")
-            return prev_context, prev_parent
+            return prev_context, prev_parent, None
         
         # For longer queries, check similarity
         return ContextManager._check_context_similarity(
@@ -431,59 +1280,48 @@ class ContextManager:
         )
     
     @staticmethod
-    def _fresh_retrieval(query: str) -> Tuple[str, Optional[str]]:
+    def _fresh_retrieval(query: str) -> Tuple[str, Optional[str], Optional[bool]]:
         """Perform fresh document retrieval"""
         try:
-            indices = retrieve_documents(query)
-            if indices:
-                parent_id = metadatas[indices[0]].get("parent_id") or metadatas[indices[0]].get("nguon")
+            procedures = retrieve_procedures(query)
+            if procedures:
+                parent_id, _ = procedures[0]
                 context = get_full_procedure_text(parent_id)
-                return context, parent_id
+                return context, parent_id, retrieval_confident(procedures)
         except Exception as e:
             logger.error(f"Fresh retrieval failed: {e}")
         
-        return "", None
+        return "", None, None
     
     @staticmethod
-    def _check_context_similarity(prev_entry: Dict, prev_context: str, prev_parent: str, query: str) -> Tuple[str, Optional[str]]:
+    def _check_context_similarity(prev_entry: Dict, prev_context: str, prev_parent: str,
+                                  query: str) -> Tuple[str, Optional[str], Optional[bool]]:
         """Check similarity between query and contexts to decide"""
         try:
             query_emb = get_query_embedding_cached(query)
             if query_emb is None:
-                return prev_context, prev_parent
+                return prev_context, prev_parent, None
             
-            # Get or compute previous context embedding
-            prev_context_emb = prev_entry.get('context_emb')
-            if prev_context_emb is None and len(prev_context) >= config.MIN_CONTEXT_LEN_FOR_SIM:
-                try:
-                    prev_context_emb = embedding_model.encode(
-                        [prev_context], convert_to_numpy=True, normalize_embeddings=True
-                    ).astype("float32")[0]
-                    prev_entry['context_emb'] = prev_context_emb
-                except Exception as e:
-                    logger.warning(f"Failed to embed previous context: {e}")
-                    return prev_context, prev_parent
+            # Previous context embedding (row lookup, or encoded once per entry)
+            prev_context_emb = history_context_embedding(prev_entry)
             
-            # Get candidate from retrieval
-            indices = retrieve_documents(query)
-            if not indices:
-                return prev_context, prev_parent
+            # Get candidate from retrieval (một lần, đã gộp theo thủ tục)
+            procedures = retrieve_procedures(query)
+            if not procedures:
+                return prev_context, prev_parent, None
             
-            candidate_parent = metadatas[indices[0]].get("parent_id") or metadatas[indices[0]].get("nguon")
-            if not candidate_parent or candidate_parent == prev_parent:
-                return prev_context, prev_parent
+            candidate_parent, _ = procedures[0]
+            if candidate_parent == prev_parent:
+                return prev_context, prev_parent, None
             
             # Get candidate context and embedding
             candidate_context = get_full_procedure_text(candidate_parent)
             if len(candidate_context) < config.MIN_CONTEXT_LEN_FOR_SIM:
-                return prev_context, prev_parent
+                return prev_context, prev_parent, None
             
-            try:
-                candidate_emb = embedding_model.encode(
-                    [candidate_context], convert_to_numpy=True, normalize_embeddings=True
-                ).astype("float32")[0]
-            except Exception:
-                return prev_context, prev_parent
+            candidate_emb = get_procedure_embedding(candidate_parent, candidate_context)
+            if candidate_emb is None:
+                return prev_context, prev_parent, None
             
             # Compare similarities
             sim_prev = cosine_similarity(query_emb, prev_context_emb) if prev_context_emb is not None else 0.0
@@ -493,26 +1331,110 @@ class ContextManager:
             if (sim_candidate >= config.CONTEXT_SIM_THRESHOLD and 
                 (sim_candidate - sim_prev) > config.SWITCH_MARGIN):
                 logger.info(f"Switched context: sim_prev={sim_prev:.3f}, sim_candidate={sim_candidate:.3f}")
-                return candidate_context, candidate_parent
+                return candidate_context, candidate_parent, retrieval_confident(procedures)
             else:
                 logger.debug(f"Kept previous context: sim_prev={sim_prev:.3f}, sim_candidate={sim_candidate:.3f}")
-                return prev_context, prev_parent
+                return prev_context, prev_parent, None
                 
         except Exception as e:
             logger.error(f"Context similarity check failed: {e}")
-            return prev_context, prev_parent
-
-def build_prompt(history: List[Dict], context: str, query: str) -> str:
-    """Build optimized prompt"""
-    if history:
-        history_str = "\n".join([
-            f"{item.get('role', 'unknown')}: {item.get('content', '')}" 
-            for item in history[-10:]  # Limit history to last 10 entries
-        ])
-    else:
-        history_str = ""
+            return prev_context, prev_parent, None
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate for budgeting; no tokenizer round-trip"""
+    return int(len(text) / config.PROMPT_CHARS_PER_TOKEN) + 1
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    max_chars = int(max_tokens * config.PROMPT_CHARS_PER_TOKEN)
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max(0, max_chars - 1)]
+    return (cut.rsplit(" ", 1)[0] if " " in cut else cut) + "…"
+
+def select_procedure_context(parent_id: Optional[str], context: str, query: str,
+                             max_tokens: int) -> Tuple[str, List[str]]:
+    """Context limited to the sections relevant to ``query`` and to ``max_tokens``.
+
+    Sections the question asks about come first and share the budget; when none
+    match, every section is kept and the longest ones are truncated.
+    """
+    obj = procedure_dict.get(parent_id) if parent_id else None
+    if not obj:
+        return truncate_to_tokens(context, max_tokens), []
+
+    asked = question_fields(query)
+    fields = list(CONTEXT_BASE_FIELDS) + asked if asked else list(FIELD_MAP)
+    sections = [(field, f"{FIELD_MAP[field]}:\n{obj[field].strip()}")
+                for field in FIELD_MAP if field in fields and obj.get(field) and obj[field].strip()]
+
+    # Cắt đều: phần ngắn giữ nguyên, phần dài chia nhau ngân sách còn lại
+    remaining = max_tokens
+    sizes = {field: estimate_tokens(text) for field, text in sections}
+    limits = {}
+    for i, (field, _) in enumerate(sorted(sections, key=lambda s: sizes[s[0]])):
+        share = remaining // (len(sections) - i)
+        limits[field] = min(sizes[field], share)
+        remaining -= limits[field]
+    parts = [truncate_to_tokens(text, limits[field]) for field, text in sections]
+    return "\n\n".join(parts), [field for field, _ in sections]
+
+def render_field_answer(parent_id: str, field: str) -> Optional[str]:
+    """Templated answer with one section of the procedure and its source link"""
+    obj = procedure_dict.get(parent_id) or {}
+    value = (obj.get(field) or "").strip()
+    name = (obj.get("ten_thu_tuc") or "").strip()
+    link = (obj.get("nguon") or "").strip()
+    if not value or not link:
+        return None
+    if field == "nguon":
+        return f"Thông tin đầy đủ về thủ tục **{name}** có tại: [{link}]({link})"
+    return f"**{FIELD_MAP[field]}** của thủ tục **{name}**:\n\n{value}\n\nNguồn: [{link}]({link})"
+
+def fast_path_answer(query: str, parent_id: Optional[str],
+                     confident_retrieval: Optional[bool] = None) -> Optional[Tuple[str, str, float]]:
+    """(answer, field, confidence) when the question maps to one section with high confidence.
+
+    ``confident_retrieval`` is ``retrieval_confident`` for a freshly resolved
+    procedure (None for a follow-up on the previous one): an ambiguous retrieval
+    never takes the fast path.
+    """
+    if confident_retrieval is False:
+        return None
+    obj = procedure_dict.get(parent_id) if parent_id else None
+    if not obj:
+        return None
+    field, confidence = classify_field_intent(query, obj.get("ten_thu_tuc") or "", config.FAST_PATH_MAX_QUERY_CHARS)
+    if field is None or confidence < config.FAST_PATH_MIN_CONFIDENCE:
+        return None
+    answer = render_field_answer(parent_id, field)
+    return (answer, field, confidence) if answer else None
+
+def history_for_prompt(history: List[Dict], max_tokens: int) -> str:
+    """Most recent turns that fit ``max_tokens``; long answers are shortened"""
+    lines: List[str] = []
+    used = 0
+    for item in reversed(history[-config.PROMPT_HISTORY_ITEMS:]):
+        content = item.get('content', '') or ''
+        if len(content) > config.PROMPT_HISTORY_ITEM_CHARS:
+            content = content[:config.PROMPT_HISTORY_ITEM_CHARS].rsplit(" ", 1)[0] + "…"
+        line = f"{item.get('role', 'unknown')}: {content}"
+        cost = estimate_tokens(line)
+        if used + cost > max_tokens:
+            break
+        lines.append(line)
+        used += cost
+    return "\n".join(reversed(lines))
+
+PROMPT_TEMPLATE_TOKENS = 250  # instructions + labels of the template below
+
+def build_prompt(history: List[Dict], context: str, query: str, parent_id: Optional[str] = None) -> str:
+    """Build the prompt within Config.PROMPT_TOKEN_BUDGET (history, then question-relevant context)"""
+    history_str = history_for_prompt(history, config.PROMPT_HISTORY_TOKENS) if history else ""
+    context_budget = (config.PROMPT_TOKEN_BUDGET - PROMPT_TEMPLATE_TOKENS
+                      - estimate_tokens(history_str) - estimate_tokens(query))
+    context, fields = select_procedure_context(parent_id, context, query, max(context_budget, 200))
     
-    return f"""Bạn là trợ lý eGov-Bot chuyên về dịch vụ công Việt Nam. Trả lời tiếng Việt, chính xác, dựa TRỌN VẸN vào DỮ LIỆU được cung cấp (nếu có). Luôn đính kèm các Nguồn (đường link) xuất hiện trong dữ liệu ở cuối.
+    prompt = f"""Bạn là trợ lý eGov-Bot chuyên về dịch vụ công Việt Nam. Trả lời tiếng Việt, chính xác, dựa TRỌN VẸN vào DỮ LIỆU được cung cấp (nếu có). Luôn đính kèm các Nguồn (đường link) xuất hiện trong dữ liệu ở cuối.
 Nếu KHÔNG tìm thấy thông tin rõ ràng trong DỮ LIỆU, trả lời: "Mình chưa có thông tin về [chủ đề]. Bạn hãy ghi rõ Thủ tục [chủ đề] để mình tìm chính xác hơn. Hoặc bạn có thể tham khảo thêm tại: [Cổng dịch vụ công quốc gia](https://dichvucong.gov.vn/p/home/dvc-trang-chu.html)".
 Lịch sử trò chuyện:
 {history_str}
@@ -522,29 +1444,19 @@ DỮ LIỆU (nếu có):
 ---
 CÂU HỎI: {query}
 TRẢ LỜI (rõ ràng, ngắn gọn, nếu cần liệt kê thành phần/điểm, hãy dùng bullets):"""
+    logger.info(f"Prompt tokens≈{estimate_tokens(prompt)} (context≈{estimate_tokens(context)}, "
+                f"history≈{estimate_tokens(history_str)}, fields={fields or 'raw'})")
+    return prompt
 
-def store_conversation_entry(history: List[Dict], query: str, response: str, 
-                           context: str, parent_id: Optional[str]) -> None:
-    """Store conversation entry with context embedding"""
-    # Compute context embedding for future similarity checks
-    context_emb = None
-    if context and len(context) >= config.MIN_CONTEXT_LEN_FOR_SIM:
-        try:
-            context_emb = embedding_model.encode(
-                [context], convert_to_numpy=True, normalize_embeddings=True
-            ).astype("float32")[0]
-        except Exception as e:
-            logger.warning(f"Failed to compute context embedding: {e}")
-    
-    # Add entries to history
+def store_conversation_entry(history: List[Dict], query: str, response: str,
+                             parent_id: Optional[str]) -> None:
+    """Store one exchange; the context is kept as a parent_id reference only"""
     history.extend([
         {'role': 'user', 'content': query},
         {
             'role': 'model',
             'content': response,
-            'context': context,
-            'parent_id': parent_id,
-            'context_emb': context_emb
+            'parent_id': parent_id
         }
     ])
     
@@ -552,29 +1464,484 @@ def store_conversation_entry(history: List[Dict], query: str, response: str,
     if len(history) > 20:
         history[:] = history[-20:]
 
+# Per-request metrics (per-stage durations: egov_stage_seconds in metrics.py)
+chat_requests = registry.counter("egov_chat_requests_total", "Answered /chat requests by answer source and outcome")
+chat_latency = registry.histogram("egov_chat_latency_seconds", "End-to-end /chat latency by answer source")
+chat_ttft = registry.histogram("egov_chat_ttft_seconds", "Time to first token of streamed /chat answers")
+answer_cache_lookups = registry.counter("egov_answer_cache_lookups_total", "Exact answer cache lookups by result")
+
+class ChatTurn:
+    """State of one /chat request, shared by the Flask and ASGI handlers"""
+
+    def __init__(self, data: Dict[str, Any]):
+        self.start_time = time.perf_counter()
+        self.user_query = (data.get('question') or '').strip()
+        self.session_id = data.get('session_id', 'default')
+        self.use_stream = data.get('stream', False)
+        self.history: List[Dict] = []
+        self.cache_key = ""
+        self.cached_answer: Optional[str] = None
+        self.context = ""
+        self.parent_id: Optional[str] = None
+        self.confident_retrieval: Optional[bool] = None  # None: procedure kept from the previous turn
+        self.prompt = ""
+        self.fresh = False  # not a follow-up of the previous turn
+        self.allow_fast_path = config.FAST_PATH_ENABLED and data.get('fast_path', True) is not False
+        self.answer_source = "llm"  # llm | cache | semantic_cache | fast_path
+        self.first_token_at: Optional[float] = None
+        self.timings: Dict[str, float] = {}  # stage -> ms, returned to the client
+
+    def latency_ms(self) -> int:
+        return int((time.perf_counter() - self.start_time) * 1000)
+
+    def semantic_cacheable(self) -> bool:
+        return config.SEMANTIC_CACHE_ENABLED and self.fresh and bool(self.parent_id)
+
+    def mark_first_token(self) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    def ttft_ms(self) -> Optional[int]:
+        """Time to first token sent to the client"""
+        if self.first_token_at is None:
+            return None
+        return int((self.first_token_at - self.start_time) * 1000)
+
+    def record_metrics(self, outcome: str = "ok") -> None:
+        """Count the request and observe its latency (call once, when the answer is complete)"""
+        chat_requests.inc(answer_source=self.answer_source, outcome=outcome)
+        chat_latency.observe(time.perf_counter() - self.start_time, answer_source=self.answer_source)
+        if self.first_token_at is not None:
+            chat_ttft.observe(self.first_token_at - self.start_time)
+
+def prepare_chat_turn(turn: ChatTurn) -> None:
+    """Session history, answer cache lookup, context retrieval and prompt building"""
+    # Session history (empty for a new or expired session)
+    with stage("session_load", turn.timings):
+        turn.history = session_store.get_history(turn.session_id)
+
+    # Check cache first
+    last_parent = turn.history[-1].get('parent_id', '') if turn.history else ""
+    turn.cache_key = cache_key_for_query(turn.user_query, session_id=turn.session_id, parent_id=str(last_parent))
+
+    with stage("answer_cache", turn.timings):
+        turn.cached_answer = session_store.get_answer(turn.cache_key)
+    answer_cache_lookups.inc(result="hit" if turn.cached_answer is not None else "miss")
+    if turn.cached_answer is not None:
+        turn.parent_id, turn.answer_source = last_parent or None, "cache"
+        record_procedure_view(turn.parent_id)
+        store_conversation_entry(turn.history, turn.user_query, turn.cached_answer, last_parent or None)
+        session_store.save_history(turn.session_id, turn.history)
+        return
+
+    # Get context for the query
+    turn.fresh = not ContextManager.should_reuse_context(turn.history, turn.user_query)
+    try:
+        with stage("context", turn.timings):
+            turn.context, turn.parent_id, turn.confident_retrieval = ContextManager.get_context_for_query(
+                turn.history, turn.user_query)
+    except Exception as e:
+        logger.error(f"Context retrieval failed: {e}")
+        turn.context, turn.parent_id = "", None
+
+    # Một lượt xem cho mỗi câu hỏi xác định được thủ tục (kể cả câu hỏi lặp lại)
+    record_procedure_view(turn.parent_id)
+
+    # Question asks for exactly one section of the resolved procedure
+    if turn.allow_fast_path:
+        with stage("fast_path", turn.timings):
+            fast = fast_path_answer(turn.user_query, turn.parent_id, turn.confident_retrieval)
+        if fast is not None:
+            turn.cached_answer, field, confidence = fast
+            turn.answer_source = "fast_path"
+            logger.info(f"Fast path: parent_id={turn.parent_id}, field={field}, confidence={confidence:.2f}")
+            store_conversation_entry(turn.history, turn.user_query, turn.cached_answer, turn.parent_id)
+            session_store.save_history(turn.session_id, turn.history)
+            return
+
+    # Same procedure, near-identical fresh question from any session
+    if turn.semantic_cacheable():
+        with stage("semantic_cache", turn.timings):
+            query_emb = get_query_embedding_cached(turn.user_query)
+            hit = semantic_answer_cache.lookup(turn.parent_id, query_emb) if query_emb is not None else None
+        if hit is not None:
+            turn.cached_answer, similarity = hit
+            turn.answer_source = "semantic_cache"
+            logger.info(f"Semantic cache hit: parent_id={turn.parent_id}, similarity={similarity:.3f}")
+            session_store.set_answer(turn.cache_key, turn.cached_answer)
+            store_conversation_entry(turn.history, turn.user_query, turn.cached_answer, turn.parent_id)
+            session_store.save_history(turn.session_id, turn.history)
+            return
+
+    # Build prompt
+    with stage("prompt", turn.timings):
+        turn.prompt = build_prompt(turn.history, turn.context, turn.user_query, turn.parent_id)
+
+def complete_chat_turn(turn: ChatTurn, answer: str, cacheable: bool = True) -> None:
+    """Cache the answer and store the exchange in the session history.
+
+    ``cacheable=False`` (an answer cut off by an error) only stores the history.
+    """
+    with stage("store", turn.timings):
+        if cacheable:
+            session_store.set_answer(turn.cache_key, answer)
+            if turn.semantic_cacheable():
+                query_emb = get_query_embedding_cached(turn.user_query)
+                if query_emb is not None:
+                    semantic_answer_cache.store(turn.parent_id, turn.user_query, query_emb, answer)
+        store_conversation_entry(turn.history, turn.user_query, answer, turn.parent_id)
+        session_store.save_history(turn.session_id, turn.history)
+
+def cached_payload(turn: ChatTurn) -> Dict[str, Any]:
+    """Answer ready without an LLM call (answer caches or fast path)"""
+    turn.record_metrics()
+    return {
+        "answer": turn.cached_answer,
+        "cached": turn.answer_source != "fast_path",
+        "answer_source": turn.answer_source,
+        "latency_ms": turn.latency_ms(),
+        "timings": turn.timings,
+        "context_source": turn.parent_id
+    }
+
+def answer_payload(turn: ChatTurn, answer: str) -> Dict[str, Any]:
+    turn.record_metrics()
+    return {
+        "answer": answer,
+        "cached": False,
+        "answer_source": turn.answer_source,
+        "latency_ms": turn.latency_ms(),
+        "timings": turn.timings,
+        "context_source": turn.parent_id
+    }
+
+def error_payload(turn: ChatTurn, e: Exception) -> Dict[str, Any]:
+    # Log the error and return appropriate response
+    logger.error(f"LLM generation failed: {e}")
+    turn.record_metrics(outcome="error")
+    return {
+        "answer": f"Xin lỗi, đã có lỗi xảy ra: {str(e)}",
+        "cached": False,
+        "latency_ms": turn.latency_ms(),
+        "timings": turn.timings,
+        "context_source": turn.parent_id,
+        "error": True
+    }
+
+def generate_answer(prompt: str, timings: Optional[Dict[str, float]] = None) -> str:
+    """Blocking Gemini call on the least-used healthy key"""
+    if not generation_pool:
+        raise RuntimeError("Generation model not available. Check GOOGLE_API_KEY.")
+    with stage("llm", timings):
+        response = generation_pool.generate(prompt)
+    return getattr(response, "text", str(response))
+
+async def generate_answer_async(prompt: str, timings: Optional[Dict[str, float]] = None) -> str:
+    """Non-blocking Gemini call (async client), same key routing as generate_answer"""
+    if not generation_pool:
+        raise RuntimeError("Generation model not available. Check GOOGLE_API_KEY.")
+    with stage("llm", timings):
+        response = await generation_pool.generate_async(prompt)
+    return getattr(response, "text", str(response))
+
+def continuation_prompt(prompt: str, partial: str) -> str:
+    """Prompt asking a fallback model to continue an answer that was cut off mid-stream"""
+    return f"""{prompt}
+{partial}
+
+(Phần trả lời ở trên đã được gửi cho người dùng nhưng bị ngắt giữa chừng. Hãy viết TIẾP ngay từ chỗ bị ngắt, KHÔNG lặp lại nội dung đã có.)"""
+
+class StreamAssembler:
+    """Accumulates streamed text across model failover without re-emitting it.
+
+    After a failover the fallback model continues from ``text``; its first
+    ``RESUME_OVERLAP_WINDOW`` characters are buffered so any part that repeats the
+    tail of what the client already has can be trimmed before emitting.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pending = ""
+        self._resuming = False
+
+    def resume(self) -> None:
+        self._resuming = bool(self.text)
+        self._pending = ""
+
+    def _trim(self, new_text: str) -> str:
+        if new_text.startswith(self.text):
+            return new_text[len(self.text):]
+        window = min(len(self.text), len(new_text), config.RESUME_OVERLAP_WINDOW)
+        for size in range(window, config.RESUME_MIN_OVERLAP - 1, -1):
+            if self.text.endswith(new_text[:size]):
+                return new_text[size:]
+        return new_text
+
+    def feed(self, chunk_text: str) -> str:
+        """Text of this chunk that should be sent to the client"""
+        if self._resuming:
+            self._pending += chunk_text
+            if len(self._pending) < config.RESUME_OVERLAP_WINDOW:
+                return ""
+            chunk_text, self._pending, self._resuming = self._trim(self._pending), "", False
+        self.text += chunk_text
+        return chunk_text
+
+    def flush(self) -> str:
+        if not self._resuming:
+            return ""
+        chunk_text, self._pending, self._resuming = self._trim(self._pending), "", False
+        self.text += chunk_text
+        return chunk_text
+
+def _stream_finished(turn: ChatTurn, assembler: StreamAssembler, error: Optional[Exception], attempts: int,
+                     llm_start: float):
+    """Final events of a stream; caches and stores the answer when there is one"""
+    observe_stage("llm", time.perf_counter() - llm_start, turn.timings)
+    if assembler.text:
+        complete_chat_turn(turn, assembler.text, cacheable=error is None)
+    logger.info(f"Stream finished: ttft_ms={turn.ttft_ms()}, latency_ms={turn.latency_ms()}, "
+                f"chars={len(assembler.text)}, attempts={attempts}, error={error is not None}")
+    turn.record_metrics(outcome="ok" if error is None else "error")
+    if error is not None:
+        yield "error", {"message": str(error), "partial": bool(assembler.text)}
+    else:
+        yield "done", {"latency_ms": turn.latency_ms(), "ttft_ms": turn.ttft_ms(), "failover": attempts > 1,
+                       "timings": turn.timings}
+
+def stream_events(turn: ChatTurn):
+    """Yield (event, data) for a streamed answer: meta, token*, then done or error.
+
+    If a model fails mid-stream the next one continues the answer instead of
+    restarting it, so the client never receives the same text twice.
+    """
+    yield "meta", {"context_source": turn.parent_id, "cached": False, "answer_source": "llm"}
+
+    assembler = StreamAssembler()
+    error: Optional[Exception] = None
+    attempts = 0
+    llm_start = time.perf_counter()
+    try:
+        if not generation_pool:
+            raise NoAvailableKeyError("Generation model not available. Check GOOGLE_API_KEY.")
+        for attempts, key in enumerate(generation_pool.candidates(), 1):
+            assembler.resume()
+            prompt = continuation_prompt(turn.prompt, assembler.text) if assembler.text else turn.prompt
+            start = time.perf_counter()
+            try:
+                for chunk in key.model.generate_content(prompt, stream=True):
+                    text = assembler.feed(getattr(chunk, "text", ""))
+                    if text:
+                        turn.mark_first_token()
+                        yield "token", {"text": text}
+                text = assembler.flush()
+                if text:
+                    turn.mark_first_token()
+                    yield "token", {"text": text}
+            except Exception as e:
+                logger.warning(f"Stream on {key.name} failed after {len(assembler.text)} chars")
+                generation_pool.record_failure(key, e)
+                error = e
+                if not is_retryable_error(e):
+                    break
+                continue
+            generation_pool.record_success(key, time.perf_counter() - start)
+            error = None
+            break
+    except NoAvailableKeyError as e:
+        error = e
+
+    yield from _stream_finished(turn, assembler, error, attempts, llm_start)
+
+async def stream_events_async(turn: ChatTurn, executor=None):
+    """Async counterpart of stream_events using the async Gemini client.
+
+    The final answer is cached and stored on ``executor`` (session store I/O and a
+    possible query encode must not block the event loop).
+    """
+    yield "meta", {"context_source": turn.parent_id, "cached": False, "answer_source": "llm"}
+
+    assembler = StreamAssembler()
+    error: Optional[Exception] = None
+    attempts = 0
+    llm_start = time.perf_counter()
+    try:
+        if not generation_pool:
+            raise NoAvailableKeyError("Generation model not available. Check GOOGLE_API_KEY.")
+        async for key in generation_pool.candidates_async():
+            attempts += 1
+            assembler.resume()
+            prompt = continuation_prompt(turn.prompt, assembler.text) if assembler.text else turn.prompt
+            start = time.perf_counter()
+            try:
+                async for chunk in await key.async_model().generate_content_async(prompt, stream=True):
+                    text = assembler.feed(getattr(chunk, "text", ""))
+                    if text:
+                        turn.mark_first_token()
+                        yield "token", {"text": text}
+                text = assembler.flush()
+                if text:
+                    turn.mark_first_token()
+                    yield "token", {"text": text}
+            except Exception as e:
+                logger.warning(f"Stream on {key.name} failed after {len(assembler.text)} chars")
+                generation_pool.record_failure(key, e)
+                error = e
+                if not is_retryable_error(e):
+                    break
+                continue
+            generation_pool.record_success(key, time.perf_counter() - start)
+            error = None
+            break
+    except NoAvailableKeyError as e:
+        error = e
+
+    events = await asyncio.get_running_loop().run_in_executor(
+        executor, lambda: list(_stream_finished(turn, assembler, error, attempts, llm_start)))
+    for event in events:
+        yield event
+
+def cached_events(turn: ChatTurn):
+    """Event sequence for an answer ready without an LLM call"""
+    yield "meta", {"context_source": turn.parent_id, "cached": turn.answer_source != "fast_path",
+                   "answer_source": turn.answer_source}
+    turn.mark_first_token()
+    yield "token", {"text": turn.cached_answer}
+    turn.record_metrics()
+    yield "done", {"latency_ms": turn.latency_ms(), "ttft_ms": turn.ttft_ms(), "failover": False,
+                   "timings": turn.timings}
+
+def sse_format(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def plain_text(event: str, data: Dict[str, Any]) -> str:
+    """Legacy text/plain stream: only answer text, errors inline"""
+    if event == "token":
+        return data["text"]
+    if event == "error":
+        return f"Error: {data['message']}"
+    return ""
+
+def wants_sse(data: Dict[str, Any], accept: str) -> bool:
+    """SSE framing when asked for with stream="sse" or Accept: text/event-stream"""
+    return data.get('stream') == "sse" or (bool(data.get('stream')) and "text/event-stream" in (accept or ""))
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
 # Flask application
 app = Flask(__name__)
 CORS(app, origins=["*"])
 
-# Session storage
-chat_histories: Dict[str, List[Dict]] = {}
 
 @app.route("/health", methods=["GET"])
 def health():
-    """Health check endpoint"""
+    """Health check endpoint (staged readiness with per-component timings)"""
     return jsonify({
         "status": "ok",
         "timestamp": time.time(),
+        **startup.snapshot(),
         "faiss_loaded": faiss_index is not None,
         "embedding_model_loaded": embedding_model is not None,
-        "generation_model_loaded": generation_model is not None,
-        "generation_model_2_loaded": generation_model_2 is not None
+        "embedding_backend": embedding_backend,
+        "generation_model_loaded": bool(generation_pool),
+        "llm_keys": generation_pool.stats() if generation_pool else [],
+        "semantic_cache": semantic_answer_cache.stats(),
+        "session_store": session_store.stats(),
+        "analytics": analytics.stats() if analytics is not None else None
     })
 
+@app.route("/health/live", methods=["GET"])
+def health_live():
+    """Liveness: process is up and startup has not failed"""
+    if startup.failed:
+        return jsonify({"status": "failed", **startup.snapshot()}), 500
+    return jsonify({"status": "alive"})
+
+@app.route("/health/ready", methods=["GET"])
+def health_ready():
+    """Readiness: all resources loaded, safe to route traffic"""
+    if not startup.ready:
+        return jsonify({"status": "starting", **startup.snapshot()}), 503
+    return jsonify({"status": "ready", **startup.snapshot()})
+
+@registry.register_collector
+def component_metrics():
+    """Gauges read from the caches, stores and key pool at scrape time"""
+    yield "egov_ready", "gauge", "1 once all startup stages are done", {}, int(startup.ready)
+    emb = query_embedding_cache.stats()
+    yield "egov_query_embedding_cache_entries", "gauge", "Cached query embeddings", {}, emb["entries"]
+    yield "egov_query_embedding_cache_bytes", "gauge", "Bytes held by the query embedding cache", {}, emb["bytes"]
+    for result, field in (("hit", "hits"), ("miss", "misses")):
+        yield "egov_query_embedding_cache_lookups_total", "counter", "Query embedding cache lookups", \
+            {"result": result}, emb[field]
+    sem = semantic_answer_cache.stats()
+    yield "egov_semantic_cache_entries", "gauge", "Answers in the semantic cache", {}, sem["entries"]
+    for result, field in (("hit", "hits"), ("miss", "misses")):
+        yield "egov_semantic_cache_lookups_total", "counter", "Semantic answer cache lookups", \
+            {"result": result}, sem[field]
+    yield "egov_procedure_text_cache_entries", "gauge", "Assembled procedure texts in memory", {}, \
+        len(procedure_text_cache)
+    sessions = session_store.stats()
+    for field in ("sessions", "session_bytes", "answers", "keys"):
+        if field in sessions:
+            yield f"egov_session_store_{field}", "gauge", f"Session store {field}", \
+                {"backend": sessions["backend"]}, sessions[field]
+    if embedding_batcher is not None:
+        yield "egov_embedding_batches_total", "counter", "Batches encoded by the embedding batcher", {}, \
+            embedding_batcher.batches
+        yield "egov_embedding_batch_items_total", "counter", "Queries encoded by the embedding batcher", {}, \
+            embedding_batcher.items
+    for key in (generation_pool.stats() if generation_pool else []):
+        labels = {"key": key["key"]}
+        yield "egov_llm_requests_total", "counter", "Gemini calls per API key", labels, key["requests"]
+        yield "egov_llm_failures_total", "counter", "Failed Gemini calls per API key", labels, key["failures"]
+        yield "egov_llm_rate_limited_total", "counter", "Rate-limited Gemini calls per API key", labels, \
+            key["rate_limited"]
+        yield "egov_llm_remaining_daily_quota", "gauge", "Requests left today per API key", labels, \
+            key["remaining_daily_quota"]
+        yield "egov_llm_breaker_open", "gauge", "1 while the key's circuit breaker is not closed", labels, \
+            int(key["state"] != CircuitBreaker.CLOSED)
+    yield "egov_analytics_pending_events", "gauge", "Views / feedback not yet flushed to SQLite", {}, \
+        analytics.stats()["pending_events"] if analytics is not None else None
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus text exposition format (per worker process)"""
+    return Response(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Sampling profiler, bật bằng PROFILER_INTERVAL_MS > 0 (tốn CPU, chỉ dùng khi điều tra)
+stack_sampler = StackSampler(config.PROFILER_INTERVAL_MS / 1000.0) if config.PROFILER_INTERVAL_MS > 0 else None
+
+def debug_authorized() -> bool:
+    """Diagnostics endpoints: enabled by DEBUG_TOKEN, called with a matching X-Debug-Token"""
+    token = request.headers.get("X-Debug-Token", "")
+    return bool(config.DEBUG_TOKEN) and hmac.compare_digest(token.encode("utf-8"), config.DEBUG_TOKEN.encode("utf-8"))
+
+@app.route("/debug/profile", methods=["GET"])
+def debug_profile():
+    """Folded stacks (flamegraph.pl / speedscope): ?limit=200&reset=1"""
+    if not debug_authorized():
+        abort(404)
+    if stack_sampler is None:
+        return jsonify({"error": "Profiler disabled, set PROFILER_INTERVAL_MS"}), 404
+    try:
+        limit = int(request.args.get("limit", 0)) or None
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    reset = request.args.get("reset") in ("1", "true")
+    return Response(stack_sampler.folded(limit, reset), content_type="text/plain; charset=utf-8")
+
+def not_ready_response():
+    return jsonify({
+        "error": "Service is starting, please retry shortly",
+        "ready": False,
+    }), 503
+
 @app.route("/chat", methods=["POST"])
 def chat():
     """Main chat endpoint with optimized processing"""
-    start_time = time.perf_counter()
+    if not startup.ready:
+        return not_ready_response()
     
     # Parse and validate request
     try:
@@ -582,149 +1949,74 @@ def chat():
     except Exception as e:
         return jsonify({"error": "Invalid JSON", "detail": str(e)}), 400
     
-    user_query = data.get('question', '').strip()
-    if not user_query:
+    turn = ChatTurn(data)
+    if not turn.user_query:
         return jsonify({"error": "No question provided"}), 400
+    use_sse = wants_sse(data, request.headers.get("Accept", ""))
     
-    session_id = data.get('session_id', 'default')
-    use_stream = data.get('stream', False)
-    
-    # Initialize or get session history
-    if session_id not in chat_histories:
-        chat_histories[session_id] = []
+    # Cache lookup, context retrieval and prompt building
+    prepare_chat_turn(turn)
+    if turn.cached_answer is not None:
+        if use_sse:
+            return Response((sse_format(*e) for e in cached_events(turn)),
+                            mimetype='text/event-stream', headers=SSE_HEADERS)
+        return jsonify(cached_payload(turn))
     
-    current_history = chat_histories[session_id]
-    
-    # Check cache first
-    last_parent = current_history[-1].get('parent_id', '') if current_history else ""
-    cache_key = cache_key_for_query(user_query, session_id=session_id, parent_id=str(last_parent))
-    
-    if cache_key in answer_cache:
-        cached_response = answer_cache[cache_key]
-        store_conversation_entry(current_history, user_query, cached_response, 'FROM_CACHE', last_parent)
-        return jsonify({"answer": cached_response, "cached": True})
-    
-    # Get context for the query
-    try:
-        context, used_parent_id = ContextManager.get_context_for_query(current_history, user_query)
-    except Exception as e:
-        logger.error(f"Context retrieval failed: {e}")
-        context, used_parent_id = "", None
-    
-    # Build prompt
-    prompt = build_prompt(current_history, context, user_query)
+    if use_sse:
+        # Server-Sent Events: meta, token*, done | error
+        return Response((sse_format(*e) for e in stream_events(turn)),
+                        mimetype='text/event-stream', headers=SSE_HEADERS)
     
     try:
-        if generation_model is None:
+        if not generation_pool:
             raise RuntimeError("Generation model not available. Check GOOGLE_API_KEY.")
         
-        if not use_stream:
+        if not turn.use_stream:
             # Non-streaming response
-            try:
-                response = generation_model.generate_content(prompt)
-                final_answer = getattr(response, "text", str(response))
-            except Exception as e:
-                # Check if it's a 429 quota error and fallback to model 2
-                if "429" in str(e) or "quota" in str(e).lower():
-                    if generation_model_2 is not None:
-                        response = generation_model_2.generate_content(prompt)
-                        final_answer = getattr(response, "text", str(response))
-                    else:
-                        raise RuntimeError("Primary model quota exceeded and fallback model not available.")
-                else:
-                    raise e
-            
-            # Cache the response
-            answer_cache[cache_key] = final_answer
-            
-            # Store in conversation history
-            store_conversation_entry(current_history, user_query, final_answer, context, used_parent_id)
-            
-            processing_time = int((time.perf_counter() - start_time) * 1000)
-            
-            return jsonify({
-                "answer": final_answer,
-                "cached": False,
-                "latency_ms": processing_time,
-                "context_source": used_parent_id
-            })
-        
-        else:
-            # Streaming response
-            def generate_stream():
-                full_response = ""
-                current_model = generation_model
-                
-                try:
-                    for chunk in current_model.generate_content(prompt, stream=True):
-                        chunk_text = getattr(chunk, "text", "")
-                        full_response += chunk_text
-                        yield chunk_text
-                except Exception as e:
-                    if generation_model_2 is not None:
-                        # Switch to fallback model and continue streaming
-                        for chunk in generation_model_2.generate_content(prompt, stream=True):
-                            chunk_text = getattr(chunk, "text", "")
-                            full_response += chunk_text
-                            yield chunk_text
-                    else:
-                        if generation_model_2 is None:
-                            yield "Error: Primary model quota exceeded and fallback model not available."
-                        else:
-                            yield f"Error: {str(e)}"
-                finally:
-                    # Cache and store after streaming completes
-                    if full_response:
-                        answer_cache[cache_key] = full_response
-                        store_conversation_entry(current_history, user_query, full_response, context, used_parent_id)
-            
-            return Response(generate_stream(), mimetype='text/plain')
-    
-    except Exception as e:
-        # Log the error and return appropriate response
-        print(f"ERROR:__main__:LLM generation failed: {e}")
-        
-        processing_time = int((time.perf_counter() - start_time) * 1000)
+            final_answer = generate_answer(turn.prompt, turn.timings)
+            complete_chat_turn(turn, final_answer)
+            return jsonify(answer_payload(turn, final_answer))
         
-        if not use_stream:
-            return jsonify({
-                "answer": f"Xin lỗi, đã có lỗi xảy ra: {str(e)}",
-                "cached": False,
-                "latency_ms": processing_time,
-                "context_source": used_parent_id,
-                "error": True
-            }), 500
-        else:
-            def error_stream():
-                yield f"Xin lỗi, đã có lỗi xảy ra: {str(e)}"
-            
-            return Response(error_stream(), mimetype='text/plain')
+        # Streaming response (text/plain)
+        return Response((plain_text(*e) for e in stream_events(turn)), mimetype='text/plain')
     
     except Exception as e:
-        logger.error(f"LLM generation failed: {e}")
-        error_response = {
-            "error": "Generation failed",
-            "detail": str(e),
-            "fallback": "Xin lỗi, hệ thống đang gặp sự cố. Vui lòng thử lại sau."
-        }
-        return jsonify(error_response), 500
+        if not turn.use_stream:
+            return jsonify(error_payload(turn, e)), 500
+
+        turn.record_metrics(outcome="error")
+        # `e` bị xoá khi ra khỏi except, generator chạy sau đó
+        msg = str(e)
+
+        def error_stream():
+            yield f"Xin lỗi, đã có lỗi xảy ra: {msg}"
+
+        return Response(error_stream(), mimetype='text/plain')
     
-@app.route("/update_popular", methods=["POST"])
-def update_popular():
+@app.route("/popular", methods=["GET"])
+def popular():
+    """Top-N procedures: ?limit=10&hours=168 (hours=0: all time)"""
+    if analytics is None:
+        return not_ready_response()
     try:
-        data = request.get_json(force=True)
-        name = data.get("name", "").strip()
-        if not name:
-            return jsonify({"error": "Thiếu tên thủ tục"}), 400
-
-        add_popular_procedures_data(name, popular_procedures_data, popular_procedures_path)
-        return jsonify({"status": "success", "name": name})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        limit = min(config.POPULAR_MAX_LIMIT, max(1, int(request.args.get("limit", config.POPULAR_DEFAULT_LIMIT))))
+        hours = min(config.POPULAR_WINDOW_HOURS, max(0, int(request.args.get("hours", config.POPULAR_WINDOW_HOURS))))
+    except ValueError:
+        return jsonify({"error": "limit and hours must be integers"}), 400
+
+    ranked = analytics.top(limit, hours * 3600 or None)
+    body = json.dumps({"window_hours": hours or None, "limit": limit, **ranked}, ensure_ascii=False)
+    response = Response(body, mimetype="application/json")
+    response.set_etag(hashlib.sha1(json.dumps(ranked["popular_procedures"]).encode("utf-8")).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = config.POPULAR_CACHE_SECONDS
+    return response.make_conditional(request)
 
 # Tìm đến hàm này trong file app.py và thay thế nó
 @app.route("/save_feedback", methods=["POST"])
 def save_feedback():
+    if analytics is None:
+        return not_ready_response()
     data = request.get_json()
     if not data:
         return jsonify({"error": "Thiếu dữ liệu JSON"}), 400
@@ -738,41 +2030,15 @@ def save_feedback():
         return jsonify({"status": "no_change"}), 200
 
     try:
-        # Mở và đọc file JSON
-        with open(user_feedback_path, "r+") as f:
-            user_feedback_data = json.load(f)
-            summary = user_feedback_data.get('feedback_summary', {'likes': 0, 'dislikes': 0})
-
-            # --- LOGIC CẬP NHẬT MỚI ---
-            
-            # 1. Trừ đi 1 cho phản hồi cũ (nếu có)
-            if previous_feedback == 'like':
-                summary['likes'] = max(0, summary.get('likes', 0) - 1)
-            elif previous_feedback == 'dislike':
-                summary['dislikes'] = max(0, summary.get('dislikes', 0) - 1)
-
-            # 2. Cộng 1 cho phản hồi mới (nếu có)
-            if new_feedback == 'like':
-                summary['likes'] = summary.get('likes', 0) + 1
-            elif new_feedback == 'dislike':
-                summary['dislikes'] = summary.get('dislikes', 0) + 1
-            
-            # --- KẾT THÚC LOGIC CẬP NHẬT ---
-
-            user_feedback_data['feedback_summary'] = summary
-            
-            # Quay lại đầu file để ghi đè nội dung mới
-            f.seek(0)
-            json.dump(user_feedback_data, f, ensure_ascii=False, indent=2)
-            f.truncate()
-
+        # Chỉ cộng/trừ trong RAM; analytics writer ghi xuống SQLite theo lô
+        analytics.record_feedback(new_feedback, previous_feedback)
         return jsonify({
             "status": "success",
-            "summary": user_feedback_data["feedback_summary"]
+            "summary": analytics.feedback_summary()
         })
-        
-    except FileNotFoundError:
-        return jsonify({"error": "Không tìm thấy file user_feedback.json"}), 404
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Lỗi khi lưu feedback: {str(e)}")
         return jsonify({"error": f"Lỗi server: {str(e)}"}), 500
@@ -781,8 +2047,12 @@ def save_feedback():
 def user_data_files(filename):
     """
     Phục vụ file từ thư mục user_data một cách an toàn.
-    Chống directory traversal bằng cách so sánh đường dẫn tuyệt đối.
+    Chỉ các file trong PUBLIC_USER_DATA_FILES; chống directory traversal bằng cách
+    so sánh đường dẫn tuyệt đối.
     """
+    if filename not in PUBLIC_USER_DATA_FILES:
+        abort(404)
+
     user_data_dir = os.path.join(app.root_path, 'user_data')
 
     # Tạo đường dẫn tuyệt đối đến file requested
@@ -808,12 +2078,69 @@ def clear_session():
     data = request.get_json(force=True)
     session_id = data.get('session_id', 'default')
     
-    if session_id in chat_histories:
-        del chat_histories[session_id]
+    if session_store.delete_history(session_id):
         return jsonify({"status": "success", "message": f"Session {session_id} cleared"})
     
     return jsonify({"status": "success", "message": "Session not found"})
 
+@app.route("/session_memory/<session_id>", methods=["GET"])
+def session_memory(session_id):
+    """Memory accounting for one session's history (diagnostics, needs DEBUG_TOKEN)"""
+    if not debug_authorized():
+        abort(404)
+    history = session_store.get_history(session_id)
+    return jsonify({"session_id": session_id, **session_memory_report(history, session_store.history_bytes(session_id))})
+
+@app.route("/search", methods=["GET"])
+def search():
+    """Procedure search: ?q=&mode=full|prefix&page=&page_size=&fields=a,b"""
+    if not startup.ready:
+        return not_ready_response()
+    query = (request.args.get("q") or "").strip()
+    mode = request.args.get("mode", "full")
+    try:
+        if mode not in ("full", "prefix"):
+            raise ValueError("mode must be 'full' or 'prefix'")
+        page = max(1, int(request.args.get("page", 1)))
+        page_size = min(config.SEARCH_MAX_PAGE_SIZE, max(1, int(request.args.get("page_size", 20))))
+        fields = parse_fields(request.args.get("fields"), ["ten_thu_tuc"])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    ranked = search_procedures(query, mode) if query else []
+    window = ranked[(page - 1) * page_size: page * page_size]
+    return jsonify({
+        "query": query,
+        "mode": mode,
+        "page": page,
+        "page_size": page_size,
+        "total": len(ranked),
+        "results": [
+            {"id": procedure_public_ids.get(parent_id), "score": round(score, 4), **project_procedure(parent_id, fields)}
+            for parent_id, score in window
+        ],
+    })
+
+@app.route("/procedure/<procedure_id>", methods=["GET"])
+def procedure(procedure_id):
+    """One procedure record (optionally ?fields=a,b), cacheable with ETag / If-None-Match"""
+    if not startup.ready:
+        return not_ready_response()
+    parent_id = procedure_by_public_id.get(procedure_id)
+    if parent_id is None or parent_id not in procedure_dict:
+        return jsonify({"error": "Procedure not found"}), 404
+    try:
+        fields = parse_fields(request.args.get("fields"), list(FIELD_MAP))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    body = json.dumps({"id": procedure_id, **project_procedure(parent_id, fields)}, ensure_ascii=False)
+    response = Response(body, mimetype="application/json")
+    response.set_etag(hashlib.sha1(body.encode("utf-8")).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = config.PROCEDURE_MAX_AGE
+    return response.make_conditional(request)
+
 @app.route("/")
 def home():
     return render_template("index.html")
@@ -832,9 +2159,24 @@ def initialize_application():
     
     logger.info("=== CHATBOT READY ===")
 
+def initialize_in_background() -> threading.Thread:
+    """Load resources on a background thread so /health/live answers immediately"""
+    def _run():
+        try:
+            initialize_application()
+        except Exception as e:
+            logger.error(f"Background initialization failed: {e}")
+
+    thread = threading.Thread(target=_run, name="initialize", daemon=True)
+    thread.start()
+    return thread
+
 if __name__ == "__main__":
     try:
-        initialize_application()
+        if config.BACKGROUND_INIT:
+            initialize_in_background()
+        else:
+            initialize_application()
         port = int(os.getenv("PORT", 7860))
         app.run(host="0.0.0.0", port=port, debug=False)
     except Exception as e:
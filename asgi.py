@@ -0,0 +1,178 @@
+# asgi.py - asyncio-native serving path for the eGov chatbot
+#
+# /chat is handled natively: retrieval and prompt building run on a bounded thread
+# pool and Gemini is called through the async client, so an in-flight LLM call no
+# longer pins a worker thread. Every other route (/clear_session, /save_feedback,
+# static files, ...) is served by the existing Flask app through WsgiToAsgi.
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 7860
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict
+
+from asgiref.wsgi import WsgiToAsgi
+
+import app as chatbot
+
+logger = chatbot.logger
+flask_asgi = WsgiToAsgi(chatbot.app)
+
+# Retrieval + prompt building (CPU / FAISS) stays bounded regardless of how many
+# requests are waiting on Gemini
+chat_executor = ThreadPoolExecutor(
+    max_workers=chatbot.config.ASYNC_RETRIEVAL_WORKERS, thread_name_prefix="chat"
+)
+
+CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+
+
+async def read_body(receive) -> bytes:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def send_json(send, payload: Dict[str, Any], status: int = 200) -> None:
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            *CORS_HEADERS,
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_stream(send, chunks, content_type: bytes = b"text/plain; charset=utf-8", headers=()) -> None:
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", content_type), *CORS_HEADERS, *headers],
+    })
+    async for text in chunks:
+        if text:
+            await send({"type": "http.response.body", "body": text.encode("utf-8"), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def single_chunk(text: str):
+    yield text
+
+
+async def iterate(events):
+    for event in events:
+        yield event
+
+
+async def sse_chunks(events):
+    async for event, data in events:
+        yield chatbot.sse_format(event, data)
+
+
+async def plain_chunks(events):
+    async for event, data in events:
+        yield chatbot.plain_text(event, data)
+
+
+SSE_HEADERS = [(k.lower().encode(), v.encode()) for k, v in chatbot.SSE_HEADERS.items()]
+
+
+async def send_sse(send, events) -> None:
+    await send_stream(send, sse_chunks(events), b"text/event-stream; charset=utf-8", SSE_HEADERS)
+
+
+async def chat(scope, receive, send) -> None:
+    """Same request/response contract as the Flask /chat view"""
+    if not chatbot.startup.ready:
+        await send_json(send, {"error": "Service is starting, please retry shortly", "ready": False}, 503)
+        return
+
+    try:
+        data = json.loads(await read_body(receive))
+        if not isinstance(data, dict):
+            raise ValueError("JSON body must be an object")
+    except Exception as e:
+        await send_json(send, {"error": "Invalid JSON", "detail": str(e)}, 400)
+        return
+
+    turn = chatbot.ChatTurn(data)
+    if not turn.user_query:
+        await send_json(send, {"error": "No question provided"}, 400)
+        return
+
+    accept = dict(scope.get("headers") or []).get(b"accept", b"").decode("latin-1")
+    use_sse = chatbot.wants_sse(data, accept)
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(chat_executor, chatbot.prepare_chat_turn, turn)
+    if turn.cached_answer is not None:
+        if use_sse:
+            await send_sse(send, iterate(chatbot.cached_events(turn)))
+        else:
+            await send_json(send, chatbot.cached_payload(turn))
+        return
+
+    if use_sse:
+        await send_sse(send, chatbot.stream_events_async(turn, chat_executor))
+        return
+
+    try:
+        if not chatbot.generation_pool:
+            raise RuntimeError("Generation model not available. Check GOOGLE_API_KEY.")
+
+        if not turn.use_stream:
+            final_answer = await chatbot.generate_answer_async(turn.prompt, turn.timings)
+            await loop.run_in_executor(chat_executor, chatbot.complete_chat_turn, turn, final_answer)
+            await send_json(send, chatbot.answer_payload(turn, final_answer))
+        else:
+            await send_stream(send, plain_chunks(chatbot.stream_events_async(turn, chat_executor)))
+
+    except Exception as e:
+        if not turn.use_stream:
+            await send_json(send, chatbot.error_payload(turn, e), 500)
+        else:
+            turn.record_metrics(outcome="error")
+            await send_stream(send, single_chunk(f"Xin lỗi, đã có lỗi xảy ra: {str(e)}"))
+
+
+async def lifespan(scope, receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                if chatbot.config.BACKGROUND_INIT:
+                    chatbot.initialize_in_background()
+                else:
+                    await asyncio.get_running_loop().run_in_executor(None, chatbot.initialize_application)
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            chat_executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        await lifespan(scope, receive, send)
+    elif scope["type"] == "http" and scope["path"] == "/chat" and scope["method"] == "POST":
+        await chat(scope, receive, send)
+    else:
+        await flask_asgi(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(application, host="0.0.0.0", port=int(os.getenv("PORT", 7860)))
@@ -0,0 +1,253 @@
+# compact_store.py - Read-only columnar corpus store shared by all workers via mmap
+#
+# ``store_dir`` is a symlink to the current version directory (``<store_dir>.<stamp>``);
+# a rebuild writes a new version and swaps the link with one atomic rename, so a
+# worker always maps a complete store. Layout of a version directory:
+#   manifest.json                   version, sizes, source artifacts the store was built from
+#   <column>.bin / <column>.offsets.npy   UTF-8 strings concatenated + int64 offsets (n + 1)
+#   chunk_parent_codes.npy          int32 row in parent_keys for every chunk (-1 = none)
+#   bm25_vocab.* / bm25_vocab.ids.npy   BM25 terms, sorted, + term id of each (SortedStringIndex)
+#   bm25_offsets.npy / bm25_doc_ids.npy / bm25_weights.npy   BM25 postings (CSR)
+#   record_keys.* / records.*       procedure keys + JSON records, in source order
+#   record_index.* / record_index.ids.npy   record keys, sorted, + row of each (SortedStringIndex)
+#
+# Every array is opened with mmap_mode="r", so pages live in the OS page cache and
+# are shared between gunicorn workers instead of being copied into each heap. Key
+# lookups (BM25 terms, record keys) binary-search the sorted mmapped columns rather
+# than building a dict per worker.
+import bisect
+import fcntl
+import glob
+import json
+import os
+import shutil
+import threading
+import time
+from collections.abc import Mapping, Sequence
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+from cachetools import LRUCache
+
+STORE_VERSION = 2
+MANIFEST = "manifest.json"
+
+
+def write_strings(prefix: str, values: Iterable[Optional[str]]) -> int:
+    """Write strings as one UTF-8 blob plus offsets; returns the number of rows"""
+    offsets = [0]
+    with open(prefix + ".bin", "wb") as f:
+        for value in values:
+            data = ("" if value is None else str(value)).encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(prefix + ".offsets.npy", np.asarray(offsets, dtype=np.int64))
+    return len(offsets) - 1
+
+
+class StringColumn(Sequence):
+    """Memory-mapped string column written by ``write_strings``"""
+
+    def __init__(self, prefix: str):
+        self.offsets = np.load(prefix + ".offsets.npy", mmap_mode="r")
+        if os.path.getsize(prefix + ".bin"):
+            self.blob = np.memmap(prefix + ".bin", dtype=np.uint8, mode="r")
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)  # mmap không nhận file rỗng
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.blob[start:end].tobytes().decode("utf-8")
+
+
+def write_sorted_index(prefix: str, keys: List[str]) -> None:
+    """Write ``keys`` sorted (for ``SortedStringIndex``) plus the original position of each"""
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    write_strings(prefix, (keys[i] for i in order))
+    np.save(prefix + ".ids.npy", np.asarray(order, dtype=np.int32))
+
+
+class SortedStringIndex(Mapping):
+    """Read-only str -> int mapping over a sorted mmapped column, looked up with bisect"""
+
+    def __init__(self, prefix: str):
+        self.keys = StringColumn(prefix)
+        self.ids = np.load(prefix + ".ids.npy", mmap_mode="r")
+
+    def _position(self, key: str) -> Optional[int]:
+        pos = bisect.bisect_left(self.keys, key)
+        return pos if pos < len(self.keys) and self.keys[pos] == key else None
+
+    def __getitem__(self, key: str) -> int:
+        pos = self._position(key) if isinstance(key, str) else None
+        if pos is None:
+            raise KeyError(key)
+        return int(self.ids[pos])
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self._position(key) is not None
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+
+class ColumnarMetas(Sequence):
+    """Chunk metadata as columns; ``metas[i]`` rebuilds the chunk dict on access (LRU-cached)"""
+
+    def __init__(self, store_dir: str, fields: List[str], cache_size: int = 2048):
+        self.fields = fields
+        self.columns = {field: StringColumn(os.path.join(store_dir, f"meta_{field}")) for field in fields}
+        self._len = len(next(iter(self.columns.values()))) if fields else 0
+        self._cache = LRUCache(maxsize=cache_size)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getitem__(self, i: int) -> Dict[str, str]:
+        if i < 0:
+            i += self._len
+        with self._lock:
+            chunk = self._cache.get(i)
+        if chunk is None:
+            chunk = {field: column[i] for field, column in self.columns.items()}
+            with self._lock:
+                self._cache[i] = chunk
+        return chunk
+
+    def value(self, i: int, field: str) -> str:
+        """Single field of one chunk without decoding the others"""
+        column = self.columns.get(field)
+        return column[i] if column is not None else ""
+
+
+class RecordStore(Mapping):
+    """Procedure records keyed by ``nguon``, JSON-decoded on first lookup and LRU-cached.
+
+    Cached dicts are shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self, store_dir: str, cache_size: int = 1024):
+        self.keys = StringColumn(os.path.join(store_dir, "record_keys"))
+        self.index = SortedStringIndex(os.path.join(store_dir, "record_index"))
+        self.records = StringColumn(os.path.join(store_dir, "records"))
+        self._cache = LRUCache(maxsize=cache_size)
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key: str) -> Dict[str, Any]:
+        with self._lock:
+            record = self._cache.get(key)
+        if record is None:
+            record = json.loads(self.records[self.index[key]])
+            with self._lock:
+                self._cache[key] = record
+        return record
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+
+def current_version(store_dir: str) -> str:
+    """Version directory ``store_dir`` points to; resolve once and map everything from it"""
+    return os.path.realpath(store_dir)
+
+
+def read_manifest(store_dir: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(store_dir, MANIFEST), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("version") == STORE_VERSION else None
+
+
+def write_store(store_dir: str, metas: List[Dict[str, Any]], parent_keys: List[str],
+                chunk_parent_codes: np.ndarray, bm25_vocab: List[str], bm25_offsets: np.ndarray,
+                bm25_doc_ids: np.ndarray, bm25_weights: np.ndarray, bm25_corpus_size: int,
+                records: Dict[str, Dict[str, Any]], sources: Dict[str, str]) -> None:
+    """Write a complete store into a new version dir, then point ``store_dir`` at it"""
+    tmp_dir = f"{store_dir}.{time.time_ns()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    fields = list(dict.fromkeys(key for chunk in metas for key in chunk))
+    for field in fields:
+        write_strings(os.path.join(tmp_dir, f"meta_{field}"), (chunk.get(field) for chunk in metas))
+    write_strings(os.path.join(tmp_dir, "parent_keys"), parent_keys)
+    np.save(os.path.join(tmp_dir, "chunk_parent_codes.npy"), np.asarray(chunk_parent_codes, dtype=np.int32))
+
+    write_sorted_index(os.path.join(tmp_dir, "bm25_vocab"), list(bm25_vocab))
+    np.save(os.path.join(tmp_dir, "bm25_offsets.npy"), bm25_offsets)
+    np.save(os.path.join(tmp_dir, "bm25_doc_ids.npy"), bm25_doc_ids)
+    np.save(os.path.join(tmp_dir, "bm25_weights.npy"), bm25_weights)
+
+    write_strings(os.path.join(tmp_dir, "record_keys"), records.keys())
+    write_sorted_index(os.path.join(tmp_dir, "record_index"), list(records))
+    write_strings(os.path.join(tmp_dir, "records"),
+                  (json.dumps(obj, ensure_ascii=False) for obj in records.values()))
+
+    with open(os.path.join(tmp_dir, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump({
+            "version": STORE_VERSION,
+            "fields": fields,
+            "chunks": len(metas),
+            "procedures": len(records),
+            "bm25_corpus_size": int(bm25_corpus_size),
+            "sources": sources,
+        }, f, ensure_ascii=False, indent=2)
+
+    swap_version(store_dir, tmp_dir)
+
+
+def swap_version(store_dir: str, version_dir: str) -> None:
+    """Atomically repoint the ``store_dir`` symlink at ``version_dir``.
+
+    The version that was current stays on disk (a worker may still be mapping
+    it); older versions are removed.
+    """
+    previous = current_version(store_dir) if os.path.islink(store_dir) else None
+    if os.path.isdir(store_dir) and not os.path.islink(store_dir):
+        # Store cũ (thư mục thật, trước khi dùng symlink): dời sang tên version để giữ lại
+        previous = f"{store_dir}.legacy-{os.getpid()}"
+        os.rename(store_dir, previous)
+    link = f"{store_dir}.link-{os.getpid()}"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(version_dir), link)
+    os.replace(link, store_dir)
+
+    keep = {os.path.realpath(version_dir), previous}
+    for path in glob.glob(glob.escape(store_dir) + ".*"):
+        if os.path.isdir(path) and not os.path.islink(path) and os.path.realpath(path) not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def build_lock(store_dir: str):
+    """Exclusive lock so only one worker builds the store; others wait, then mmap it"""
+    os.makedirs(os.path.dirname(os.path.abspath(store_dir)), exist_ok=True)
+    with open(store_dir + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_array(store_dir: str, name: str) -> np.ndarray:
+    return np.load(os.path.join(store_dir, name + ".npy"), mmap_mode="r")
@@ -0,0 +1,301 @@
+# llm_pool.py - Pool of Gemini clients, one per API key
+#
+# Every key gets its own GenerativeModel bound to its own API client (the global
+# genai.configure() only holds one key at a time), a token bucket for its
+# requests-per-minute limit, a daily request budget and a circuit breaker that
+# takes the key out of rotation after repeated 429/5xx errors. The rate limit and
+# the daily budget are opt-in (None = unlimited) and counted per process: with
+# several workers each one holds its own budget.
+#
+# Requests are routed to the key with the most remaining daily quota among keys
+# that are closed (healthy) and have a token available, so a key that is known to
+# be exhausted is skipped without paying for a failed round-trip.
+import asyncio
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+try:
+    from google.api_core import exceptions as google_exceptions
+except ImportError:  # google-generativeai không được cài (script offline, benchmark)
+    google_exceptions = None
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def error_status(e: Exception) -> Optional[int]:
+    """HTTP status of a google.api_core error, None for anything else"""
+    if google_exceptions is None or not isinstance(e, google_exceptions.GoogleAPICallError):
+        return None
+    if isinstance(e, google_exceptions.ResourceExhausted):  # 429, hết quota
+        return 429
+    if isinstance(e, (google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError)):
+        return e.code if isinstance(e.code, int) else 503
+    return e.code if isinstance(e.code, int) else None
+
+
+def is_retryable_error(e: Exception) -> bool:
+    """Quota / rate limit / server errors: worth retrying on another key"""
+    return error_status(e) in RETRYABLE_STATUS
+
+
+class NoAvailableKeyError(RuntimeError):
+    """Every key is rate limited, out of daily quota or has its circuit open"""
+
+
+class TokenBucket:
+    """Requests-per-minute limiter; ``capacity`` tokens refilled at ``rate`` per second"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+    def try_acquire(self) -> bool:
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait_time(self) -> float:
+        """Seconds until the next token is available"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class CircuitBreaker:
+    """closed -> open after ``threshold`` consecutive failures; one probe after ``cooldown``"""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = 0.0
+        self.state = self.CLOSED
+
+    def ready(self) -> bool:
+        """Would ``allow`` let a request through? No state change"""
+        return self.state == self.CLOSED or time.monotonic() - self.opened_at >= self.cooldown
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            # Cho một request thử lại mỗi cooldown; thất bại thì mở lại
+            self.state = self.HALF_OPEN
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.state = self.CLOSED
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class LLMKey:
+    """One API key: its bound model plus limiter, breaker and usage counters"""
+
+    def __init__(self, name: str, model: Any, rpm: Optional[float], burst: Optional[float],
+                 daily_quota: Optional[int], breaker_threshold: int, breaker_cooldown: float,
+                 bind_async: Optional[Callable[[Any], None]] = None):
+        self.name = name
+        self.model = model
+        # Gọi trên event loop đang phục vụ trước lần gọi async đầu tiên (client grpc.aio
+        # phải được tạo trên đúng loop sẽ dùng nó, không phải trên thread khởi động)
+        self.bind_async = bind_async
+        self._bound_loop = None
+        # rpm / daily_quota = None: không giới hạn
+        self.bucket = TokenBucket(rpm / 60.0, burst or max(1.0, rpm / 60.0)) if rpm else None
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.daily_quota = daily_quota
+        self.day = self._today()
+        self.day_requests = 0
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.latency_total = 0.0
+
+    def async_model(self) -> Any:
+        """``model`` with its async client bound to the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self.bind_async is not None and self._bound_loop is not loop:
+            self.bind_async(self.model)
+            self._bound_loop = loop
+        return self.model
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+    def remaining_quota(self) -> float:
+        """Requests left today in this process; math.inf without a daily quota"""
+        if self.daily_quota is None:
+            return math.inf
+        today = self._today()
+        if today != self.day:
+            self.day, self.day_requests = today, 0
+        return self.daily_quota - self.day_requests
+
+    def tokens_available(self) -> float:
+        return self.bucket.available() if self.bucket else math.inf
+
+    def try_acquire_token(self) -> bool:
+        return self.bucket.try_acquire() if self.bucket else True
+
+    def token_wait_time(self) -> float:
+        return self.bucket.wait_time() if self.bucket else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "key": self.name,
+            "state": self.breaker.state,
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "rate_limited": self.rate_limited,
+            "remaining_daily_quota": None if self.daily_quota is None else self.remaining_quota(),
+            "tokens_available": round(self.bucket.available(), 2) if self.bucket else None,
+            "avg_latency_ms": round(self.latency_total * 1000 / self.successes, 1) if self.successes else None,
+        }
+
+
+class GenerationPool:
+    """Routes Gemini calls across API keys by remaining quota"""
+
+    def __init__(self, keys: List[LLMKey], max_wait: float = 0.0):
+        self.keys = keys
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _try_acquire(self, tried: set):
+        """(key, 0) if a key got a token, else (None, seconds until one might)"""
+        with self._lock:
+            # ready() không đổi trạng thái: chỉ key được chọn mới chuyển sang half-open
+            usable = [k for k in self.keys
+                      if k.name not in tried and k.remaining_quota() > 0 and k.breaker.ready()]
+            usable.sort(key=lambda k: (k.remaining_quota(), k.tokens_available()), reverse=True)
+            for key in usable:
+                if key.try_acquire_token():
+                    key.breaker.allow()
+                    key.requests += 1
+                    key.day_requests += 1
+                    return key, 0.0
+            return None, min((k.token_wait_time() for k in usable), default=None)
+
+    def candidates(self) -> Iterator[LLMKey]:
+        """Keys to try in order, one token acquired per yielded key.
+
+        Waits up to ``max_wait`` for a token when every bucket is empty. Call
+        ``record_success`` / ``record_failure`` for each yielded key and stop
+        iterating once a call succeeds or fails with a non-retryable error.
+        """
+        tried: set = set()
+        while True:
+            key, wait = self._try_acquire(tried)
+            if key is None and wait is not None and wait <= self.max_wait:
+                time.sleep(wait)
+                key, wait = self._try_acquire(tried)
+            if key is None:
+                if not tried:
+                    raise NoAvailableKeyError("All Gemini API keys are rate limited or unavailable")
+                return
+            tried.add(key.name)
+            yield key
+
+    async def candidates_async(self) -> AsyncIterator[LLMKey]:
+        """``candidates`` for the event loop (waits with asyncio.sleep)"""
+        tried: set = set()
+        while True:
+            key, wait = self._try_acquire(tried)
+            if key is None and wait is not None and wait <= self.max_wait:
+                await asyncio.sleep(wait)
+                key, wait = self._try_acquire(tried)
+            if key is None:
+                if not tried:
+                    raise NoAvailableKeyError("All Gemini API keys are rate limited or unavailable")
+                return
+            tried.add(key.name)
+            yield key
+
+    def record_success(self, key: LLMKey, elapsed: float) -> None:
+        with self._lock:
+            key.successes += 1
+            key.latency_total += elapsed
+            key.breaker.record_success()
+
+    def record_failure(self, key: LLMKey, e: Exception) -> None:
+        """Only quota / server errors count against the key's circuit breaker"""
+        status = error_status(e)
+        with self._lock:
+            key.failures += 1
+            if status == 429:
+                key.rate_limited += 1
+            if status in RETRYABLE_STATUS:
+                key.breaker.record_failure()
+        logger.warning(f"Gemini call on {key.name} failed (status={status}, circuit={key.breaker.state}): {e}")
+
+    def generate(self, prompt: str) -> Any:
+        """Blocking generate_content on the best key, failing over on retryable errors"""
+        error: Optional[Exception] = None
+        for key in self.candidates():
+            start = time.perf_counter()
+            try:
+                response = key.model.generate_content(prompt)
+            except Exception as e:
+                self.record_failure(key, e)
+                if not is_retryable_error(e):
+                    raise
+                error = e
+                continue
+            self.record_success(key, time.perf_counter() - start)
+            return response
+        raise error or NoAvailableKeyError("All Gemini API keys are rate limited or unavailable")
+
+    async def generate_async(self, prompt: str) -> Any:
+        """Async counterpart of ``generate``"""
+        error: Optional[Exception] = None
+        async for key in self.candidates_async():
+            start = time.perf_counter()
+            try:
+                response = await key.async_model().generate_content_async(prompt)
+            except Exception as e:
+                self.record_failure(key, e)
+                if not is_retryable_error(e):
+                    raise
+                error = e
+                continue
+            self.record_success(key, time.perf_counter() - start)
+            return response
+        raise error or NoAvailableKeyError("All Gemini API keys are rate limited or unavailable")
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [k.stats() for k in self.keys]
@@ -0,0 +1,205 @@
+# metrics.py - Per-stage timers and a Prometheus text-format /metrics registry
+#
+#   with stage("prompt", turn.timings):
+#       ...
+#
+# records the duration in the ``egov_stage_seconds{stage="prompt"}`` histogram and,
+# when a dict is given, in that dict (milliseconds) so a request can report its own
+# breakdown. Values that already live elsewhere (cache stats, key usage, session
+# counts) are read at scrape time through ``register_collector`` callbacks.
+#
+# Metrics are per process: with several workers, scrape each one (or run a
+# single worker per container).
+#
+# ``StackSampler`` is an optional sampling profiler: a background thread records
+# every other thread's stack every ``interval`` seconds, aggregated as folded
+# stacks ("a;b;c count") ready for flamegraph.pl / speedscope.
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Giây; từ cache hit (~ms) tới một lượt Gemini chậm
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels, extra: Iterable[Tuple[str, str]] = ()) -> str:
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for k, v in items)
+    return "{" + body + "}"
+
+
+class CounterMetric:
+    """Monotonic counter with labels"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(k)} {v}" for k, v in self._values.items()]
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels (Prometheus semantics)"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Labels, List[float]] = {}  # bucket counts..., +Inf count, sum
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += 1
+            row[-1] += value
+
+    def samples(self) -> List[str]:
+        out = []
+        with self._lock:
+            for key, row in self._values.items():
+                for bound, count in zip(self.buckets, row):
+                    out.append(f"{self.name}_bucket{_format_labels(key, [('le', repr(bound))])} {count}")
+                out.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {row[-2]}")
+                out.append(f"{self.name}_count{_format_labels(key)} {row[-2]}")
+                out.append(f"{self.name}_sum{_format_labels(key)} {row[-1]}")
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List = []
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, Dict[str, str], float]]]] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str) -> CounterMetric:
+        metric = CounterMetric(name, help_text)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, fn: Callable) -> Callable:
+        """``fn()`` yields (name, kind, help, labels, value) at scrape time"""
+        with self._lock:
+            self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.kind}"]
+            lines += metric.samples()
+
+        seen = set()
+        with self._lock:
+            collectors = list(self._collectors)
+        for fn in collectors:
+            try:
+                samples = list(fn())
+            except Exception as e:  # một collector lỗi không làm hỏng cả trang /metrics
+                lines.append(f"# collector {getattr(fn, '__name__', fn)} failed: {e}")
+                continue
+            for name, kind, help_text, labels, value in samples:
+                if value is None:
+                    continue
+                if name not in seen:
+                    seen.add(name)
+                    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                lines.append(f"{name}{_format_labels(tuple(labels.items()))} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram("egov_stage_seconds", "Duration of each /chat pipeline stage")
+
+
+def observe_stage(name: str, seconds: float, timings: Optional[Dict[str, float]] = None) -> None:
+    stage_seconds.observe(seconds, stage=name)
+    if timings is not None:
+        timings[name] = round(timings.get(name, 0.0) + seconds * 1000, 2)
+
+
+@contextmanager
+def stage(name: str, timings: Optional[Dict[str, float]] = None):
+    """Time a block into ``egov_stage_seconds{stage=name}`` (and ``timings[name]`` in ms)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start, timings)
+
+
+class StackSampler:
+    """Sampling profiler: folded stacks of all threads every ``interval`` seconds"""
+
+    def __init__(self, interval: float = 0.01, max_stacks: int = 5000):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.samples = 0
+        self._stacks: Counter = Counter()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _fold(frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, frame in frames.items():
+                    if ident == own:
+                        continue
+                    stack = self._fold(frame)
+                    if stack in self._stacks or len(self._stacks) < self.max_stacks:
+                        self._stacks[stack] += 1
+                self.samples += 1
+
+    def folded(self, limit: Optional[int] = None, reset: bool = False) -> str:
+        with self._lock:
+            rows = self._stacks.most_common(limit)
+            if reset:
+                self._stacks.clear()
+                self.samples = 0
+        return "\n".join(f"{stack} {count}" for stack, count in rows) + "\n"
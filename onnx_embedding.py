@@ -0,0 +1,82 @@
+# onnx_embedding.py - ONNX Runtime CPU backend for the sentence embedding model
+#
+# The model directory is produced by Offline_Pharse/export_onnx_embedding.py and holds:
+#   model.onnx / model_quant.onnx   transformer exported from SentenceTransformer (fp32 / dynamic int8)
+#   pooling.json                    {"pooling": "cls" | "mean", "dim": ..., "max_seq_length": ...}
+#   tokenizer files                 saved with tokenizer.save_pretrained
+import json
+import os
+from typing import List, Union
+
+import numpy as np
+
+FP32_FILE = "model.onnx"
+QUANT_FILE = "model_quant.onnx"
+POOLING_FILE = "pooling.json"
+
+
+class OnnxEmbeddingModel:
+    """Drop-in replacement for ``SentenceTransformer.encode`` backed by ONNX Runtime.
+
+    Embeddings use the same pooling as the exported SentenceTransformer, so they
+    stay compatible with the existing ``index.faiss``.
+    """
+
+    def __init__(self, model_dir: str, quantized: bool = True, num_threads: int = 0):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(model_dir, POOLING_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.pooling = meta.get("pooling", "cls")
+        self.dim = int(meta["dim"])
+        self.max_seq_length = int(meta.get("max_seq_length", 512))
+
+        model_file = QUANT_FILE if quantized else FP32_FILE
+        self.model_path = os.path.join(model_dir, model_file)
+        if not os.path.isfile(self.model_path):
+            raise FileNotFoundError(f"ONNX model not found: {self.model_path}")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def _pool(self, hidden: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        if self.pooling == "mean":
+            mask = attention_mask[..., None].astype(hidden.dtype)
+            return (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return hidden[:, 0]
+
+    def encode(self, sentences: Union[str, List[str]], batch_size: int = 32,
+               convert_to_numpy: bool = True, normalize_embeddings: bool = False,
+               **kwargs) -> np.ndarray:
+        """Encode sentences; mirrors the SentenceTransformer arguments used in app.py"""
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        if not sentences:
+            return np.zeros((0, self.dim), dtype=np.float32)
+
+        # Sort by length so each batch pads as little as possible
+        order = np.argsort([-len(s) for s in sentences], kind="stable")
+        chunks = []
+        for start in range(0, len(sentences), max(1, batch_size)):
+            batch = [sentences[i] for i in order[start:start + batch_size]]
+            enc = self.tokenizer(batch, padding=True, truncation=True,
+                                 max_length=self.max_seq_length, return_tensors="np")
+            feeds = {name: value.astype(np.int64) for name, value in enc.items() if name in self.input_names}
+            hidden = self.session.run(None, feeds)[0]
+            chunks.append(self._pool(hidden, enc["attention_mask"]))
+
+        embs = np.concatenate(chunks)[np.argsort(order, kind="stable")].astype(np.float32)
+        if normalize_embeddings:
+            embs /= np.clip(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12, None)
+        return embs[0] if single else embs
@@ -0,0 +1,128 @@
+# procedure_fields.py - Sections of a procedure record and how they are rendered
+#
+# Shared by app.py and the offline scripts (procedure embeddings, benchmark corpus)
+# so the text that is embedded offline is exactly the text assembled at runtime,
+# plus the rules mapping a question to the section it asks about.
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from vn_text import fold, normalize, normalize_text
+
+# Field mapping for response formatting
+FIELD_MAP = {
+    "ten_thu_tuc": "Tên thủ tục",
+    "cach_thuc_thuc_hien": "Cách thức thực hiện",
+    "thanh_phan_ho_so": "Thành phần hồ sơ",
+    "trinh_tu_thuc_hien": "Trình tự thực hiện",
+    "co_quan_thuc_hien": "Cơ quan thực hiện",
+    "yeu_cau_dieu_kien": "Yêu cầu, điều kiện",
+    "thu_tuc_lien_quan": "Thủ tục liên quan",
+    "nguon": "Nguồn",
+}
+
+NO_DETAILS_TEXT = "Không tìm thấy thông tin chi tiết."
+
+
+def procedure_text(obj: Dict[str, Any]) -> str:
+    """Labelled sections of a procedure record, in record order"""
+    parts = []
+    for key, value in obj.items():
+        if value and key in FIELD_MAP:
+            parts.append(f"{FIELD_MAP[key]}:\n{value.strip()}")
+    return "\n\n".join(parts) if parts else NO_DETAILS_TEXT
+
+
+# ======================================================
+# Question -> section intent (fast path + question-relevant prompt context)
+# ======================================================
+
+# Question patterns (on normalize_text) -> the FIELD_MAP section that answers them
+FIELD_INTENTS = {
+    "thanh_phan_ho_so": [r"giấy\s*tờ", r"hồ\s*sơ", r"thành\s*phần", r"mang\s*(theo|gì)", r"chuẩn\s*bị",
+                         r"cần\s*(những\s*)?gì", r"bản\s*(sao|chính)", r"tờ\s*khai"],
+    "co_quan_thuc_hien": [r"cơ\s*quan", r"ở\s*đâu", r"nộp\s*(hồ\s*sơ\s*)?(ở|tại)", r"nơi\s*(nộp|làm|giải\s*quyết)",
+                          r"ai\s*(giải\s*quyết|cấp|thực\s*hiện)", r"đơn\s*vị"],
+    "trinh_tu_thuc_hien": [r"trình\s*tự", r"các\s*bước", r"quy\s*trình", r"làm\s*(thế\s*nào|sao|như\s*thế\s*nào)",
+                           r"thực\s*hiện\s*như"],
+    "cach_thuc_thuc_hien": [r"cách\s*thức", r"trực\s*tuyến", r"online", r"bưu\s*chính", r"nộp\s*qua",
+                            r"lệ\s*phí", r"\bphí\b", r"bao\s*(lâu|nhiêu\s*ngày|nhiêu\s*tiền)", r"thời\s*(hạn|gian)"],
+    "yeu_cau_dieu_kien": [r"điều\s*kiện", r"yêu\s*cầu", r"đối\s*tượng", r"được\s*không", r"có\s*được"],
+    "thu_tuc_lien_quan": [r"liên\s*quan"],
+    "nguon": [r"nguồn", r"\blink\b", r"đường\s*dẫn", r"trang\s*web", r"website"],
+}
+# Patterns too generic to decide on their own: a section matched only by these is
+# dropped when another section matched clearly ("nguồn ở đâu" -> nguon,
+# "nộp hồ sơ ở đâu" -> co_quan_thuc_hien). "yêu cầu" is also a verb ("yêu cầu
+# bồi thường ... cần hồ sơ gì"), so alone it does not beat another section.
+WEAK_INTENT_PATTERNS = {r"ở\s*đâu", r"hồ\s*sơ", r"yêu\s*cầu"}
+
+# An actual question about the procedure; a bare procedure name is not one
+QUESTION_CUES = [r"\bgì\b", r"\bnào\b", r"ở\s*đâu", r"thế\s*nào", r"ra\s*sao", r"làm\s*sao", r"bao\s*gồm"]
+
+# Questions that need reasoning over a section rather than the section itself
+FAST_PATH_BLOCKERS = [r"tại\s*sao", r"vì\s*sao", r"\bnếu\b", r"trường\s*hợp", r"khác\s*nhau", r"so\s*sánh",
+                      r"có\s*phải", r"có\s*cần", r"bao\s*(lâu|nhiêu)", r"\bphí\b", r"giải\s*thích",
+                      r"thì\s*sao", r"\bkhi\b", r"bị\s*mất", r"thất\s*lạc", r"không\s*(có|mang|đủ|được)",
+                      r"(quá|hết)\s*hạn"]
+# Sections whose text is answered as a whole; cach_thuc_thuc_hien mixes fees and
+# deadlines, so questions about it still go to the LLM
+FAST_PATH_FIELDS = ("thanh_phan_ho_so", "co_quan_thuc_hien", "trinh_tu_thuc_hien",
+                    "yeu_cau_dieu_kien", "thu_tuc_lien_quan", "nguon")
+
+
+def question_fields(query: str) -> List[str]:
+    """FIELD_MAP sections the question asks about, in FIELD_MAP order; [] if none stand out"""
+    text = normalize_text(query)
+    matched = {field: [p for p in FIELD_INTENTS.get(field, ()) if re.search(p, text)] for field in FIELD_MAP}
+    strong = [field for field, patterns in matched.items() if set(patterns) - WEAK_INTENT_PATTERNS]
+    if strong:
+        return strong
+    return [field for field, patterns in matched.items() if patterns]
+
+
+def strip_procedure_name(text: str, procedure_name: str, min_run: int = 2) -> str:
+    """Drop runs of ``min_run``+ consecutive words that also appear consecutively in the name.
+
+    Accent-insensitive and tolerant of partial names ("yêu cầu bồi thường" inside
+    "Giải quyết yêu cầu bồi thường tại ..."), so words of the name are not read as
+    the question's intent.
+    """
+    name = f" {fold(normalize(procedure_name))} "
+    words = text.split()
+    folded = [fold(normalize(w)) for w in words]
+    keep = [True] * len(words)
+    i = 0
+    while i < len(words):
+        run = 0
+        while i + run < len(words) and folded[i + run] and \
+                f" {' '.join(folded[i:i + run + 1])} " in name:
+            run += 1
+        if run >= min_run:
+            keep[i:i + run] = [False] * run
+            i += run
+        else:
+            i += 1
+    return " ".join(w for w, k in zip(words, keep) if k)
+
+
+def classify_field_intent(query: str, procedure_name: str = "", max_chars: int = 120) -> Tuple[Optional[str], float]:
+    """(FIELD_MAP section the question asks for, confidence in [0, 1])"""
+    raw = normalize_text(query)
+    text = strip_procedure_name(raw, procedure_name) if procedure_name else raw
+    fields = question_fields(text)
+    if not fields:
+        return None, 0.0
+    field = fields[0]
+    if len(fields) > 1:
+        return field, 0.3  # hỏi nhiều mục một lúc
+
+    confidence = 1.0
+    if field not in FAST_PATH_FIELDS:
+        confidence -= 0.4
+    if "?" not in raw and not any(re.search(pattern, text) for pattern in QUESTION_CUES):
+        confidence -= 0.5
+    if any(re.search(pattern, text) for pattern in FAST_PATH_BLOCKERS):
+        confidence -= 0.5
+    if len(raw) > max_chars or raw.count("?") > 1:
+        confidence -= 0.3
+    return field, max(confidence, 0.0)
@@ -0,0 +1,236 @@
+# session_store.py - Chat sessions and the exact-answer cache, in-process or in Redis
+#
+#   SESSION_BACKEND=memory   (default) TTL + max-sessions bounded store inside the worker
+#   SESSION_BACKEND=redis    any server speaking the Redis protocol (REDIS_URL), shared
+#                            by every gunicorn / uvicorn worker
+#
+# Histories are stored as one compact blob:
+#   <uint32 header length> <JSON header> <float32 context embeddings, row-major>
+# so ``context_emb`` travels as raw bytes instead of pickled numpy objects.
+#
+# If Redis is unreachable the Redis backend logs the error and behaves like an
+# empty store (no history, no cached answer) so /chat keeps answering.
+import json
+import logging
+import socket
+import struct
+import threading
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+import numpy as np
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+HEADER_LEN = struct.Struct("<I")
+FORMAT_VERSION = 1
+
+
+def encode_history(history: List[Dict[str, Any]]) -> bytes:
+    entries, embs = [], []
+    for item in history:
+        entry = dict(item)
+        emb = entry.get("context_emb")
+        if emb is not None:
+            entry["context_emb"] = len(embs)  # row in the embedding block
+            embs.append(np.asarray(emb, dtype=np.float32).ravel())
+        entries.append(entry)
+    dim = len(embs[0]) if embs else 0
+    header = json.dumps({"v": FORMAT_VERSION, "dim": dim, "entries": entries},
+                        ensure_ascii=False).encode("utf-8")
+    block = np.stack(embs).tobytes() if embs else b""
+    return HEADER_LEN.pack(len(header)) + header + block
+
+
+def decode_history(data: bytes) -> List[Dict[str, Any]]:
+    (size,) = HEADER_LEN.unpack_from(data)
+    header = json.loads(data[HEADER_LEN.size:HEADER_LEN.size + size])
+    if header.get("v") != FORMAT_VERSION:
+        return []
+    dim = header["dim"]
+    embs = np.frombuffer(data, dtype=np.float32, offset=HEADER_LEN.size + size)
+    embs = embs.reshape(-1, dim) if dim else embs.reshape(0, 0)
+    history = header["entries"]
+    for entry in history:
+        row = entry.get("context_emb")
+        if row is not None:
+            entry["context_emb"] = embs[row]
+    return history
+
+
+class SessionStore:
+    """Interface shared by the memory and Redis backends"""
+
+    def get_history(self, session_id: str) -> List[Dict[str, Any]]:
+        data = self._get(self._session_key(session_id))
+        return decode_history(data) if data else []
+
+    def save_history(self, session_id: str, history: List[Dict[str, Any]]) -> None:
+        self._set(self._session_key(session_id), encode_history(history), self.session_ttl)
+
+    def history_bytes(self, session_id: str) -> int:
+        """Size of the stored history blob"""
+        data = self._get(self._session_key(session_id))
+        return len(data) if data else 0
+
+    def delete_history(self, session_id: str) -> bool:
+        return self._delete(self._session_key(session_id))
+
+    def get_answer(self, cache_key: str) -> Optional[str]:
+        data = self._get(self._answer_key(cache_key))
+        return data.decode("utf-8") if data is not None else None
+
+    def set_answer(self, cache_key: str, answer: str) -> None:
+        self._set(self._answer_key(cache_key), answer.encode("utf-8"), self.answer_ttl)
+
+    @staticmethod
+    def _session_key(session_id: str) -> str:
+        return f"session:{session_id}"
+
+    @staticmethod
+    def _answer_key(cache_key: str) -> str:
+        return f"answer:{cache_key}"
+
+
+class MemorySessionStore(SessionStore):
+    """Per-process store; sessions expire after ``session_ttl`` and are LRU-bounded"""
+
+    backend = "memory"
+
+    def __init__(self, max_sessions: int, session_ttl: int, max_answers: int, answer_ttl: int):
+        self.session_ttl = session_ttl
+        self.answer_ttl = answer_ttl
+        self._sessions = TTLCache(maxsize=max_sessions, ttl=session_ttl)
+        self._answers = TTLCache(maxsize=max_answers, ttl=answer_ttl)
+        self._lock = threading.Lock()
+
+    def _bucket(self, key: str) -> TTLCache:
+        return self._sessions if key.startswith("session:") else self._answers
+
+    def _get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._bucket(key).get(key)
+
+    def _set(self, key: str, value: bytes, ttl: int) -> None:
+        with self._lock:
+            self._bucket(key)[key] = value
+
+    def _delete(self, key: str) -> bool:
+        with self._lock:
+            return self._bucket(key).pop(key, None) is not None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "sessions": len(self._sessions),
+                "session_bytes": sum(len(v) for v in self._sessions.values()),
+                "answers": len(self._answers),
+            }
+
+
+class RespError(RuntimeError):
+    """Error reply (``-ERR ...``) from the server"""
+
+
+class RespClient:
+    """Minimal Redis protocol (RESP2) client, one connection per thread"""
+
+    def __init__(self, url: str, timeout: float = 2.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        conn = (sock, sock.makefile("rb"))
+        self._local.conn = conn
+        if self.password:
+            self._call(conn, "AUTH", self.password)
+        if self.db:
+            self._call(conn, "SELECT", self.db)
+        return conn
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(out)
+
+    def _read(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by server")
+        kind, rest = line[:1], line[1:-2]
+        if kind in (b"+", b":"):
+            return int(rest) if kind == b":" else rest.decode()
+        if kind == b"-":
+            raise RespError(rest.decode())
+        if kind == b"$":
+            size = int(rest)
+            return None if size < 0 else reader.read(size + 2)[:-2]
+        if kind == b"*":
+            size = int(rest)
+            return None if size < 0 else [self._read(reader) for _ in range(size)]
+        raise RuntimeError(f"Unexpected RESP reply: {line!r}")
+
+    def _call(self, conn, *args):
+        sock, reader = conn
+        sock.sendall(self._encode(args))
+        return self._read(reader)
+
+    def execute(self, *args):
+        """Run one command; reconnects once if the pooled connection went stale"""
+        conn = getattr(self._local, "conn", None)
+        for attempt in range(2):
+            try:
+                if conn is None:
+                    conn = self._connect()
+                return self._call(conn, *args)
+            except (ConnectionError, OSError):
+                self._local.conn = conn = None
+                if attempt:
+                    raise
+
+
+class RedisSessionStore(SessionStore):
+    """Store shared by all workers through a Redis-protocol server"""
+
+    backend = "redis"
+
+    def __init__(self, url: str, session_ttl: int, answer_ttl: int, prefix: str = "egov:"):
+        self.client = RespClient(url)
+        self.session_ttl = session_ttl
+        self.answer_ttl = answer_ttl
+        self.prefix = prefix
+
+    def _execute(self, *args, default=None):
+        """Run a command; on a connection / server error log it and return ``default``"""
+        try:
+            return self.client.execute(*args)
+        except (OSError, RespError) as e:
+            logger.warning(f"Redis {args[0]} failed, continuing without session store: {e}")
+            return default
+
+    def _get(self, key: str) -> Optional[bytes]:
+        return self._execute("GET", self.prefix + key)
+
+    def _set(self, key: str, value: bytes, ttl: int) -> None:
+        self._execute("SET", self.prefix + key, value, "EX", int(ttl))
+
+    def _delete(self, key: str) -> bool:
+        return bool(self._execute("DEL", self.prefix + key, default=0))
+
+    def stats(self) -> Dict[str, Any]:
+        try:
+            return {"backend": self.backend, "keys": self.client.execute("DBSIZE")}
+        except Exception as e:
+            return {"backend": self.backend, "error": str(e)}
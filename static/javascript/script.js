@@ -1,24 +1,19 @@
 document.addEventListener('DOMContentLoaded', () => {
 
-    // Biến để lưu trữ toàn bộ dữ liệu thủ tục
-    let allProcedures = [];
+    // Tìm kiếm và chi tiết thủ tục lấy từ server (/search, /procedure/<id>),
+    // không tải toàn bộ file dữ liệu về trình duyệt nữa
+    const searchProcedures = async (query, { mode = 'full', page = 1, pageSize = 50, fields = 'ten_thu_tuc' } = {}) => {
+        const params = new URLSearchParams({ q: query, mode, page, page_size: pageSize, fields });
+        const response = await fetch(`/search?${params}`);
+        if (!response.ok) throw new Error(`Lỗi tìm kiếm (HTTP ${response.status})`);
+        return response.json();
+    };
 
-    // TẢI DỮ LIỆU TỪ FILE JSON 
-    fetch(typeof DATA_JSON_URL !== 'undefined' ? DATA_JSON_URL : '/static/data/toan_bo_du_lieu_final.json')
-        .then(response => {
-            if (!response.ok) {
-                throw new Error('Lỗi mạng hoặc không tìm thấy file toan_bo_du_lieu_final.json');
-            }
-            return response.json();
-        })
-        .then(data => {
-            allProcedures = data;
-            console.log(`Tải thành công ${allProcedures.length} thủ tục từ file JSON.`);
-        })
-        .catch(error => {
-            console.error('Lỗi nghiêm trọng khi tải file dữ liệu:', error);
-            alert('Không thể tải được cơ sở dữ liệu thủ tục. Vui lòng kiểm tra lại file và đường dẫn. Chức năng tìm kiếm sẽ không hoạt động.');
-        });
+    const fetchProcedure = async (id) => {
+        const response = await fetch(`/procedure/${encodeURIComponent(id)}`);
+        if (!response.ok) throw new Error(`Không tải được thủ tục (HTTP ${response.status})`);
+        return response.json();
+    };
 
     // Lấy các phần tử DOM 
     const getEl = (id) => document.getElementById(id);
@@ -220,10 +215,16 @@ ${proc.thu_tuc_lien_quan || '_Không có_'}
                 statsModalBody.innerHTML = '<p>Đang tải danh sách thủ tục được hỏi nhiều nhất...</p>';
 
                 try {
-                    const POP_URL = (typeof POPULAR_JSON_URL !== 'undefined') ? POPULAR_JSON_URL : 'user_data/popular_procedures.json';
-                    const resp = await fetch(POP_URL);
-                    if (!resp.ok) throw new Error('Không tải được file popular_procedures.json (HTTP ' + resp.status + ')');
-                    const json = await resp.json();
+                    const fetchPopular = async (query) => {
+                        const resp = await fetch('/popular?' + query);
+                        if (!resp.ok) throw new Error('Không tải được danh sách thủ tục phổ biến (HTTP ' + resp.status + ')');
+                        return resp.json();
+                    };
+                    let json = await fetchPopular('limit=10');
+                    // Cửa sổ gần đây trống (vd. vừa deploy, số liệu seed không có thời gian) -> lấy toàn thời gian
+                    if (Array.isArray(json.popular_procedures) && json.popular_procedures.length === 0) {
+                        json = await fetchPopular('limit=10&hours=0');
+                    }
 
                     let arr = [];
                     if (Array.isArray(json.popular_procedures)) arr = json.popular_procedures;
@@ -372,13 +373,12 @@ ${proc.thu_tuc_lien_quan || '_Không có_'}
                             const normalized = s => (s || '').toString().trim().toLowerCase();
                             const nameLower = normalized(item.name);
                             let match = null;
-                            if (Array.isArray(allProcedures) && allProcedures.length > 0) {
-                                match = allProcedures.find(p => normalized(p.ten_thu_tuc) === nameLower);
-                                if (!match) {
-                                    match = allProcedures.find(p =>
-                                        normalized(p.ten_thu_tuc).includes(nameLower) || nameLower.includes(normalized(p.ten_thu_tuc))
-                                    );
-                                }
+                            try {
+                                const { results } = await searchProcedures(item.name, { pageSize: 5 });
+                                const hit = results.find(p => normalized(p.ten_thu_tuc) === nameLower) || results[0];
+                                if (hit) match = await fetchProcedure(hit.id);
+                            } catch (err) {
+                                console.error('Lỗi khi tìm thủ tục:', err);
                             }
                             if (match) {
                                 showProcedureDetails(match, match.ten_thu_tuc || item.name, li);
@@ -408,7 +408,7 @@ ${proc.thu_tuc_lien_quan || '_Không có_'}
                     statsModalBody.appendChild(ol);
 
                 } catch (err) {
-                    console.error('Lỗi khi load popular_procedures.json:', err);
+                    console.error('Lỗi khi tải /popular:', err);
                     statsModalBody.innerHTML = `<p>Không thể tải dữ liệu thống kê: ${err.message}</p>`;
                 }
 
@@ -590,30 +590,71 @@ ${proc.thu_tuc_lien_quan || '_Không có_'}
     startChatBtn.addEventListener('click', (e) => openModal(chatbotContainer, e.currentTarget));
 
     // LOGIC TÌM KIẾM 
-    searchForm.addEventListener('submit', (e) => {
+    searchForm.addEventListener('submit', async (e) => {
         e.preventDefault();
-        const keyword = searchInput.value.trim().toLowerCase();
+        const keyword = searchInput.value.trim();
         resultsList.innerHTML = '';
+        resultsContainer.querySelectorAll('.search-more').forEach((btn) => btn.remove());
 
         if (keyword) {
-            const filtered = allProcedures.filter(item =>
-                item.ten_thu_tuc?.toLowerCase().includes(keyword)
-            );
-
-            if (filtered.length > 0) {
-                resultsTitle.textContent = `Kết quả (${filtered.length}):`;
-                filtered.forEach((item) => {
-                    const li = document.createElement('li');
-                    li.className = 'p-3 border border-white/10 rounded-lg bg-white/5 hover:bg-white/10 transition-colors text-sm cursor-pointer';
-                    li.textContent = item.ten_thu_tuc;
-
-                    // Hiển thị bằng hàm chung để giống hệt behaviour khi click từ Top10
-                    li.addEventListener('click', (e_li) => {
-                        showProcedureDetails(item, item.ten_thu_tuc, e_li.currentTarget);
-                    });
+            let data = null;
+            try {
+                data = await searchProcedures(keyword);
+            } catch (err) {
+                console.error(err);
+            }
 
-                    resultsList.appendChild(li);
+            if (data && data.results.length > 0) {
+                let shown = 0;
+                const renderItems = (items) => {
+                    items.forEach((item) => {
+                        const li = document.createElement('li');
+                        li.className = 'p-3 border border-white/10 rounded-lg bg-white/5 hover:bg-white/10 transition-colors text-sm cursor-pointer';
+                        li.textContent = item.ten_thu_tuc;
+
+                        // Hiển thị bằng hàm chung để giống hệt behaviour khi click từ Top10
+                        li.addEventListener('click', async (e_li) => {
+                            const trigger = e_li.currentTarget;
+                            try {
+                                const proc = await fetchProcedure(item.id);
+                                showProcedureDetails(proc, proc.ten_thu_tuc, trigger);
+                            } catch (err) {
+                                console.error(err);
+                                alert(err.message);
+                            }
+                        });
+
+                        resultsList.appendChild(li);
+                    });
+                    shown += items.length;
+                    resultsTitle.textContent = shown < data.total
+                        ? `Kết quả (${shown}/${data.total}):`
+                        : `Kết quả (${data.total}):`;
+                };
+
+                // Server trả từng trang (tối đa 50): nút "Xem thêm" tải trang kế tiếp
+                const moreBtn = document.createElement('button');
+                moreBtn.type = 'button';
+                moreBtn.className = 'search-more mt-2 px-4 py-2 rounded-full bg-white/10 hover:bg-white/20 text-sm';
+                moreBtn.textContent = 'Xem thêm';
+                let page = 1;
+                moreBtn.addEventListener('click', async () => {
+                    moreBtn.disabled = true;
+                    try {
+                        const next = await searchProcedures(keyword, { page: page + 1 });
+                        page += 1;
+                        moreBtn.remove();
+                        renderItems(next.results);
+                        if (next.results.length > 0 && shown < data.total) resultsList.after(moreBtn);
+                    } catch (err) {
+                        console.error(err);
+                    } finally {
+                        moreBtn.disabled = false;
+                    }
                 });
+
+                renderItems(data.results);
+                if (shown < data.total) resultsList.after(moreBtn);
             } else {
                 resultsTitle.textContent = 'Không tìm thấy kết quả nào.';
             }
@@ -623,6 +664,31 @@ ${proc.thu_tuc_lien_quan || '_Không có_'}
         }
     });
 
+    // Gợi ý tên thủ tục khi gõ (mode=prefix, không gọi mô hình embedding)
+    const suggestionList = document.createElement('datalist');
+    suggestionList.id = 'search-suggestions';
+    document.body.appendChild(suggestionList);
+    searchInput.setAttribute('list', suggestionList.id);
+    let suggestTimer = null;
+    searchInput.addEventListener('input', () => {
+        clearTimeout(suggestTimer);
+        const query = searchInput.value.trim();
+        if (query.length < 2) return;
+        suggestTimer = setTimeout(async () => {
+            try {
+                const { results } = await searchProcedures(query, { mode: 'prefix', pageSize: 8 });
+                suggestionList.innerHTML = '';
+                results.forEach(item => {
+                    const option = document.createElement('option');
+                    option.value = item.ten_thu_tuc;
+                    suggestionList.appendChild(option);
+                });
+            } catch (err) {
+                console.error(err);
+            }
+        }, 200);
+    });
+
     // LOGIC CHAT 
     let messages = [{ role: "assistant", content: "Chào bạn, tôi là trợ lý ảo eGov-Bot." }];
 
@@ -782,10 +848,11 @@ ${proc.thu_tuc_lien_quan || '_Không có_'}
             const API_ENDPOINT = "http://localhost:7860/chat";
             const response = await fetch(API_ENDPOINT, {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
                 body: JSON.stringify({
                     question: userText,
-                    session_id: "user123" 
+                    session_id: "user123",
+                    stream: "sse"
                 }),
             });
 
@@ -793,23 +860,47 @@ ${proc.thu_tuc_lien_quan || '_Không có_'}
                 throw new Error('Lỗi kết nối đến máy chủ AI');
             }
 
-            const data = await response.json();
-            const fullAnswer = data.answer;
-
-            const statusContent = statusDiv.querySelector('i');
-            statusContent.textContent = 'Đã tìm thấy câu trả lời. Bắt đầu hiển thị...';
-
-            await sleep(1000);
-
-            statusDiv.remove();
-
-            messages.push({ role: 'assistant', content: fullAnswer });
-            renderMessages();
-
-            const lastMessageElement = chatMessagesContainer.lastElementChild;
-            if (lastMessageElement) {
-                lastMessageElement.classList.add('message-enter-active');
+            // Câu trả lời hiện dần theo từng token (SSE); JSON vẫn được hỗ trợ
+            const assistantMessage = { role: 'assistant', content: '' };
+            let started = false;
+            let renderPending = false;
+            const showToken = (text) => {
+                if (!started) {
+                    started = true;
+                    statusDiv.remove();
+                    messages.push(assistantMessage);
+                }
+                assistantMessage.content += text;
+                if (!renderPending) {
+                    renderPending = true;
+                    requestAnimationFrame(() => {
+                        renderPending = false;
+                        renderMessages();
+                    });
+                }
+            };
+
+            const contentType = response.headers.get('Content-Type') || '';
+            if (contentType.includes('text/event-stream')) {
+                await readEventStream(response, (event, data) => {
+                    if (event === 'token') {
+                        showToken(data.text);
+                    } else if (event === 'done') {
+                        console.log(`TTFT ${data.ttft_ms} ms, tổng ${data.latency_ms} ms`);
+                    } else if (event === 'error' && !started) {
+                        throw new Error(data.message);
+                    } else if (event === 'error') {
+                        showToken('\n\n_(Câu trả lời bị gián đoạn, vui lòng thử lại.)_');
+                    }
+                });
+            } else {
+                const data = await response.json();
+                showToken(data.answer);
             }
+            if (!started) {
+                throw new Error('Máy chủ không trả về câu trả lời');
+            }
+            renderMessages();
 
         } catch (error) {
             console.error('Lỗi:', error);
@@ -819,6 +910,30 @@ ${proc.thu_tuc_lien_quan || '_Không có_'}
         }
     });
 
+    // Đọc luồng Server-Sent Events từ fetch (EventSource không hỗ trợ POST)
+    async function readEventStream(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder('utf-8');
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const block = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                let event = 'message';
+                let data = '';
+                block.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) event = line.slice(6).trim();
+                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                });
+                if (data) onEvent(event, JSON.parse(data));
+            }
+        }
+    }
+
     // LOGIC CHO NÚT XÓA CHAT 
     clearChatBtn.addEventListener('click', async () => {
         // Đặt lại mảng tin nhắn về trạng thái ban đầu
@@ -0,0 +1,88 @@
+"""In-process stand-in for a Redis server: RESP2 with GET / SET [EX] / DEL / DBSIZE"""
+import socketserver
+import threading
+import time
+
+
+class RespServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password=None, clock=time.monotonic):
+        super().__init__(("127.0.0.1", 0), RespHandler)
+        self.password = password
+        self.clock = clock
+        self.data = {}  # key -> (value, expires_at or None)
+        self.lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        auth = f":{self.password}@" if self.password else ""
+        return f"redis://{auth}127.0.0.1:{self.server_address[1]}/0"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+    def _live(self, key):
+        item = self.data.get(key)
+        if item is not None and item[1] is not None and self.clock() >= item[1]:
+            del self.data[key]
+            return None
+        return item
+
+    def command(self, args):
+        name = args[0].upper()
+        with self.lock:
+            if name == b"AUTH":
+                return b"+OK" if args[1].decode() == self.password else b"-ERR invalid password"
+            if name in (b"SELECT", b"PING"):
+                return b"+OK"
+            if name == b"GET":
+                item = self._live(args[1])
+                return None if item is None else item[0]
+            if name == b"SET":
+                expires = None
+                if len(args) >= 5 and args[3].upper() == b"EX":
+                    expires = self.clock() + int(args[4])
+                self.data[args[1]] = (args[2], expires)
+                return b"+OK"
+            if name == b"DEL":
+                return sum(self._live(key) is not None and self.data.pop(key) is not None for key in args[1:])
+            if name == b"DBSIZE":
+                return sum(self._live(key) is not None for key in list(self.data))
+        return b"-ERR unknown command"
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            size = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def handle(self):
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            reply = self.server.command(args)
+            if reply is None:
+                out = b"$-1\r\n"
+            elif isinstance(reply, int):
+                out = b":%d\r\n" % reply
+            elif reply[:1] in (b"+", b"-"):
+                out = reply + b"\r\n"
+            else:
+                out = b"$%d\r\n%s\r\n" % (len(reply), reply)
+            self.wfile.write(out)
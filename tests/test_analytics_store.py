@@ -0,0 +1,52 @@
+import pytest
+
+from analytics_store import AnalyticsStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    st = AnalyticsStore(str(tmp_path / "analytics.db"), flush_interval=3600)
+    yield st
+    st.close()
+
+
+def forbid_sqlite(store, monkeypatch):
+    def fail():
+        raise AssertionError("SQLite accessed on the request path")
+    monkeypatch.setattr(store, "_connect", fail)
+
+
+def test_feedback_summary_is_served_from_memory(store, monkeypatch):
+    store.record_feedback("like")
+    store.flush()
+    store.record_feedback("dislike", "like")  # đổi phiếu: delta âm cho like
+    forbid_sqlite(store, monkeypatch)
+    assert store.feedback_summary() == {"likes": 0, "dislikes": 1}
+
+
+def test_flushed_votes_stay_counted(store):
+    store.record_feedback("like")
+    store.record_feedback("like")
+    store.flush()
+    assert store.feedback_summary() == {"likes": 2, "dislikes": 0}
+
+
+def test_refresh_picks_up_other_workers(store):
+    other = AnalyticsStore(store.db_path, flush_interval=3600)
+    try:
+        other.record_feedback("dislike")
+        other.flush()
+    finally:
+        other.close()
+    assert store.feedback_summary()["dislikes"] == 0
+    store.refresh_feedback_totals()
+    assert store.feedback_summary()["dislikes"] == 1
+
+
+def test_every_view_is_counted(store):
+    for _ in range(3):
+        store.record_view("Cấp hộ chiếu")
+    store.record_view("Đăng ký khai sinh")
+    store.flush()
+    assert store.popular(2) == [{"name": "Cấp hộ chiếu", "total_queries": 3},
+                                {"name": "Đăng ký khai sinh", "total_queries": 1}]
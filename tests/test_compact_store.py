@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+
+from compact_store import ColumnarMetas, RecordStore, SortedStringIndex, current_version, read_manifest, write_store
+
+
+def build(store_dir, title):
+    metas = [{"parent_id": "p1", "text": title}, {"parent_id": "p2", "text": "khác"}]
+    records = {"p1": {"ten_thu_tuc": title}, "p2": {"ten_thu_tuc": "khác"}}
+    write_store(store_dir, metas, ["p1", "p2"], np.array([0, 1]), ["a"], np.array([0, 1]),
+                np.array([0], dtype=np.int32), np.array([1.0], dtype=np.float32), 2,
+                records, {"raw": title})
+
+
+def test_rebuild_swaps_symlink_and_prunes_old_versions(tmp_path):
+    store_dir = str(tmp_path / "store")
+    build(store_dir, "v1")
+    first = current_version(store_dir)
+    assert os.path.islink(store_dir) and read_manifest(store_dir)["sources"] == {"raw": "v1"}
+
+    build(store_dir, "v2")
+    second = current_version(store_dir)
+    assert second != first and os.path.isdir(first)  # previous version kept for readers
+    assert RecordStore(first)["p1"] == {"ten_thu_tuc": "v1"}
+
+    build(store_dir, "v3")
+    assert not os.path.exists(first)
+    assert os.path.isdir(second)
+    assert RecordStore(store_dir)["p1"] == {"ten_thu_tuc": "v3"}
+
+
+def test_legacy_directory_is_replaced(tmp_path):
+    store_dir = tmp_path / "store"
+    store_dir.mkdir()
+    (store_dir / "manifest.json").write_text("{}")
+    build(str(store_dir), "v1")
+    assert os.path.islink(store_dir)
+    assert read_manifest(str(store_dir))["procedures"] == 2
+
+
+def test_decoded_rows_are_cached(tmp_path):
+    store_dir = str(tmp_path / "store")
+    build(store_dir, "v1")
+    records = RecordStore(store_dir, cache_size=1)
+    assert records["p1"] is records["p1"]
+    assert records["p2"] == {"ten_thu_tuc": "khác"}
+    metas = ColumnarMetas(store_dir, read_manifest(store_dir)["fields"])
+    assert metas[0] is metas[0] and metas[-1] == {"parent_id": "p2", "text": "khác"}
+
+
+def test_keys_are_looked_up_in_sorted_columns(tmp_path):
+    store_dir = str(tmp_path / "store")
+    vocab = ["thủ_tục", "đăng", "cấp", "~dang"]
+    write_store(store_dir, [{"parent_id": "p1"}], ["p1"], np.array([0]), vocab,
+                np.arange(len(vocab) + 1), np.zeros(len(vocab), dtype=np.int32),
+                np.ones(len(vocab), dtype=np.float32), 1,
+                {"z": {"ten_thu_tuc": "z"}, "a": {"ten_thu_tuc": "a"}}, {"raw": "v1"})
+    index = SortedStringIndex(os.path.join(store_dir, "bm25_vocab"))
+    assert {term: index[term] for term in vocab} == {term: i for i, term in enumerate(vocab)}
+    assert index.get("khác") is None and "khác" not in index and len(index) == 4
+
+    records = RecordStore(store_dir)
+    assert records["z"] == {"ten_thu_tuc": "z"} and records["a"] == {"ten_thu_tuc": "a"}
+    assert list(records) == ["z", "a"] and "b" not in records
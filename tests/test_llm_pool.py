@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+import pytest
+
+from llm_pool import CircuitBreaker, GenerationPool, LLMKey, NoAvailableKeyError, error_status
+
+
+def make_key(name, rpm=None, burst=None, daily_quota=None):
+    return LLMKey(name, model=None, rpm=rpm, burst=burst, daily_quota=daily_quota,
+                  breaker_threshold=1, breaker_cooldown=0.05)
+
+
+def open_breaker(key):
+    key.breaker.record_failure()
+    assert key.breaker.state == CircuitBreaker.OPEN
+
+
+def test_unlimited_by_default():
+    pool = GenerationPool([make_key("a")])
+    for _ in range(100):
+        key, wait = pool._try_acquire(set())
+        assert key is not None and wait == 0.0
+    assert pool.stats()[0]["remaining_daily_quota"] is None
+
+
+def test_daily_quota_is_enforced():
+    pool = GenerationPool([make_key("a", daily_quota=2)])
+    assert pool._try_acquire(set())[0] is not None
+    assert pool._try_acquire(set())[0] is not None
+    assert pool._try_acquire(set()) == (None, None)
+    with pytest.raises(NoAvailableKeyError):
+        next(pool.candidates())
+
+
+def test_only_the_chosen_key_goes_half_open():
+    a, b = make_key("a", daily_quota=10), make_key("b", daily_quota=5)
+    open_breaker(a)
+    open_breaker(b)
+    opened_at = b.breaker.opened_at
+    time.sleep(0.06)
+    key, _ = GenerationPool([a, b])._try_acquire(set())
+    assert key is a
+    assert a.breaker.state == CircuitBreaker.HALF_OPEN
+    assert b.breaker.state == CircuitBreaker.OPEN
+    assert b.breaker.opened_at == opened_at
+
+
+def test_open_key_is_skipped_without_side_effects():
+    a, b = make_key("a"), make_key("b")
+    open_breaker(a)
+    opened_at = a.breaker.opened_at
+    key, _ = GenerationPool([a, b])._try_acquire(set())
+    assert key is b
+    assert a.breaker.state == CircuitBreaker.OPEN and a.breaker.opened_at == opened_at
+
+
+def test_error_status_ignores_message_text():
+    assert error_status(RuntimeError("upstream said 503 / quota")) is None
+
+
+def test_error_status_google_exceptions():
+    exceptions = pytest.importorskip("google.api_core.exceptions")
+    assert error_status(exceptions.ResourceExhausted("quota")) == 429
+    assert error_status(exceptions.ServiceUnavailable("down")) == 503
+    assert error_status(exceptions.InternalServerError("oops")) == 500
+    assert error_status(exceptions.InvalidArgument("bad prompt")) == 400
+
+
+def test_async_client_bound_once_per_event_loop():
+    bound = []
+    key = LLMKey("a", model=object(), rpm=None, burst=None, daily_quota=None,
+                 breaker_threshold=1, breaker_cooldown=1, bind_async=lambda model: bound.append(model))
+
+    async def call_twice():
+        key.async_model()
+        key.async_model()
+
+    asyncio.run(call_twice())
+    assert len(bound) == 1
+    asyncio.run(call_twice())  # loop mới -> client mới
+    assert len(bound) == 2
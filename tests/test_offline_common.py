@@ -0,0 +1,24 @@
+import json
+
+from offline_common import load_questions, read_items
+
+
+def test_load_questions_from_jsonl(tmp_path):
+    path = tmp_path / "testset.jsonl"
+    path.write_text(
+        json.dumps({"id": "7", "question": "Cần giấy tờ gì?"}, ensure_ascii=False) + "\n"
+        + json.dumps({"id": "8", "question": "Nộp ở đâu?"}, ensure_ascii=False) + "\n\n",
+        encoding="utf-8")
+    assert load_questions(str(path)) == ["Cần giấy tờ gì?", "Nộp ở đâu?"]
+    assert [item["id"] for item in read_items(str(path))] == ["7", "8"]
+
+
+def test_load_questions_from_legacy_json(tmp_path):
+    path = tmp_path / "testset_multi_turn.json"
+    path.write_text(json.dumps([
+        {"context": "Cấp hộ chiếu", "dialogue": [{"question": "Q1"}, {"question": "Q2"}]},
+        {"question": "Q3"},
+    ]), encoding="utf-8")
+    assert load_questions(str(path)) == ["Q1", "Q2", "Q3"]
+    assert load_questions(str(path), limit=2) == ["Q1", "Q2"]
+    assert read_items(str(path))[0]["context"] == "Cấp hộ chiếu"
@@ -0,0 +1,65 @@
+import pytest
+
+from procedure_fields import (
+    FIELD_MAP, NO_DETAILS_TEXT, classify_field_intent, procedure_text, question_fields, strip_procedure_name
+)
+
+FAST_PATH_MIN_CONFIDENCE = 0.8  # Config.FAST_PATH_MIN_CONFIDENCE
+
+BAN_SAO = "Cấp bản sao trích lục hộ tịch"
+BOI_THUONG = "Giải quyết yêu cầu bồi thường tại cơ quan trực tiếp quản lý người thi hành công vụ gây thiệt hại"
+HO_CHIEU = "Cấp hộ chiếu phổ thông trong nước"
+
+
+def fast_path_field(query, name=""):
+    field, confidence = classify_field_intent(query, name)
+    return field if confidence >= FAST_PATH_MIN_CONFIDENCE else None
+
+
+@pytest.mark.parametrize("query, name, expected", [
+    ("Cấp hộ chiếu cần những giấy tờ gì?", HO_CHIEU, "thanh_phan_ho_so"),
+    ("cap ho chieu can giay to gi", HO_CHIEU, None),  # không dấu: không khớp mẫu, để LLM trả lời
+    ("Cơ quan nào thực hiện thủ tục cấp hộ chiếu?", HO_CHIEU, "co_quan_thuc_hien"),
+    ("Nộp hồ sơ ở đâu?", HO_CHIEU, "co_quan_thuc_hien"),
+    ("Nguồn ở đâu", HO_CHIEU, "nguon"),
+    ("Trình tự thực hiện như thế nào", HO_CHIEU, "trinh_tu_thuc_hien"),
+    ("Yêu cầu bồi thường nhà nước cần hồ sơ gì", BOI_THUONG, "thanh_phan_ho_so"),
+    ("Điều kiện là gì?", BOI_THUONG, "yeu_cau_dieu_kien"),
+])
+def test_fast_path_answers_single_section_questions(query, name, expected):
+    assert fast_path_field(query, name) == expected
+
+
+@pytest.mark.parametrize("query, name", [
+    (BAN_SAO, BAN_SAO),                                   # tên thủ tục trần, không phải câu hỏi
+    ("cấp bản sao trích lục hộ tịch", ""),
+    ("Không mang theo giấy tờ thì sao?", BAN_SAO),
+    ("Phải làm gì khi bị mất?", BAN_SAO),
+    ("Trình tự thực hiện khi bị mất hộ chiếu là gì?", HO_CHIEU),
+    ("Tại sao cần giấy tờ này?", HO_CHIEU),
+    ("Yêu cầu bồi thường cần hồ sơ gì", ""),              # tên không rõ: hai mục, không chắc chắn
+    ("Lệ phí bao nhiêu?", HO_CHIEU),                       # cach_thuc_thuc_hien luôn qua LLM
+    ("Cần giấy tờ gì và nộp ở đâu?", HO_CHIEU),            # hỏi nhiều mục
+])
+def test_fast_path_declines_ambiguous_or_reasoning_questions(query, name):
+    assert fast_path_field(query, name) is None
+
+
+def test_weak_patterns_yield_to_a_clear_section():
+    assert question_fields("nguồn ở đâu") == ["nguon"]
+    assert question_fields("nộp hồ sơ ở đâu") == ["co_quan_thuc_hien"]
+    assert question_fields("hồ sơ ở đâu") == ["thanh_phan_ho_so", "co_quan_thuc_hien"]
+
+
+def test_strip_procedure_name_matches_partial_and_unaccented_names():
+    assert strip_procedure_name("yêu cầu bồi thường nhà nước cần hồ sơ gì", BOI_THUONG) == "nhà nước cần hồ sơ gì"
+    assert strip_procedure_name("cap ban sao trich luc can gi?", BAN_SAO) == "can gi?"
+    # Một từ trùng lẻ không bị xoá
+    assert strip_procedure_name("cần bản chính không", BAN_SAO) == "cần bản chính không"
+
+
+def test_procedure_text_keeps_record_order_and_known_fields():
+    obj = {"nguon": "https://x", "ten_thu_tuc": "A", "khac": "bỏ qua", "thanh_phan_ho_so": "  Tờ khai "}
+    assert procedure_text(obj) == "Nguồn:\nhttps://x\n\nTên thủ tục:\nA\n\nThành phần hồ sơ:\nTờ khai"
+    assert procedure_text({"khac": "x"}) == NO_DETAILS_TEXT
+    assert set(FIELD_MAP) >= {"ten_thu_tuc", "nguon"}
@@ -0,0 +1,118 @@
+import socket
+
+import numpy as np
+import pytest
+
+from resp_server import RespServer
+from session_store import MemorySessionStore, RedisSessionStore, RespClient, decode_history, encode_history
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def sample_history():
+    return [
+        {"role": "user", "content": "Cần giấy tờ gì?", "parent_id": "1.001",
+         "context_emb": np.arange(4, dtype=np.float32) / 4},
+        {"role": "assistant", "content": "Thành phần hồ sơ: ..."},
+        {"role": "user", "content": "Nộp ở đâu?", "context_emb": np.ones(4, dtype=np.float32)},
+    ]
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def server(clock):
+    with RespServer(password="secret", clock=clock) as srv:
+        yield srv
+
+
+@pytest.fixture
+def store(server):
+    return RedisSessionStore(server.url, session_ttl=60, answer_ttl=10)
+
+
+def test_history_round_trip():
+    history = sample_history()
+    decoded = decode_history(encode_history(history))
+    assert [{k: v for k, v in e.items() if k != "context_emb"} for e in decoded] == \
+        [{k: v for k, v in e.items() if k != "context_emb"} for e in history]
+    np.testing.assert_array_equal(decoded[0]["context_emb"], history[0]["context_emb"])
+    np.testing.assert_array_equal(decoded[2]["context_emb"], history[2]["context_emb"])
+    assert "context_emb" not in decoded[1]
+
+
+def test_history_round_trip_without_embeddings():
+    history = [{"role": "user", "content": "xin chào"}]
+    assert decode_history(encode_history(history)) == history
+    assert decode_history(encode_history([])) == []
+
+
+def test_resp_client_get_set_delete_dbsize(server):
+    client = RespClient(server.url)
+    assert client.execute("GET", "k") is None
+    assert client.execute("SET", "k", b"\x00v\r\n", "EX", 5) == "OK"
+    assert client.execute("GET", "k") == b"\x00v\r\n"
+    assert client.execute("DBSIZE") == 1
+    assert client.execute("DEL", "k", "missing") == 1
+    assert client.execute("DBSIZE") == 0
+
+
+def test_redis_store_round_trip_and_delete(store):
+    store.save_history("s1", sample_history())
+    history = store.get_history("s1")
+    assert [e["content"] for e in history] == [e["content"] for e in sample_history()]
+    assert store.history_bytes("s1") > 0
+    store.set_answer("q", "Trả lời")
+    assert store.get_answer("q") == "Trả lời"
+    assert store.stats() == {"backend": "redis", "keys": 2}
+    assert store.delete_history("s1") is True
+    assert store.delete_history("s1") is False
+    assert store.get_history("s1") == []
+
+
+def test_redis_store_ttl(store, clock):
+    store.save_history("s1", sample_history())
+    store.set_answer("q", "Trả lời")
+    clock.now += 11
+    assert store.get_answer("q") is None
+    assert store.get_history("s1") != []
+    clock.now += 50
+    assert store.get_history("s1") == []
+    assert store.stats()["keys"] == 0
+
+
+def test_redis_store_survives_reconnect(server, store):
+    store.set_answer("q", "a")
+    store.client._local.conn[0].close()  # connection dropped under the client
+    assert store.get_answer("q") == "a"
+
+
+def test_redis_unavailable_degrades_to_empty_store():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]  # closed again: nothing listens here
+    store = RedisSessionStore(f"redis://127.0.0.1:{port}/0", session_ttl=60, answer_ttl=10)
+    assert store.get_history("s1") == []
+    store.save_history("s1", sample_history())
+    assert store.get_answer("q") is None
+    assert store.delete_history("s1") is False
+    assert "error" in store.stats()
+
+
+def test_memory_store_round_trip():
+    store = MemorySessionStore(max_sessions=2, session_ttl=60, max_answers=2, answer_ttl=60)
+    store.save_history("s1", sample_history())
+    assert len(store.get_history("s1")) == 3
+    store.set_answer("q", "a")
+    assert store.get_answer("q") == "a"
+    assert store.stats()["sessions"] == 1 and store.stats()["answers"] == 1
+    assert store.delete_history("s1") and store.get_history("s1") == []
@@ -0,0 +1,91 @@
+# vn_text.py - Vietnamese normalization and tokenization shared by indexing and queries
+#
+# The same functions build the BM25 postings and tokenize incoming questions, so
+# both sides always agree on what a term is:
+#
+#   normalize("Đăng ký  KHAI-SINH!")  -> "đăng ký khai sinh"   (NFC, lowercase, no punctuation)
+#   fold("đăng ký khai sinh")         -> "dang ky khai sinh"   (diacritics removed, đ -> d)
+#
+# Index terms come in two parallel fields:
+#   exact   unigrams + adjacent bigrams ("khai_sinh") on the accented text
+#   folded  the same terms on the folded text, prefixed with "~" ("~dang_ky")
+# A query word typed without diacritics ("dang ky khai sinh", common on mobile)
+# is looked up in the folded field; words typed with diacritics stay exact.
+import re
+import unicodedata
+from functools import lru_cache
+from typing import List, Tuple
+
+# Bump when the term format changes: indexes built with another version are stale
+TOKENIZER_VERSION = 1
+
+FOLDED_PREFIX = "~"
+BIGRAM_JOINER = "_"
+
+_PUNCT_RE = re.compile(r"[^\w\s]|_", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+", re.UNICODE)
+
+
+def _build_fold_table():
+    """Translation table: every precomposed Latin letter -> its base letter"""
+    table = {}
+    for start, end in ((0x00C0, 0x024F), (0x1E00, 0x1EFF)):
+        for code in range(start, end + 1):
+            ch = chr(code)
+            base = "".join(c for c in unicodedata.normalize("NFD", ch) if not unicodedata.combining(c))
+            if base != ch and base.isascii():
+                table[code] = base
+    table.update({ord("đ"): "d", ord("Đ"): "D"})
+    return table
+
+
+_FOLD_TABLE = _build_fold_table()
+
+
+def fold(text: str) -> str:
+    """Remove Vietnamese diacritics (expects NFC text)"""
+    return text.translate(_FOLD_TABLE)
+
+
+@lru_cache(maxsize=4096)
+def normalize_text(text: str) -> str:
+    """NFC, lowercase, whitespace collapsed; punctuation is kept ("?" still marks a question)"""
+    return " ".join(unicodedata.normalize("NFC", text).lower().strip().split())
+
+
+@lru_cache(maxsize=4096)
+def normalize(text: str) -> str:
+    """NFC, lowercase, punctuation replaced by spaces, whitespace collapsed"""
+    text = unicodedata.normalize("NFC", text or "").lower()
+    return _SPACE_RE.sub(" ", _PUNCT_RE.sub(" ", text)).strip()
+
+
+def tokenize(text: str) -> List[str]:
+    return normalize(text).split()
+
+
+def _with_bigrams(tokens: List[str]) -> List[str]:
+    return tokens + [a + BIGRAM_JOINER + b for a, b in zip(tokens, tokens[1:])]
+
+
+def index_terms(text: str) -> List[str]:
+    """BM25 document terms: exact and folded unigrams + bigrams"""
+    tokens = tokenize(text)
+    folded = [FOLDED_PREFIX + t for t in _with_bigrams([fold(t) for t in tokens])]
+    return _with_bigrams(tokens) + folded
+
+
+@lru_cache(maxsize=4096)
+def query_terms(text: str) -> Tuple[str, ...]:
+    """BM25 query terms; a unigram / bigram containing an unaccented word uses the folded field"""
+    tokens = tokenize(text)
+    plain = [fold(t) == t for t in tokens]
+
+    def term(words: List[str], flags: List[bool]) -> str:
+        if any(flags):
+            return FOLDED_PREFIX + BIGRAM_JOINER.join(fold(w) for w in words)
+        return BIGRAM_JOINER.join(words)
+
+    terms = [term([t], [p]) for t, p in zip(tokens, plain)]
+    terms += [term(tokens[i:i + 2], plain[i:i + 2]) for i in range(len(tokens) - 1)]
+    return tuple(terms)